@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# Usage: python -m benchmarks.bench_annotation_tree [DATAPOINTS]
+#
+# Compares looking up the datapoints match_vendor needs by four recursive walks
+# of the annotation tree and by a single indexing walk, on a synthetic annotation
+# with a big line item table in front of the vendor section. Then compares parsing
+# the request body with json.loads and with the pruning ANNOTATION_DECODER, by time
+# and by peak memory relative to the size of the body.
+
+import json
+import sys
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List
+
+from fuzzy_vendor_matching_webhook_python.webhook import (
+    ANNOTATION_DECODER,
+    MATCHED_SCHEMA_IDS,
+    index_by_schema_id,
+)
+
+LINE_ITEM_COLUMNS = ["item_description", "item_quantity", "item_amount", "item_amount_total"]
+
+
+def create_annotation_tree(datapoints: int) -> List[Dict]:
+    """Annotation content with a line item table of about `datapoints` datapoints."""
+    rows = [
+        {
+            "id": f"row{row}",
+            "schema_id": "line_item",
+            "children": [
+                {"id": f"{row}_{column}", "schema_id": column, "content": {"value": str(row)}}
+                for column in LINE_ITEM_COLUMNS
+            ],
+        }
+        for row in range(datapoints // len(LINE_ITEM_COLUMNS))
+    ]
+    vendor_section = {
+        "id": "vendor_section",
+        "schema_id": "vendor_section",
+        "children": [
+            {"id": schema_id, "schema_id": schema_id, "content": {"value": ""}}
+            for schema_id in MATCHED_SCHEMA_IDS
+        ],
+    }
+    line_items_section = {
+        "id": "line_items_section",
+        "schema_id": "line_items_section",
+        "children": [{"id": "line_items", "schema_id": "line_items", "children": rows}],
+    }
+    return [line_items_section, vendor_section]
+
+
+def find_by_schema_id_recursive(annotation_tree: List[Dict], schema_id: str):
+    """The former lookup, one recursive walk per schema id."""
+    for node in annotation_tree:
+        if node["schema_id"] == schema_id:
+            return node
+        elif "children" in node:
+            node = find_by_schema_id_recursive(node["children"], schema_id)
+            if node is not None:
+                return node
+    return None
+
+
+def peak_memory(call: Callable) -> int:
+    """Peak bytes allocated by a call."""
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def best_time(call: Callable) -> float:
+    number, _ = timeit.Timer(call).autorange()
+    return min(timeit.repeat(call, number=number, repeat=5)) / number
+
+
+if __name__ == "__main__":
+    datapoints = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    annotation_tree = create_annotation_tree(datapoints)
+    benchmarks = {
+        "recursive walk per datapoint": lambda: [
+            find_by_schema_id_recursive(annotation_tree, schema_id)
+            for schema_id in MATCHED_SCHEMA_IDS
+        ],
+        "single indexing walk": lambda: index_by_schema_id(annotation_tree, MATCHED_SCHEMA_IDS),
+    }
+    for name, lookup in benchmarks.items():
+        best = best_time(lookup)
+        print(f"{name}: {best * 1e6:.0f} us per annotation ({datapoints} datapoints)")
+
+    body = json.dumps({"annotation": {"content": annotation_tree}}).encode()
+    parsers = {
+        "json.loads": lambda: json.loads(body),
+        "pruning decoder": lambda: ANNOTATION_DECODER.decode(body.decode()),
+    }
+    for name, parse in parsers.items():
+        print(
+            f"{name}: {best_time(parse) * 1e6:.0f} us, "
+            f"peak {peak_memory(parse) / len(body):.1f}x the body ({len(body)} bytes)"
+        )
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Usage: python -m benchmarks.bench_concurrency URL [CONCURRENCY] [REQUESTS]
+#
+# Sends signed vendor matching requests to a running webhook from CONCURRENCY
+# clients at once and reports the throughput and latency percentiles. Compare
+# the Flask and the ASGI server, both serving the database configured by DB_*:
+#
+#   gunicorn -w 4 --threads 8 -b :5000 "fuzzy_vendor_matching_webhook_python:create_app()"
+#   uvicorn --workers 4 --port 5001 fuzzy_vendor_matching_webhook_python.asgi:app
+#
+# SECRET_KEY must be the same for the servers and this script.
+
+import hashlib
+import hmac
+import http.client
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle, islice
+from urllib.parse import urlsplit
+
+from fuzzy_vendor_matching_webhook_python import config
+
+NAMES = ["Bernhard", "Bosco", "Roodel", "Schumm", "Kiehn", "Gmbh", "Group", "Inc"]
+
+
+def request_bodies(count: int):
+    for index, name in enumerate(islice(cycle(NAMES), count)):
+        # distinct names keep the match cache from answering
+        annotation_tree = [
+            {"id": "1", "schema_id": "sender_name", "content": {"value": f"{name} {index}"}},
+            {"id": "2", "schema_id": "sender_address", "content": {"value": ""}},
+            {"id": "3", "schema_id": "vendor_vat_id", "content": {"value": ""}},
+            {"id": "4", "schema_id": "vendor_match", "content": {"value": ""}},
+        ]
+        yield json.dumps(
+            {
+                "action": "initialize",
+                "updated_datapoints": [],
+                "annotation": {"content": annotation_tree},
+            }
+        ).encode()
+
+
+def send(url, bodies):
+    """Send the requests over one keep-alive connection, return their latencies."""
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port)
+    latencies = []
+    for body in bodies:
+        signature = hmac.new(config.SECRET_KEY.encode(), body, hashlib.sha1).hexdigest()
+        headers = {"Content-Type": "application/json", "X-Elis-Signature": f"sha1={signature}"}
+        start = time.perf_counter()
+        connection.request("POST", parts.path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            raise RuntimeError(f"Unexpected status {response.status}")
+    connection.close()
+    return latencies
+
+
+def percentile(values, fraction: float) -> float:
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    url = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+
+    bodies = list(request_bodies(requests))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = executor.map(
+            send, [url] * concurrency, [bodies[i::concurrency] for i in range(concurrency)]
+        )
+        latencies = sorted(latency for result in results for latency in result)
+    elapsed = time.perf_counter() - start
+
+    print(f"{url}: {concurrency} clients, {requests / elapsed:.0f} requests/s")
+    for fraction in (0.5, 0.95, 0.99):
+        print(f"  p{fraction * 100:.0f}: {percentile(latencies, fraction) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
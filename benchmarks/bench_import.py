@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+#
+# Usage: python -m benchmarks.bench_import [ROWS]
+#
+# Compares the rows/sec of the row by row INSERT import and the COPY bulk import
+# into the database configured by the DB_* environment variables.
+
+import sys
+import tempfile
+import time
+
+from benchmarks.vendors import write_vendors
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import db_import, db_drop_vendor_data
+
+
+def bench(filename: str, rows: int, bulk: bool) -> float:
+    start = time.perf_counter()
+    db_import(filename, bulk=bulk)
+    elapsed = time.perf_counter() - start
+    db_drop_vendor_data()
+    return rows / elapsed
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.NamedTemporaryFile(suffix=".csv") as vendor_file:
+        write_vendors(vendor_file.name, rows)
+        for name, bulk in [("insert", False), ("copy", True)]:
+            print(f"{name}: {bench(vendor_file.name, rows, bulk):.0f} rows/s ({rows} rows)")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# Usage: python -m benchmarks.bench_prepared [ROWS] [CALLS]
+#
+# Compares the per-call latency of matching vendors with one query text for all
+# inputs, sent and planned on every call, and with the prepared statement of the
+# present inputs, in the database configured by the DB_* environment variables.
+# Both find the same vendors for the inputs of a generated vendor, which is checked
+# before timing them.
+
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.suite import extracted_inputs
+from benchmarks.vendors import write_vendors
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import (
+    db,
+    db_import,
+    db_drop_vendor_data,
+    NAME_SEARCH_EXPRESSION,
+    ADDRESS_SEARCH_EXPRESSION,
+    VAT_ID_SEARCH_EXPRESSION,
+    LABEL_EXPRESSION,
+)
+from fuzzy_vendor_matching_webhook_python import config
+from fuzzy_vendor_matching_webhook_python.matching import (
+    ID_ORDER,
+    SqlVendorMatcher,
+    THRESHOLD_SETTING,
+)
+from fuzzy_vendor_matching_webhook_python.normalize import normalize_lookup
+
+# the VAT ID lookup deciding a unique hit, as one query text
+VAT_ID_TEXT_QUERY = f"""
+    SELECT taxid1, {LABEL_EXPRESSION} AS vendor FROM vendor_data
+        WHERE {VAT_ID_SEARCH_EXPRESSION} = %(vat_id)s LIMIT 2
+    """
+
+# the fuzzy search guarding the conditions and distances of empty inputs, ranked like
+# matching.match_vendor_query
+TEXT_QUERY = f"""
+    SELECT taxid1, {LABEL_EXPRESSION} AS vendor FROM vendor_data
+        WHERE (%(vat_id)s = ''
+                OR ({VAT_ID_SEARCH_EXPRESSION} IS NULL OR {VAT_ID_SEARCH_EXPRESSION} = %(vat_id)s))
+            AND (%(name)s = '' OR {NAME_SEARCH_EXPRESSION} %% %(name)s)
+            AND (%(address)s = '' OR {ADDRESS_SEARCH_EXPRESSION} %% %(address)s)
+            AND (SELECT set_config('{THRESHOLD_SETTING}', %(threshold)s::float8::text, true))
+                IS NOT NULL
+        ORDER BY CASE WHEN %(name)s = '' THEN 0 ELSE {NAME_SEARCH_EXPRESSION} <-> %(name)s END
+            + CASE WHEN %(address)s = '' THEN 0
+                ELSE {ADDRESS_SEARCH_EXPRESSION} <-> %(address)s END
+            + CASE WHEN %(vat_id)s = '' THEN 0
+                ELSE ({VAT_ID_SEARCH_EXPRESSION} IS DISTINCT FROM %(vat_id)s)::int::real END,
+            {ID_ORDER}
+        LIMIT %(limit)s
+    """
+
+# the inputs of each benchmarked combination, taken from a generated vendor
+COMBINATIONS = [("vat_id",), ("name",), ("address",), ("name", "address")]
+
+
+def benchmark_inputs(rows: int):
+    """The inputs of each combination, extracted from a vendor having a VAT ID."""
+    vendor = next(inputs for inputs in extracted_inputs(rows, 100, 0) if inputs["vat_id"])
+    return [
+        tuple(vendor[key] if key in combination else "" for key in ("vat_id", "name", "address"))
+        for combination in COMBINATIONS
+    ]
+
+
+def text_query(vat_id, name, address):
+    vat_id, name, address = normalize_lookup(vat_id, name, address)
+    if vat_id:
+        hits = db.execute_and_fetchall(VAT_ID_TEXT_QUERY, {"vat_id": vat_id})
+        if len(hits) == 1:
+            return hits
+    return db.execute_and_fetchall(
+        TEXT_QUERY,
+        {
+            "vat_id": vat_id,
+            "name": name,
+            "address": address,
+            "limit": 20,
+            "threshold": config.SIMILARITY_THRESHOLD,
+        },
+    )
+
+
+def prepared(vat_id, name, address, matcher=SqlVendorMatcher()):
+    return matcher.match(*normalize_lookup(vat_id, name, address), 20)
+
+
+def latencies(match, inputs, calls: int):
+    result = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        match(*inputs)
+        result.append(time.perf_counter() - start)
+    return sorted(result)
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.NamedTemporaryFile(suffix=".csv") as vendor_file:
+        write_vendors(vendor_file.name, rows)
+        db_import(vendor_file.name)
+    try:
+        for inputs in benchmark_inputs(rows):
+            assert text_query(*inputs) == prepared(*inputs), inputs
+            for name, match in [("text", text_query), ("prepared", prepared)]:
+                times = latencies(match, inputs, calls)
+                print(
+                    f"{name:>8} {inputs}: median {statistics.median(times) * 1000:.2f} ms, "
+                    f"p99 {times[int(len(times) * 0.99)] * 1000:.2f} ms"
+                )
+    finally:
+        db_drop_vendor_data()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#
+# Usage: python -m benchmarks.suite [--sizes ROWS ...] [--queries N] [--output FILE]
+#
+# Benchmarks the vendor import, match_vendor with each combination of inputs and
+# whole /vendor_matching requests on synthetic vendor masters of each size, in the
+# database configured by the DB_* environment variables. The results are written
+# as JSON, one record per benchmark and size, to be compared across commits.
+
+import argparse
+import hashlib
+import hmac
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from benchmarks.vendors import generate_vendors, write_vendors
+from fuzzy_vendor_matching_webhook_python import config, create_app
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import (
+    db,
+    db_import,
+    db_drop_vendor_data,
+)
+from fuzzy_vendor_matching_webhook_python.matching import reset_matcher
+from fuzzy_vendor_matching_webhook_python.normalize import fold, LEGAL_FORMS
+from fuzzy_vendor_matching_webhook_python.webhook import match_vendor
+
+# inputs extracted from the documents of each benchmarked combination
+INPUT_COMBINATIONS = {
+    "vat_id": ("vat_id",),
+    "name": ("name",),
+    "address": ("address",),
+    "name_address": ("name", "address"),
+    "all": ("vat_id", "name", "address"),
+}
+
+
+def without_legal_form(name: str) -> str:
+    """The name without the longest legal form of normalize.LEGAL_FORMS it ends with,
+    e.g. "Müller GmbH & Co. KG" -> "Müller"."""
+    words = name.split()
+    for start in range(1, len(words)):
+        if tuple(fold(" ".join(words[start:])).split()) in LEGAL_FORMS:
+            return " ".join(words[:start])
+    return name
+
+
+def extracted_inputs(rows: int, count: int, seed: int) -> List[Dict[str, str]]:
+    """Inputs as extracted from the documents of `count` random vendors: the name
+    without the legal form and in other case, the address on one line."""
+    picked = set(random.Random(seed).sample(range(rows), min(count, rows)))
+    inputs = []
+    for vendor in generate_vendors(rows, seed):
+        if int(vendor["VendorID"]) in picked:
+            inputs.append(
+                {
+                    "vat_id": vendor["TaxID1"],
+                    "name": without_legal_form(vendor["VendorName"]).upper(),
+                    "address": f"{vendor['Address1']}, {vendor['ZipCode']} {vendor['City']}",
+                }
+            )
+    return inputs
+
+
+def annotation_tree(inputs: Dict[str, str], combination) -> List[Dict]:
+    def value(key):
+        return inputs[key] if key in combination else ""
+
+    return [
+        {"id": "1", "schema_id": "sender_name", "content": {"value": value("name")}},
+        {"id": "2", "schema_id": "sender_address", "content": {"value": value("address")}},
+        {"id": "3", "schema_id": "vendor_vat_id", "content": {"value": value("vat_id")}},
+        {"id": "4", "schema_id": "vendor_match", "content": {"value": ""}},
+    ]
+
+
+def latency_stats(call: Callable, arguments: List) -> Dict:
+    """Call once per argument and return the latency percentiles in milliseconds."""
+    times = []
+    for argument in arguments:
+        start = time.perf_counter()
+        call(argument)
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    def percentile(fraction):
+        return round(times[min(int(len(times) * fraction), len(times) - 1)] * 1000, 3)
+
+    return {
+        "calls": len(times),
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "calls_per_second": round(len(times) / sum(times), 1),
+    }
+
+
+def bench_import(rows: int, seed: int) -> Dict:
+    with tempfile.NamedTemporaryFile(suffix=".csv") as vendor_file:
+        write_vendors(vendor_file.name, rows, seed)
+        start = time.perf_counter()
+        db_import(vendor_file.name)
+        elapsed = time.perf_counter() - start
+    return {"seconds": round(elapsed, 3), "rows_per_second": round(rows / elapsed, 1)}
+
+
+def bench_match(inputs: List[Dict], combination) -> Dict:
+    trees = [annotation_tree(vendor, combination) for vendor in inputs]
+    return latency_stats(lambda tree: match_vendor(tree, [], "initialize"), trees)
+
+
+def bench_requests(inputs: List[Dict]) -> Dict:
+    client = create_app().test_client()
+    bodies = []
+    for vendor in inputs:
+        body = json.dumps(
+            {
+                "action": "initialize",
+                "updated_datapoints": [],
+                "annotation": {"content": annotation_tree(vendor, INPUT_COMBINATIONS["all"])},
+            }
+        ).encode()
+        signature = hmac.new(config.SECRET_KEY.encode(), body, hashlib.sha1).hexdigest()
+        bodies.append((body, f"sha1={signature}"))
+
+    def post(request):
+        body, signature = request
+        response = client.post(
+            "/vendor_matching",
+            data=body,
+            headers={"Content-Type": "application/json", "X-Elis-Signature": signature},
+        )
+        assert response.status_code == 200, response.status_code
+
+    return latency_stats(post, bodies)
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    (postgres,) = db.execute_and_fetch("SELECT version()")
+    db.rollback()
+    return {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "postgres": postgres,
+        "vendor_matcher": config.VENDOR_MATCHER,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vendor matching pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--queries", type=int, default=200, help="lookups per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout)
+    args = parser.parse_args()
+
+    # measure the lookups, not the cache
+    config.MATCH_CACHE_SIZE = 0
+    results = []
+    for rows in args.sizes:
+        results.append({"benchmark": "import", "rows": rows, **bench_import(rows, args.seed)})
+        reset_matcher()
+        try:
+            inputs = extracted_inputs(rows, args.queries, args.seed)
+            for combination_name, combination in INPUT_COMBINATIONS.items():
+                stats = bench_match(inputs, combination)
+                results.append(
+                    {"benchmark": "match", "inputs": combination_name, "rows": rows, **stats}
+                )
+            results.append({"benchmark": "request", "rows": rows, **bench_requests(inputs)})
+        finally:
+            db.release()
+            db_drop_vendor_data()
+        print(f"{rows} rows done", file=sys.stderr)
+
+    json.dump({"environment": environment(), "results": results}, args.output, indent=2)
+    args.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
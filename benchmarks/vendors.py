@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Synthetic vendor masters of German companies, reproducible from a seed."""
+import csv
+import random
+from typing import Dict, Iterator
+
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import CSV_FIELDS
+
+# fmt: off
+SURNAMES = [
+    "Müller", "Schmidt", "Schneider", "Fischer", "Weber", "Meyer", "Wagner", "Becker",
+    "Schulz", "Hoffmann", "Schäfer", "Koch", "Bauer", "Richter", "Klein", "Wolf",
+    "Schröder", "Neumann", "Schwarz", "Zimmermann", "Braun", "Krüger", "Hofmann", "Hartmann",
+    "Lange", "Schmitt", "Werner", "Schmitz", "Krause", "Meier", "Lehmann", "Schmid",
+    "Schulze", "Maier", "Köhler", "Herrmann", "König", "Walter", "Mayer", "Huber",
+    "Kaiser", "Fuchs", "Peters", "Lang", "Scholz", "Möller", "Weiß", "Jung",
+    "Hahn", "Vogel", "Friedrich", "Keller", "Günther", "Frank", "Berger", "Winkler",
+    "Roth", "Beck", "Lorenz", "Baumann", "Franke", "Albrecht", "Schuster", "Simon",
+]
+
+TRADES = [
+    "Bau", "Elektro", "Metallbau", "Logistik", "Spedition", "Druckerei", "Holzbau",
+    "Sanitär", "Haustechnik", "Maschinenbau", "Software", "Consulting", "Handel",
+    "Autohaus", "Bäckerei", "Gebäudereinigung", "Steuerberatung", "Kunststofftechnik",
+    "Verpackung", "Medizintechnik", "Immobilien", "Landtechnik", "Feinmechanik", "Optik",
+]
+
+LEGAL_FORMS = [
+    "GmbH", "GmbH", "GmbH", "AG", "KG", "GmbH & Co. KG", "GmbH & Co. KG", "e.K.", "OHG",
+    "UG (haftungsbeschränkt)", "mbH", "SE",
+]
+
+STREETS = [
+    "Hauptstraße", "Bahnhofstraße", "Schulstraße", "Gartenstraße", "Dorfstraße",
+    "Bergstraße", "Lindenstraße", "Kirchstraße", "Waldstraße", "Ringstraße",
+    "Friedrichstr.", "Goethestr.", "Schillerstr.", "Industriestraße", "Am Markt",
+    "Mühlenweg", "Rosenweg", "Birkenallee", "Königsallee", "Eichendorffstr.",
+    "Brandenburgische Straße", "Flotowstr.", "Kurfürstendamm", "Leipziger Platz",
+]
+
+CITIES = [
+    ("Berlin", "Berlin", "10"), ("Hamburg", "Hamburg", "20"), ("München", "Bayern", "80"),
+    ("Köln", "Nordrhein-Westfalen", "50"), ("Frankfurt am Main", "Hessen", "60"),
+    ("Stuttgart", "Baden-Württemberg", "70"), ("Düsseldorf", "Nordrhein-Westfalen", "40"),
+    ("Leipzig", "Sachsen", "04"), ("Dortmund", "Nordrhein-Westfalen", "44"),
+    ("Essen", "Nordrhein-Westfalen", "45"), ("Bremen", "Bremen", "28"),
+    ("Dresden", "Sachsen", "01"), ("Hannover", "Niedersachsen", "30"),
+    ("Nürnberg", "Bayern", "90"), ("Würzburg", "Bayern", "97"),
+    ("Lübeck", "Schleswig-Holstein", "23"), ("Göttingen", "Niedersachsen", "37"),
+    ("Saarbrücken", "Saarland", "66"), ("Mönchengladbach", "Nordrhein-Westfalen", "41"),
+    ("Fürth", "Bayern", "90"),
+]
+INDUSTRY_SECTORS = ["Retail trade", "Manufacturing", "Construction", "Services", "Transport"]
+# fmt: on
+
+
+def generate_vendors(rows: int, seed: int = 0) -> Iterator[Dict[str, str]]:
+    """Yield `rows` active vendors with company names, addresses and VAT IDs of
+    German companies. About one in ten vendors has no VAT ID."""
+    rng = random.Random(seed)
+    for vendor_id in range(rows):
+        owners = rng.sample(SURNAMES, rng.choice((1, 1, 1, 2)))
+        name = " & ".join(owners)
+        if rng.random() < 0.6:
+            name = f"{name} {rng.choice(TRADES)}"
+        city, state, zip_prefix = rng.choice(CITIES)
+        yield {
+            "VendorID": str(vendor_id),
+            "VendorName": f"{name} {rng.choice(LEGAL_FORMS)}",
+            "Address1": f"{rng.choice(STREETS)} {rng.randint(1, 200)}",
+            "Address2": "",
+            "Address3": "",
+            "City": city,
+            "State": state,
+            "ZipCode": f"{zip_prefix}{rng.randint(0, 999):03d}",
+            "Country": "DE",
+            "Telephone": f"0{rng.randint(30, 9999)} {rng.randint(100000, 9999999)}",
+            "VendorAccountGroup": "FF",
+            "IndustrySector": rng.choice(INDUSTRY_SECTORS),
+            "TaxID1": "" if rng.random() < 0.1 else f"DE{rng.randint(100000000, 999999999)}",
+            "ActiveVendor": "1",
+            "FileID": "345",
+        }
+
+
+def write_vendors(filename: str, rows: int, seed: int = 0):
+    """Write a vendor CSV file in the format of import_vendor_data."""
+    with open(filename, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.DictWriter(csvfile, CSV_FIELDS, delimiter=";")
+        writer.writeheader()
+        writer.writerows(generate_vendors(rows, seed))
@@ -1,13 +1,200 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import logging
+import random
 import threading
 import time
-from contextlib import closing
+from collections import deque
+from contextlib import closing, contextmanager
 import psycopg2
-from fuzzy_vendor_matching_webhook_python.config import get_database_config
+from psycopg2.extensions import (
+    QueryCanceledError,
+    TransactionRollbackError,
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_INTRANS,
+    TRANSACTION_STATUS_UNKNOWN,
+)
+from fuzzy_vendor_matching_webhook_python.config import (
+    get_database_config,
+    get_pool_config,
+    get_retry_config,
+)
+from fuzzy_vendor_matching_webhook_python.metrics import (
+    DB_RETRIES,
+    DB_CIRCUIT_BREAKER_STATE,
+    SQL_SECONDS,
+)
 
-__threadLocal = threading.local()
+
+class PoolTimeout(Exception):
+    """No connection got free within the checkout timeout."""
+
+
+class DeadlineExceeded(Exception):
+    """The deadline of the queries ran out before a query started, see Database.deadline."""
+
+
+class DatabaseUnavailable(Exception):
+    """The database could not be reached within the retry budget, or the circuit
+    breaker is open and queries fail fast without trying."""
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Connection remembering the names of the statements prepared in its session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class CircuitBreaker:
+    """Stop calling a failing database until `reset_timeout` passes.
+
+    After `failure_threshold` consecutive failures the breaker opens. Once the
+    timeout passes, a single trial call is let through (half open); its success
+    closes the breaker, its failure opens it again, and a trial given up without
+    either lets the next call try."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = None  # thread making the half-open trial call
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go to the database now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+                self._trial = threading.get_ident()
+                return True
+            return False
+
+    def release_trial(self):
+        """Give up the trial call of the current thread, if any, without an outcome."""
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._trial == threading.get_ident():
+                self._set_state(self.OPEN)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        self.state = state
+        DB_CIRCUIT_BREAKER_STATE.state(state)
+
+
+class ConnectionPool:
+    """Bounded thread-safe pool of database connections.
+
+    Idle connections are handed out most recently used first. A connection is
+    checked before it is handed out and replaced in case it turned out broken."""
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=5.0, health_check_interval=30.0):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = deque()  # (connection, time it was returned to the pool)
+        self._size = 0
+        self._cond = threading.Condition()
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def getconn(self):
+        """Check out a healthy connection, waiting up to `timeout` seconds for one."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            "No database connection available within %s s" % self.timeout
+                        )
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                else:
+                    conn, returned_at = None, None
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+            if self._is_healthy(conn, returned_at):
+                return conn
+            self._close(conn)
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, closing it when broken or `discard`ed."""
+        if not (discard or conn.closed):
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Close all idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            with closing(conn.cursor()) as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._forget()
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
 
 
 class Database:
@@ -15,80 +202,221 @@ class Database:
     password = None
     database = None
     hostname = None
-    _db_conn = None
+    port = None
+
+    """self-reconnecting database object
+
+    Connections come from a pool shared by all threads. A thread holds on to its
+    connection from the first query until release() is called, so that several
+    queries can form one transaction finished by commit() or rollback()."""
+
+    def __init__(self):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._local = threading.local()
+        retry_config = get_retry_config()
+        self.retry_attempts = retry_config["attempts"]
+        self.retry_backoff = retry_config["backoff"]
+        self.retry_backoff_cap = retry_config["backoff_cap"]
+        self.retry_deadline = retry_config["deadline"]
+        self.breaker = CircuitBreaker(
+            retry_config["breaker_failure_threshold"], retry_config["breaker_reset_timeout"]
+        )
 
-    """self-reconnecting database object"""
+    def _connect(self):
+        return psycopg2.connect(
+            dbname=self.database,
+            host=self.hostname,
+            port=self.port,
+            user=self.username,
+            password=self.password,
+            connection_factory=PreparingConnection,
+        )
+
+    @property
+    def pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                database_config = get_database_config()
+                self.username = database_config["username"]
+                self.password = database_config["password"]
+                self.database = database_config["database"]
+                self.hostname = database_config["hostname"]
+                self.port = database_config["port"]
+                self._pool = ConnectionPool(self._connect, **get_pool_config())
+            return self._pool
 
     @property
     def db_conn(self):
-        if self._db_conn:
-            return self._db_conn
+        """connection held by the current thread, checked out from the pool on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.pool.getconn()
+        return conn
 
-        database_config = get_database_config()
-        self.username = database_config["username"]
-        self.password = database_config["password"]
-        self.database = database_config["database"]
-        self.hostname = database_config["hostname"]
+    def release(self, discard=False):
+        """return the connection of the current thread to the pool, rolling back
+        anything not committed"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            self.pool.putconn(conn, discard=discard)
 
-        self._db_conn = psycopg2.connect(
-            dbname=self.database, host=self.hostname, user=self.username, password=self.password,
-        )
-        return self._db_conn
+    def close(self):
+        """release the connection of the current thread and close the pool, e.g. before
+        forking processes, which must not share connections; the next query opens a new pool"""
+        self.release()
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.closeall()
+
+    @contextmanager
+    def deadline(self, seconds):
+        """let the queries of the current thread within the block run until `seconds`
+        from now at most, none if 0: each query gets the time left as statement_timeout,
+        after which Postgres cancels it with QueryCanceledError, and once the time is up
+        no query starts but DeadlineExceeded is raised"""
+        previous = getattr(self._local, "deadline", None)
+        if seconds > 0:
+            deadline = time.monotonic() + seconds
+            self._local.deadline = deadline if previous is None else min(previous, deadline)
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    @contextmanager
+    def outside_deadline(self):
+        """let the queries of the current thread within the block run regardless of the
+        deadline of an enclosing deadline() block, e.g. to build state outliving a request"""
+        previous = getattr(self._local, "deadline", None)
+        self._local.deadline = None
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
 
     def execute(self, query, attrs=None):
         """execute a query and return one result"""
-        with closing(self.db_conn.cursor()) as cur:
-            cur = self._execute(cur, query, attrs)
+        with closing(self._execute(query, attrs)):
+            pass
 
     def execute_and_fetch(self, query, attrs=None):
         """execute a query and return one result"""
-        with closing(self.db_conn.cursor()) as cur:
-            cur = self._execute(cur, query, attrs)
+        with closing(self._execute(query, attrs)) as cur:
             return cur.fetchone()
 
     def execute_and_fetchall(self, query, attrs=None):
         """execute a query and return all results"""
-        with closing(self.db_conn.cursor()) as cur:
-            cur = self._execute(cur, query, attrs)
+        with closing(self._execute(query, attrs)) as cur:
+            return cur.fetchall()
+
+    def execute_prepared_and_fetchall(self, name, statement, attrs):
+        """execute a prepared statement and return all results. The statement is
+        prepared from its text on the first use on each connection; prepared
+        statements outlive transactions and stay with the connection in the pool"""
+        query = "EXECUTE %s(%s)" % (name, ", ".join(["%s"] * len(attrs)))
+        with closing(self._execute(query, attrs, prepare=(name, statement))) as cur:
             return cur.fetchall()
 
-    def _execute(self, cur, query, attrs, level=1):
-        """execute a query, and in case of OperationalError (db restart)
-        reconnect to database. Recursion with increasing pause between tries"""
+    def copy_expert(self, query, file):
+        """feed a file-like object to a COPY ... FROM STDIN query"""
+        with closing(self.db_conn.cursor()) as cur:
+            cur.copy_expert(query, file)
+
+    def _execute(self, query, attrs, prepare=None):
+        """execute a query and return its cursor. In case of a dropped connection
+        (db restart) reconnect and retry with a jittered, exponentially growing
+        pause, as long as the retry budget and deadline allow. Queries started
+        inside an open transaction are not retried, as its earlier statements
+        would be lost with the connection. `prepare` is a (name, statement) pair
+        to prepare on the connection before the query unless done already."""
+        request_deadline = getattr(self._local, "deadline", None)
+        if request_deadline is not None and request_deadline <= time.monotonic():
+            raise DeadlineExceeded("Deadline exceeded before the query")
+        if not self.breaker.allow():
+            raise DatabaseUnavailable("Database circuit breaker is open")
         try:
-            if attrs is None:
-                cur.execute(query)
-            else:
-                cur.execute(query, attrs)
-            return cur
-        except psycopg2.DataError as error:  # when biitr comes and enters '99999999999999999999' for amount
-            logging.exception(
-                "We have invalid input data (SQLi?): level %s (%s) @%s"
-                % (level, error, time.strftime("%Y%m%d %a %I:%m %p"))
-            )
-            self.db_conn.rollback()
-            raise RuntimeError("Non-sanitized data entered again... BOBBY TABLES")
-        except psycopg2.IntegrityError:
-            # This is not an error that deserves to be treated
-            # as dropped connection.
+            return self._execute_with_retries(query, attrs, prepare, request_deadline)
+        finally:
+            # a query leaving without success or failure recorded gives the trial up
+            self.breaker.release_trial()
 
+    def _checkout(self):
+        """connection of the current thread, DatabaseUnavailable when the pool has
+        none to give, e.g. on PoolTimeout; psycopg2 errors are left to the retries"""
+        try:
+            return self.db_conn
+        except psycopg2.Error:
             raise
         except Exception as error:
-            logging.exception(
-                "Sleeping: level %s (%s) @%s" % (level, error, time.strftime("%Y%m%d %a %I:%m %p"))
-            )
-            time.sleep(min(2 ** level, 30))
+            raise DatabaseUnavailable("No database connection: %s" % error) from error
+
+    def _execute_with_retries(self, query, attrs, prepare, request_deadline):
+        deadline = time.monotonic() + self.retry_deadline
+        if request_deadline is not None:
+            deadline = min(deadline, request_deadline)
+        attempt = 1
+        while True:
+            in_transaction = False
+            statement = query
+            if request_deadline is not None:
+                timeout = int((request_deadline - time.monotonic()) * 1000)
+                if timeout <= 0:
+                    raise DeadlineExceeded("Deadline exceeded before the query")
+                statement = "SET LOCAL statement_timeout = %d; %s" % (timeout, query)
             try:
-                self.db_conn = psycopg2.connect(
-                    dbname=self.database,
-                    host=self.hostname,
-                    user=self.username,
-                    password=self.password,
+                conn = self._checkout()
+                in_transaction = conn.get_transaction_status() == TRANSACTION_STATUS_INTRANS
+                cur = conn.cursor()
+                if prepare is not None and prepare[0] not in conn.prepared:
+                    cur.execute("PREPARE %s AS %s" % prepare)
+                    conn.prepared.add(prepare[0])
+                with SQL_SECONDS.time():
+                    if attrs is None:
+                        cur.execute(statement)
+                    else:
+                        cur.execute(statement, attrs)
+                self.breaker.record_success()
+                return cur
+            except psycopg2.DataError as error:  # when biitr comes and enters '99999999999999999999' for amount
+                self.breaker.record_success()
+                logging.exception(
+                    "We have invalid input data (SQLi?): attempt %s (%s) @%s"
+                    % (attempt, error, time.strftime("%Y%m%d %a %I:%m %p"))
+                )
+                self.db_conn.rollback()
+                raise RuntimeError("Non-sanitized data entered again... BOBBY TABLES")
+            except (QueryCanceledError, TransactionRollbackError):
+                self.breaker.record_success()
+                raise
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+                self.breaker.record_failure()
+                # the connection may be broken, replace it with a fresh one from the pool
+                self.release(discard=True)
+                pause = random.uniform(
+                    0, min(self.retry_backoff * 2 ** attempt, self.retry_backoff_cap)
+                )
+                if (
+                    in_transaction
+                    or attempt >= self.retry_attempts
+                    or time.monotonic() + pause > deadline
+                    or not self.breaker.allow()
+                ):
+                    raise DatabaseUnavailable("Database query failed: %s" % error) from error
+                logging.warning(
+                    "Retrying in %.2f s: attempt %s (%s) @%s"
+                    % (pause, attempt, error, time.strftime("%Y%m%d %a %I:%m %p"))
                 )
-            except:
-                time.sleep(1)
-            cur = self.db_conn.cursor()
-            return self._execute(cur, query, attrs, level + 1)
+                DB_RETRIES.inc()
+                time.sleep(pause)
+                attempt += 1
+            except psycopg2.Error:
+                # This is not an error that deserves to be treated
+                # as dropped connection, the database did answer.
+                self.breaker.record_success()
+                raise
 
     def commit(self):
         """pass commit to db"""
@@ -1,5 +1,26 @@
 import flask
-from fuzzy_vendor_matching_webhook_python.webhook import vendor_matching
+from prometheus_client import CONTENT_TYPE_LATEST
+from werkzeug.exceptions import ServiceUnavailable
+
+from database.database import DatabaseUnavailable
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import db
+from fuzzy_vendor_matching_webhook_python.metrics import latest_metrics
+from fuzzy_vendor_matching_webhook_python.webhook import vendor_matching, vendor_matching_batch
+
+
+def release_database_connection(exception=None):
+    """Hand the database connection of the request back to the pool."""
+    db.release()
+
+
+def database_unavailable(error):
+    """Fail fast with 503 while the database is down, instead of holding the request."""
+    return ServiceUnavailable(str(error))
+
+
+def metrics():
+    """Expose the metrics to Prometheus."""
+    return flask.Response(latest_metrics(), mimetype=CONTENT_TYPE_LATEST)
 
 
 def create_app():
@@ -7,4 +28,8 @@ def create_app():
     app.config.from_object(flask.config)
     # app.config["DEBUG"] = True
     app.route("/vendor_matching", methods=["POST"])(vendor_matching)
+    app.route("/vendor_matching/batch", methods=["POST"])(vendor_matching_batch)
+    app.route("/metrics")(metrics)
+    app.teardown_appcontext(release_database_connection)
+    app.register_error_handler(DatabaseUnavailable, database_unavailable)
     return app
@@ -1,3 +1,11 @@
 from fuzzy_vendor_matching_webhook_python import create_app
 
 app = create_app()
+
+
+def entry_point():
+    """Serve the webhook from pre-forked worker processes, see prefork.main."""
+    # gunicorn is only needed by this entry point
+    from fuzzy_vendor_matching_webhook_python.prefork import main
+
+    main()
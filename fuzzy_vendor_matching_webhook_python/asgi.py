@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""The vendor matching webhook as an ASGI application, querying the database with asyncpg.
+
+Run it with an ASGI server, e.g.
+
+    uvicorn fuzzy_vendor_matching_webhook_python.asgi:app
+
+A request waiting for the database does not occupy a worker, the event loop
+serves other requests meanwhile."""
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+import asyncpg
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from database.database import DatabaseUnavailable, DeadlineExceeded
+from fuzzy_vendor_matching_webhook_python import config
+from fuzzy_vendor_matching_webhook_python.cache import LRUCache, MISSING
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import db
+from fuzzy_vendor_matching_webhook_python.matching import (
+    ALL_VENDORS,
+    enough_candidates,
+    get_matcher,
+    MatchDeadlineExceeded,
+    match_vendor_statement,
+    threshold_tiers,
+    unique_vat_id_hit,
+    vat_id_statement,
+    VendorScope,
+)
+from fuzzy_vendor_matching_webhook_python.metrics import (
+    latest_metrics,
+    MATCH_SECONDS,
+    SERIALIZE_SECONDS,
+    SIMILARITY_THRESHOLD_TIERS,
+    SIGNATURE_SECONDS,
+    SQL_SECONDS,
+)
+from fuzzy_vendor_matching_webhook_python.serialization import dumps
+from fuzzy_vendor_matching_webhook_python.webhook import (
+    body_hmac,
+    check_signature,
+    deadline_operations,
+    parse_json,
+    vendor_lookup,
+    vendor_operations,
+    vendor_scope,
+)
+
+# errors meaning the database cannot serve the request now
+DATABASE_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    DatabaseUnavailable,
+)
+
+VENDOR_DATA_VERSION_QUERY = "SELECT version FROM vendor_data_version;"
+
+
+class AsyncSqlVendorMatcher:
+    """Matches vendors like the "sql" backend does, exact VAT ID lookup first, over an
+    asyncpg connection pool and behind the same kind of cache. asyncpg prepares the
+    statements of each connection on first use by itself.
+
+    As with CachedVendorMatcher, lookups served from the cache query no VAT ID and are
+    not counted in VAT_ID_LOOKUPS."""
+
+    def __init__(self):
+        self.pool = None
+        self.cache = None
+        if config.MATCH_CACHE_SIZE > 0:
+            self.cache = LRUCache(config.MATCH_CACHE_SIZE, config.MATCH_CACHE_TTL)
+        self._pool_lock = None
+        self._vendor_data_version = None
+        self._vendor_data_checked_at = float("-inf")
+
+    async def connect(self):
+        """Create the connection pool unless already created."""
+        if self._pool_lock is None:
+            self._pool_lock = asyncio.Lock()
+        async with self._pool_lock:
+            if self.pool is None:
+                database_config = config.get_database_config()
+                pool_config = config.get_pool_config()
+                self.pool = await asyncpg.create_pool(
+                    database=database_config["database"],
+                    host=database_config["hostname"],
+                    port=int(database_config["port"]),
+                    user=database_config["username"],
+                    password=database_config["password"],
+                    min_size=pool_config["min_size"],
+                    max_size=pool_config["max_size"],
+                )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def match(
+        self,
+        vat_id: str,
+        name: str,
+        address: str,
+        limit: int,
+        scope: VendorScope = ALL_VENDORS,
+        deadline: Optional[float] = None,
+    ):
+        """Return at most `limit` (VAT ID, label) pairs of vendors within the scope
+        matching the normalized inputs, best match first. Queries still running at the
+        `deadline`, in terms of time.monotonic(), are cancelled and raise
+        MatchDeadlineExceeded."""
+        await self.connect()
+        key = (vat_id, name, address, limit, scope)
+        if self.cache is not None:
+            try:
+                await self._check_vendor_data_version(deadline)
+            except (asyncio.TimeoutError, DeadlineExceeded) as error:
+                raise MatchDeadlineExceeded([]) from error
+            results = self.cache.get(key)
+            if results is not MISSING:
+                return results
+
+        inputs = [value for value in (vat_id, name, address) if value]
+        if not inputs:
+            return []
+        scoped = [value for value in scope if value]
+        vat_id_hits = []
+        async with self.pool.acquire(timeout=config.get_pool_config()["timeout"]) as conn:
+            try:
+                rows = None
+                if vat_id:
+                    with SQL_SECONDS.time():
+                        _, statement = vat_id_statement(*map(bool, scope))
+                        rows = await conn.fetch(
+                            statement, vat_id, *scoped, timeout=time_left(deadline)
+                        )
+                    vat_id_hits = [tuple(row) for row in rows]
+                    if not unique_vat_id_hit(len(rows)):
+                        rows = None
+                if rows is None:
+                    present = (bool(vat_id), bool(name), bool(address), *map(bool, scope))
+                    rows = await self._match_adaptively(
+                        conn, present, [*inputs, *scoped, limit], name, address, limit, deadline
+                    )
+            except (asyncio.TimeoutError, DeadlineExceeded) as error:
+                raise MatchDeadlineExceeded(vat_id_hits) from error
+        results = [tuple(row) for row in rows]
+        if self.cache is not None:
+            self.cache.put(key, results)
+        return results
+
+    @staticmethod
+    async def _match_adaptively(
+        conn, present, parameters, name, address, limit: int, deadline: Optional[float]
+    ):
+        """Run the fuzzy statement for the `present` inputs like matching.match_adaptively
+        does, each threshold tier in one round trip."""
+        _, statement = match_vendor_statement(*present)
+        tiers = threshold_tiers(name, address)
+        for threshold in tiers or [config.SIMILARITY_THRESHOLD]:
+            with SQL_SECONDS.time():
+                rows = await conn.fetch(
+                    statement, *parameters, threshold, timeout=time_left(deadline)
+                )
+            if enough_candidates(rows, limit):
+                break
+        if tiers:
+            SIMILARITY_THRESHOLD_TIERS.labels(str(threshold)).inc()
+        return rows
+
+    async def _check_vendor_data_version(self, deadline: Optional[float] = None):
+        """Drop the cache when an import changed the vendor table, see get_matcher. The
+        check is cancelled at the `deadline` like the lookup."""
+        now = time.monotonic()
+        if now - self._vendor_data_checked_at < config.VENDOR_DATA_CHECK_INTERVAL:
+            return
+        self._vendor_data_checked_at = now
+        try:
+            version = await self.pool.fetchval(
+                VENDOR_DATA_VERSION_QUERY, timeout=time_left(deadline)
+            )
+        except asyncpg.UndefinedTableError:
+            version = 0
+        if version != self._vendor_data_version:
+            self.cache.clear()
+            self._vendor_data_version = version
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Seconds left until a deadline in terms of time.monotonic(), as the timeout of a
+    query, which asyncpg cancels once it runs out. None without a deadline."""
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded before the query")
+    return left
+
+
+matcher = AsyncSqlVendorMatcher()
+
+
+def match_in_thread(vat_id: str, name: str, address: str, limit: int, scope: VendorScope):
+    """Match vendors with a synchronous backend, returning the database connection after."""
+    try:
+        return get_matcher().match(vat_id, name, address, limit, scope)
+    finally:
+        db.release()
+
+
+async def match_vendor(
+    annotation_tree: List[dict],
+    updated_datapoints: List[int],
+    action: str,
+    scope: VendorScope = ALL_VENDORS,
+    deadline: Optional[float] = None,
+):
+    """Vendor matching as in webhook.match_vendor, without blocking the event loop.
+
+    The "sql" backend is queried asynchronously until the `deadline`, other backends
+    run in a thread."""
+    lookup = vendor_lookup(annotation_tree, updated_datapoints, action)
+    if lookup is None:
+        return [], []
+    if not (lookup.vat_id or lookup.name or lookup.address):
+        return vendor_operations(lookup.vendor, [])
+    with MATCH_SECONDS.time():
+        if config.VENDOR_MATCHER == "sql":
+            try:
+                results = await matcher.match(
+                    lookup.vat_id,
+                    lookup.name,
+                    lookup.address,
+                    config.MAX_VENDOR_OPTIONS,
+                    scope,
+                    deadline,
+                )
+            except MatchDeadlineExceeded as error:
+                return deadline_operations(lookup.vendor, error.results)
+        else:
+            results = await asyncio.get_running_loop().run_in_executor(
+                None,
+                match_in_thread,
+                lookup.vat_id,
+                lookup.name,
+                lookup.address,
+                config.MAX_VENDOR_OPTIONS,
+                scope,
+            )
+    return vendor_operations(lookup.vendor, results)
+
+
+async def respond(send, status: int, payload: Optional[Dict] = None):
+    with SERIALIZE_SECONDS.time():
+        body = dumps(payload) if payload is not None else b""
+    await send_response(send, status, body, b"application/json")
+
+
+async def send_response(send, status: int, body: bytes, content_type: bytes):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type)],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def read_signed_body(receive):
+    """Read the request body, hashing each chunk as it arrives, see webhook.read_signed_body."""
+    body = bytearray()
+    body_mac = body_hmac()
+    hashing = 0.0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        body += chunk
+        start = time.perf_counter()
+        body_mac.update(chunk)
+        hashing += time.perf_counter() - start
+        if not message.get("more_body"):
+            SIGNATURE_SECONDS.observe(hashing)
+            return body, body_mac
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await matcher.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point serving POST /vendor_matching, within REQUEST_DEADLINE, and the
+    metrics on GET /metrics."""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        await send_response(send, 200, latest_metrics(), CONTENT_TYPE_LATEST.encode())
+        return
+    if scope["path"] != "/vendor_matching":
+        await respond(send, 404, {"error": "Not found."})
+        return
+    if scope["method"] != "POST":
+        await respond(send, 405, {"error": "Method not allowed."})
+        return
+    deadline = time.monotonic() + config.REQUEST_DEADLINE if config.REQUEST_DEADLINE > 0 else None
+
+    body, body_mac = await read_signed_body(receive)
+    headers = dict(scope["headers"])
+    error = check_signature(body_mac, headers.get(b"x-elis-signature", b"").decode("latin-1"))
+    if error:
+        await respond(send, 401, {"error": error})
+        return
+    try:
+        payload = parse_json(body)
+        annotation_tree = payload["annotation"]["content"]
+        updated_datapoints = payload["updated_datapoints"]
+        action = payload["action"]
+        lookup_scope = vendor_scope(payload.get("settings"))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        await respond(send, 400, {"error": "Invalid webhook payload."})
+        return
+
+    try:
+        messages, operations = await match_vendor(
+            annotation_tree, updated_datapoints, action, lookup_scope, deadline
+        )
+    except DATABASE_ERRORS:
+        await respond(send, 503, {"error": "Database unavailable."})
+        return
+    await respond(send, 200, {"messages": messages, "operations": operations})
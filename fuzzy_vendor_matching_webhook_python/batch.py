@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Matching the vendors of many annotations at once, e.g. to re-match exported
+annotations after the vendor data changed.
+
+Usage: python -m fuzzy_vendor_matching_webhook_python.batch [--country C] [--file-id F] [FILE]
+
+Each line of the NDJSON file (standard input by default) is an object with the
+"vat_id", "name" and "address" of a vendor, any of them may be missing. Each
+line is written to standard output with the matched vendors added as "options",
+best match first, the way the webhook offers them. --country and --file-id
+restrict the matched vendors like the hook settings do."""
+import argparse
+import json
+import sys
+from itertools import tee
+from typing import Any, Dict, Iterable, Iterator, List
+
+from fuzzy_vendor_matching_webhook_python.config import MAX_VENDOR_OPTIONS
+from fuzzy_vendor_matching_webhook_python.matching import ALL_VENDORS, get_matcher, VendorScope
+from fuzzy_vendor_matching_webhook_python.normalize import normalize_lookup
+
+
+# Fields of a vendor matched by, each a string, null or missing
+INPUT_FIELDS = ("vat_id", "name", "address")
+
+
+def check_vendors(vendors: Any) -> List[Dict]:
+    """Return the vendors of a batch, raising ValueError unless they are a list of
+    objects whose INPUT_FIELDS are strings or null."""
+    if not isinstance(vendors, list):
+        raise ValueError('"vendors" must be a list')
+    for position, vendor in enumerate(vendors):
+        if not isinstance(vendor, dict):
+            raise ValueError(f"Vendor {position} must be an object")
+        for field in INPUT_FIELDS:
+            if not isinstance(vendor.get(field, ""), (str, type(None))):
+                raise ValueError(f'"{field}" of vendor {position} must be a string or null')
+    return vendors
+
+
+def match_batch(vendors: Iterable[Dict], scope: VendorScope = ALL_VENDORS) -> Iterator[Dict]:
+    """Yield each vendor with the vendors within the scope matching it added as
+    "options", in the order of the input. The vendors are matched many at a time,
+    see VendorMatcher.match_many."""
+    vendors, inputs = tee(vendors)
+    queries = (
+        normalize_lookup(vendor.get("vat_id"), vendor.get("name"), vendor.get("address"))
+        for vendor in inputs
+    )
+    for vendor, results in zip(
+        vendors, get_matcher().match_many(queries, MAX_VENDOR_OPTIONS, scope)
+    ):
+        yield {**vendor, "options": [{"value": id, "label": label} for id, label in results]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "file", nargs="?", type=argparse.FileType(), default=sys.stdin, help="NDJSON vendors"
+    )
+    parser.add_argument("--country", default="", help="match only the vendors of a country")
+    parser.add_argument("--file-id", default="", help="match only the vendors of a vendor file")
+    args = parser.parse_args()
+
+    scope = VendorScope(args.country.strip().upper(), args.file_id)
+    vendors = (json.loads(line) for line in args.file if line.strip())
+    for vendor in match_batch(vendors, scope):
+        sys.stdout.write(json.dumps(vendor) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""A bounded in-process cache for vendor lookups."""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable
+
+from fuzzy_vendor_matching_webhook_python.metrics import MATCH_CACHE_REQUESTS
+
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe cache of at most `maxsize` entries, evicting the least recently used
+    one when full. Entries expire `ttl` seconds after they were stored."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        """Return the value stored for the key, or MISSING."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                MATCH_CACHE_REQUESTS.labels("miss").inc()
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            MATCH_CACHE_REQUESTS.labels("hit").inc()
+            return entry[1]
+
+    def put(self, key: Hashable, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "size": len(self._entries),
+            }
@@ -4,6 +4,59 @@ from typing import Dict
 
 SECRET_KEY = os.getenv("SESSION_SECRET_KEY", "secret")
 
+# Maximum number of ranked vendor candidates offered in the vendor enum
+MAX_VENDOR_OPTIONS = int(os.getenv("MAX_VENDOR_OPTIONS", "20"))
+
+# Vendor matching backend, "sql" to query the database with pg_trgm on every call,
+# "memory" to search trigram posting lists loaded into the process at first use
+VENDOR_MATCHER = os.getenv("VENDOR_MATCHER", "sql")
+
+# Index file the "memory" backend maps into memory, built from the vendor table when
+# missing or out of date; unset to build the index in each process instead
+VENDOR_INDEX_FILE = os.getenv("VENDOR_INDEX_FILE")
+
+# Trigram similarity a name or address needs to match, as pg_trgm.similarity_threshold
+# in the database for the "sql" backend
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.3"))
+
+# Similarity thresholds of adaptive matching, comma separated: a lookup starts at the
+# strictest and relaxes tier by tier until MIN_VENDOR_CANDIDATES vendors match. Tiers below
+# SIMILARITY_THRESHOLD only apply to names or addresses of LONG_INPUT_LENGTH characters or
+# more, which share few trigrams with a vendor when garbled by OCR, while short ones match
+# too many vendors already. Unset to match at SIMILARITY_THRESHOLD alone.
+ADAPTIVE_THRESHOLDS = sorted(
+    (float(t) for t in os.getenv("ADAPTIVE_THRESHOLDS", "").split(",") if t.strip()), reverse=True,
+)
+MIN_VENDOR_CANDIDATES = int(os.getenv("MIN_VENDOR_CANDIDATES", "1"))
+LONG_INPUT_LENGTH = int(os.getenv("LONG_INPUT_LENGTH", "30"))
+
+# Encoder of the webhook responses, "json" of the standard library or "orjson", which
+# needs the "orjson" extra (orjson 3.9 or later) and falls back to json without it
+JSON_SERIALIZER = os.getenv("JSON_SERIALIZER", "json")
+
+# Seconds a webhook call may take to match vendors, 0 for no limit. Postgres cancels the
+# queries still running then (statement_timeout), and the call answers with the vendors
+# having the VAT ID, if found by then, or leaves the vendor enum as it is
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "10"))
+
+# Vendor lookups cached by their inputs, 0 disables the cache
+MATCH_CACHE_SIZE = int(os.getenv("MATCH_CACHE_SIZE", "10000"))
+MATCH_CACHE_TTL = float(os.getenv("MATCH_CACHE_TTL", "300"))
+
+# Countries the vendor table is partitioned by, comma separated, each getting a partition
+# of its own with its own search indexes; vendors of other countries share a default one
+VENDOR_PARTITIONS = [
+    country.strip().upper() for country in os.getenv("VENDOR_PARTITIONS", "").split(",") if country
+]
+
+# Fraction of the vendors a delta sync may delete at most, guarding against an empty or
+# truncated vendor file; a sync deleting more is aborted, leaving the vendor table as it is
+SYNC_MAX_DELETE_FRACTION = float(os.getenv("SYNC_MAX_DELETE_FRACTION", "0.5"))
+
+# Seconds between checks whether an import changed the vendor table, which drops
+# cached lookups and reloads the "memory" backend
+VENDOR_DATA_CHECK_INTERVAL = float(os.getenv("VENDOR_DATA_CHECK_INTERVAL", "1"))
+
 
 def get_database_config() -> Dict[str, str]:
     return {
@@ -15,5 +68,31 @@ def get_database_config() -> Dict[str, str]:
     }
 
 
+def get_pool_config() -> Dict[str, float]:
+    return {
+        "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+        "max_size": int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+        # seconds to wait for a free connection before giving up
+        "timeout": float(os.getenv("DB_POOL_TIMEOUT", "5")),
+        # idle connections older than this many seconds are pinged before handed out
+        "health_check_interval": float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30")),
+    }
+
+
+def get_retry_config() -> Dict[str, float]:
+    return {
+        # attempts of one query, including the first one
+        "attempts": int(os.getenv("DB_RETRY_ATTEMPTS", "3")),
+        # exponential backoff between attempts, randomized between zero and the current step
+        "backoff": float(os.getenv("DB_RETRY_BACKOFF", "0.1")),
+        "backoff_cap": float(os.getenv("DB_RETRY_BACKOFF_CAP", "2")),
+        # seconds a query including its retries may take before giving up
+        "deadline": float(os.getenv("DB_RETRY_DEADLINE", "5")),
+        # consecutive failures after which queries fail fast for reset_timeout seconds
+        "breaker_failure_threshold": int(os.getenv("DB_BREAKER_FAILURE_THRESHOLD", "5")),
+        "breaker_reset_timeout": float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "10")),
+    }
+
+
 # Database configuration
 DATABASE_CONFIG = get_database_config()
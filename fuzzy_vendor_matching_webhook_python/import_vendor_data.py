@@ -1,48 +1,148 @@
 #!/usr/bin/env python3
 #
 # Usage: import_vendor_data.py supportive_data/vendor_data_de.csv
+#        import_vendor_data.py --workers 8 supportive_data/vendor_data_de.csv
+#        import_vendor_data.py --sync {delta,swap} supportive_data/vendor_data_de.csv
 
+import argparse
 import csv
-import sys
-from typing import Dict
+import io
+import locale
+import logging
+import os
+import re
+import time
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from psycopg2 import errors, sql
 
 from database.database import VendorDatabase
+from fuzzy_vendor_matching_webhook_python import config
+from fuzzy_vendor_matching_webhook_python.normalize import (
+    normalize_address,
+    normalize_name,
+    normalize_vat_id,
+)
 
 db = VendorDatabase()
 
+# Search columns shared by the trigram indexes and the matching query in the webhook. They
+# are normalized at import time, see search_fields, the same way the lookup inputs are.
+NAME_SEARCH_EXPRESSION = "name_norm"
+ADDRESS_SEARCH_EXPRESSION = "address_norm"
+VAT_ID_SEARCH_EXPRESSION = "taxid_norm"
+# Label of a vendor in the vendor enum
+LABEL_EXPRESSION = "label"
+
+
+# CSV fields in the order of the vendor_data columns
+CSV_FIELDS = [
+    "VendorID",
+    "VendorName",
+    "Address1",
+    "Address2",
+    "Address3",
+    "City",
+    "State",
+    "ZipCode",
+    "Country",
+    "Telephone",
+    "VendorAccountGroup",
+    "IndustrySector",
+    "TaxID1",
+    "ActiveVendor",
+    "FileID",
+]
+
+# Fields computed from the CSV fields by search_fields
+SEARCH_FIELDS = ["NameNorm", "AddressNorm", "TaxIDNorm", "Label"]
+
+# Fields of a vendor row in the order of the vendor_data columns
+ROW_FIELDS = CSV_FIELDS + SEARCH_FIELDS
+
+# vendor_data columns in the order of ROW_FIELDS
+VENDOR_DATA_COLUMNS = [
+    "id",
+    "name",
+    "address1",
+    "address2",
+    "address3",
+    "city",
+    "state",
+    "zipcode",
+    "country",
+    "telephone",
+    "vendor_account_group",
+    "industry_sector",
+    "taxid1",
+    "active_vendor",
+    "file_id",
+    "name_norm",
+    "address_norm",
+    "taxid_norm",
+    "label",
+]
 
-def vendor_import(row: Dict):
+SHADOW_TABLE = "vendor_data_shadow"
+
+# Rows sent to the database by one COPY, bounding the memory of a bulk import
+COPY_CHUNK_SIZE = 10000
+
+# Shards of the vendor file per worker process of a parallel import
+SHARDS_PER_WORKER = 4
+
+
+def vendor_import(row: Dict, table: str = "vendor_data"):
     """Insert named rows in the order appropriate for the database schema."""
     db.execute(
-        "INSERT INTO vendor_data VALUES (" + ", ".join(["%s" for _ in range(15)]) + ")",
-        list(
-            row[k]
-            for k in [
-                "VendorID",
-                "VendorName",
-                "Address1",
-                "Address2",
-                "Address3",
-                "City",
-                "State",
-                "ZipCode",
-                "Country",
-                "Telephone",
-                "VendorAccountGroup",
-                "IndustrySector",
-                "TaxID1",
-                "ActiveVendor",
-                "FileID",
-            ]
-        ),
+        f"INSERT INTO {table} VALUES (" + ", ".join(["%s" for _ in ROW_FIELDS]) + ")",
+        list(row[k] for k in ROW_FIELDS),
     )
 
 
-def db_import(filename: str):
-    """Create vendor table and import active vendors to it."""
+def copy_value(value: Optional[str]) -> str:
+    """Escape a value for the text format of COPY."""
+    if value is None:
+        return "\\N"
+    return (
+        value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    )
+
+
+def vendor_bulk_import(
+    rows: Iterable[Dict], table: str = "vendor_data", chunk_size: int = COPY_CHUNK_SIZE
+):
+    """Stream named rows to the database with COPY, `chunk_size` rows at a time.
+    Return the number of rows."""
+    rows = iter(rows)
+    count = 0
+    for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+        data = "".join("\t".join(copy_value(row[k]) for k in ROW_FIELDS) + "\n" for row in chunk)
+        db.copy_expert(f"COPY {table} FROM STDIN", io.StringIO(data))
+        count += len(chunk)
+    return count
+
+
+def db_create_vendor_data(table: str = "vendor_data"):
+    """Create vendor table, without the search indexes.
+
+    The table is partitioned by country, with a partition for each of
+    VENDOR_PARTITIONS and a default one for the other countries. A lookup
+    scoped to a country only reads its partition. The vendors of a country added
+    to VENDOR_PARTITIONS later are moved from the default partition to its own.
+
+    A table created unpartitioned, before the vendor table was partitioned, raises
+    ValueError; db_import replaces it by a partitioned one."""
+    (relkind,) = db.execute_and_fetch(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table,)
+    ) or (None,)
+    if relkind == "r":
+        raise ValueError(f"{table} is not partitioned by country, import the vendors anew")
     db.execute(
-        """CREATE TABLE IF NOT EXISTS vendor_data (
-                id VARCHAR(16) PRIMARY KEY,
+        f"""CREATE TABLE IF NOT EXISTS {table} (
+                id VARCHAR(16) NOT NULL,
                 name TEXT NOT NULL,
                 address1 TEXT,
                 address2 TEXT,
@@ -50,31 +150,363 @@ def db_import(filename: str):
                 city TEXT,
                 state TEXT,
                 zipcode TEXT,
-                country TEXT,
+                country TEXT NOT NULL,
                 telephone TEXT,
                 vendor_account_group TEXT,
                 industry_sector TEXT,
                 taxid1 TEXT,
                 active_vendor INT NOT NULL,
-                file_id TEXT);"""
+                file_id TEXT,
+                name_norm TEXT NOT NULL,
+                address_norm TEXT NOT NULL,
+                taxid_norm TEXT,
+                label TEXT NOT NULL,
+                PRIMARY KEY (id, country))
+            PARTITION BY LIST (country);"""
+    )
+    has_default = relkind is not None
+    for country in config.VENDOR_PARTITIONS:
+        partition = partition_name(table, country)
+        if db.execute_and_fetch("SELECT to_regclass(%s);", (partition,)) != (None,):
+            continue
+        if has_default:
+            db_move_to_partition(table, partition, country)
+            continue
+        db.execute(
+            sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES IN ({});").format(
+                sql.Identifier(partition), sql.Identifier(table), sql.Literal(country)
+            )
+        )
+    db.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;")
+
+
+def db_move_to_partition(table: str, partition: str, country: str):
+    """Create the partition of a country of an existing vendor table, moving the vendors
+    of the country out of the default partition, which Postgres requires before it
+    attaches the partition. The indexes of the table are created on it as it is attached."""
+    db.execute(
+        sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);").format(
+            sql.Identifier(partition), sql.Identifier(table)
+        )
+    )
+    db.execute(
+        sql.SQL(
+            """WITH moved AS (DELETE FROM {} WHERE country = {} RETURNING *)
+                INSERT INTO {} SELECT * FROM moved;"""
+        ).format(
+            sql.Identifier(f"{table}_default"), sql.Literal(country), sql.Identifier(partition)
+        )
     )
+    db.execute(
+        sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({});").format(
+            sql.Identifier(table), sql.Identifier(partition), sql.Literal(country)
+        )
+    )
+
+
+def partition_name(table: str, country: str) -> str:
+    """Name of the partition of a vendor table holding the vendors of a country."""
+    return f"{table}_{re.sub(r'[^a-z0-9]', '_', country.lower())}"
+
+
+def search_fields(row: Dict) -> Dict:
+    """Add the normalized search fields and the label to a named row.
+
+    A vendor without a VAT ID gets None as normalized VAT ID, which every
+    looked up VAT ID matches. The country, the partition key, is upper-cased and,
+    like the file id, stripped the way the hook settings are, see webhook.vendor_scope."""
+    name, address1, city = row["VendorName"], row["Address1"] or "", row["City"] or ""
+    address = [row["Address1"], row["Address2"], row["Address3"], row["City"], row["ZipCode"]]
+    row["NameNorm"] = normalize_name(name)
+    row["AddressNorm"] = normalize_address(*address)
+    row["TaxIDNorm"] = normalize_vat_id(row["TaxID1"]) or None
+    row["Country"] = (row["Country"] or "").strip().upper()
+    if row["FileID"] is not None:
+        row["FileID"] = row["FileID"].strip()
+    row["Label"] = f"{name}, {address1}, {city} ({row['VendorID']})"
+    return row
+
+
+def read_active_vendors(
+    csvfile: Iterable[str], fieldnames: Optional[List[str]] = None
+) -> Iterator[Dict]:
+    """Read named rows of active vendors from the lines of a vendor CSV file, with
+    search fields. The names of the fields are read from the first line unless given."""
+    reader = csv.DictReader(csvfile, fieldnames=fieldnames, delimiter=";")
+    return (search_fields(row) for row in reader if row["ActiveVendor"] == "1")
+
+
+def db_import(filename: str, bulk: bool = True, workers: int = 1):
+    """Replace the vendor table by the active vendors of a CSV file.
+
+    The vendors are loaded into the shadow table, which is indexed and swapped in for
+    the vendor table once they are all loaded, see db_swap_in_shadow_table. An import
+    thus replaces the vendors imported before, whatever the number of `workers`, and
+    the webhook serves the old vendors until it is done. A failed import leaves the
+    vendor table as it is.
+
+    The vendors are loaded with COPY, or with an INSERT per vendor unless `bulk`.
+    With more than one of `workers`, they are loaded in parallel, with COPY only, see
+    db_parallel_import."""
+    if workers > 1:
+        if not bulk:
+            raise ValueError("A parallel import loads the vendors with COPY only")
+        db_parallel_import(filename, workers)
+        return
+    try:
+        db.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE};")
+        db_create_vendor_data(SHADOW_TABLE)
+        with open(filename) as csvfile:
+            if bulk:
+                vendor_bulk_import(read_active_vendors(csvfile), table=SHADOW_TABLE)
+            else:
+                for row in read_active_vendors(csvfile):
+                    vendor_import(row, table=SHADOW_TABLE)
+        db_create_indexes(SHADOW_TABLE)
+        db_swap_in_shadow_table()
+    except Exception:
+        # the shadow table was created in the rolled back transaction
+        db.rollback()
+        raise
+
+
+def shard_ranges(filename: str, shards: int) -> List[Tuple[int, int]]:
+    """Split the vendors of a CSV file into at most `shards` byte ranges starting
+    at line boundaries, leaving out the header line. Vendors must not span lines."""
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as csvfile:
+        csvfile.readline()
+        bounds = [csvfile.tell()]
+        for shard in range(1, shards):
+            csvfile.seek(max(bounds[0] + (size - bounds[0]) * shard // shards, bounds[-1]))
+            csvfile.readline()
+            bounds.append(min(csvfile.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def import_shard(
+    filename: str, fieldnames: List[str], start: int, end: int, table: str = "vendor_data"
+) -> int:
+    """Load the vendors in a byte range of a CSV file into a table over a connection
+    of this process, committing them. Return the number of vendors."""
+    encoding = locale.getpreferredencoding(False)
+    with open(filename, "rb") as csvfile:
+        csvfile.seek(start)
+        lines = iter(lambda: csvfile.readline() if csvfile.tell() < end else b"", b"")
+        rows = read_active_vendors((line.decode(encoding) for line in lines), fieldnames)
+        count = vendor_bulk_import(rows, table=table)
+    db.commit()
+    return count
 
+
+def db_parallel_import(filename: str, workers: int):
+    """Import the vendors of a CSV file with `workers` processes, each parsing,
+    normalizing and loading byte ranges of the file over its own connection.
+
+    The file is split into several shards per worker to balance the load; the
+    progress is logged as shards finish. The workers load the shadow table, which
+    is swapped in for the vendor table once all of them are loaded and indexed, like
+    db_import does, so that the webhook serves the old vendors until then. A failed
+    import drops the shadow table and leaves the vendor table as it is."""
+    db.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE};")
+    db_create_vendor_data(SHADOW_TABLE)
+    db.commit()
+    # the workers must not inherit connections of this process
+    db.close()
     with open(filename) as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=";")
-        for row in reader:
-            if row["ActiveVendor"] == "1":
-                vendor_import(row)
+        fieldnames = next(csv.reader(csvfile, delimiter=";"))
+    shards = shard_ranges(filename, workers * SHARDS_PER_WORKER)
+
+    start = time.monotonic()
+    imported = 0
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(import_shard, filename, fieldnames, *shard, SHADOW_TABLE)
+                for shard in shards
+            ]
+            for done, future in enumerate(as_completed(futures), 1):
+                imported += future.result()
+                logging.info(
+                    "Imported %d of %d shards, %d vendors, %.0f rows/s",
+                    done,
+                    len(shards),
+                    imported,
+                    imported / (time.monotonic() - start),
+                )
+        db_create_indexes(SHADOW_TABLE)
+        db_swap_in_shadow_table()
+    except Exception:
+        db.rollback()
+        db.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE};")
+        db.commit()
+        raise
+    elapsed = time.monotonic() - start
+    logging.info(
+        "Imported %d vendors in %.1f s, %.0f rows/s", imported, elapsed, imported / elapsed
+    )
+
+
+def db_create_indexes(table: str = "vendor_data"):
+    """Create the indexes over the columns the webhook searches by: trigram indexes
+    over the name and address and a hash index over the VAT ID.
+
+    GiST is used rather than GIN as besides the `%` filter it also serves
+    the `<->` distance ordering, so that a top-K lookup stops after K rows.
+    Postgres keeps the indexes up to date on every later insert or update."""
+    db.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    db.execute(
+        f"""CREATE INDEX IF NOT EXISTS {table}_name_trgm_idx
+                ON {table} USING gist ({NAME_SEARCH_EXPRESSION} gist_trgm_ops);"""
+    )
+    db.execute(
+        f"""CREATE INDEX IF NOT EXISTS {table}_address_trgm_idx
+                ON {table} USING gist ({ADDRESS_SEARCH_EXPRESSION} gist_trgm_ops);"""
+    )
+    # the exact VAT ID lookup only ever tests equality
+    db.execute(
+        f"""CREATE INDEX IF NOT EXISTS {table}_taxid_hash_idx
+                ON {table} USING hash ({VAT_ID_SEARCH_EXPRESSION});"""
+    )
+    db.execute(f"ANALYZE {table};")
+
+
+def db_sync(filename: str, strategy: str = "delta"):
+    """Bring the vendor table in line with a vendor file, serving all the time.
+
+    The "delta" strategy changes only vendors that were added, modified or
+    removed. The "swap" strategy loads the file into a shadow table and swaps
+    it in for the vendor table in one transaction."""
+    if strategy == "delta":
+        db_sync_delta(filename)
+    elif strategy == "swap":
+        db_sync_swap(filename)
+    else:
+        raise ValueError(f"Unknown sync strategy {strategy!r}")
+
+
+def db_sync_delta(filename: str):
+    """Upsert vendors whose content changed and delete vendors no longer in the file.
+
+    A file without vendors, or one whose sync would delete more than
+    SYNC_MAX_DELETE_FRACTION of the vendors, aborts the sync with ValueError."""
+    db_create_vendor_data()
+    db.execute("CREATE TEMPORARY TABLE vendor_data_staging (LIKE vendor_data) ON COMMIT DROP;")
+    with open(filename) as csvfile:
+        staged = vendor_bulk_import(read_active_vendors(csvfile), table="vendor_data_staging")
+    if not staged:
+        db.rollback()
+        raise ValueError(f"No active vendors in {filename}, not syncing")
+    (vendors,) = db.execute_and_fetch("SELECT COUNT(*) FROM vendor_data;")
+
+    columns = ", ".join(VENDOR_DATA_COLUMNS)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in VENDOR_DATA_COLUMNS[1:])
+    (upserted,) = db.execute_and_fetch(
+        f"""WITH upserted AS (
+                INSERT INTO vendor_data ({columns}) SELECT {columns} FROM vendor_data_staging
+                ON CONFLICT (id, country) DO UPDATE SET {updates}
+                    WHERE ROW(vendor_data.*) IS DISTINCT FROM ROW(EXCLUDED.*)
+                RETURNING 1)
+            SELECT COUNT(*) FROM upserted;"""
+    )
+    (deleted,) = db.execute_and_fetch(
+        """WITH deleted AS (
+                DELETE FROM vendor_data WHERE NOT EXISTS (
+                    SELECT 1 FROM vendor_data_staging
+                        WHERE vendor_data_staging.id = vendor_data.id
+                            AND vendor_data_staging.country = vendor_data.country)
+                RETURNING 1)
+            SELECT COUNT(*) FROM deleted;"""
+    )
+    if deleted > config.SYNC_MAX_DELETE_FRACTION * vendors:
+        db.rollback()
+        raise ValueError(
+            f"Syncing {filename} would delete {deleted} of {vendors} vendors, not syncing"
+        )
+    db_create_indexes()
+    db_bump_vendor_data_version()
+    db.commit()
+    logging.info("Synced vendor data: %s upserted, %s deleted", upserted, deleted)
+
+
+def db_sync_swap(filename: str):
+    """Load a vendor file into a shadow table and swap it in for the vendor table.
+
+    The shadow table is built in the same transaction that swaps it in, so
+    readers see either the complete old or the complete new vendor table. This is
+    what db_import does."""
+    db_import(filename)
+
+
+def db_swap_in_shadow_table():
+    """Replace the vendor table by the shadow table, committing the swap."""
+    db.execute("DROP TABLE IF EXISTS vendor_data;")
+    # rename the shadow table along with its indexes, so that the next swap finds their names free
+    relations = db.execute_and_fetchall(
+        """SELECT relname, relkind IN ('i', 'I') FROM pg_class
+            WHERE relnamespace = current_schema()::regnamespace AND relname LIKE %s""",
+        (SHADOW_TABLE.replace("_", "\\_") + "%",),
+    )
+    for relname, is_index in relations:
+        db.execute(
+            sql.SQL("ALTER {} {} RENAME TO {};").format(
+                sql.SQL("INDEX" if is_index else "TABLE"),
+                sql.Identifier(relname),
+                sql.Identifier("vendor_data" + relname[len(SHADOW_TABLE) :]),
+            )
+        )
+    db_bump_vendor_data_version()
     db.commit()
 
 
+def db_bump_vendor_data_version():
+    """Record a change of the vendor table, for processes caching its contents to notice.
+
+    The version is bumped in the transaction changing the vendor table, so that
+    it gets visible together with the change."""
+    db.execute("CREATE TABLE IF NOT EXISTS vendor_data_version (version BIGINT NOT NULL);")
+    db.execute(
+        """INSERT INTO vendor_data_version
+            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM vendor_data_version);"""
+    )
+    db.execute("UPDATE vendor_data_version SET version = version + 1;")
+
+
+def db_vendor_data_version() -> int:
+    """Return the version of the vendor table, 0 before the first import."""
+    try:
+        row = db.execute_and_fetch("SELECT version FROM vendor_data_version;")
+    except errors.UndefinedTable:
+        db.rollback()
+        return 0
+    return row[0] if row else 0
+
+
 def db_drop_vendor_data():
     db.execute(
         """
         DROP TABLE vendor_data;
         """
     )
+    db_bump_vendor_data_version()
     db.commit()
 
 
 if __name__ == "__main__":
-    db_import(sys.argv[1])
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Import vendors from a CSV file.")
+    parser.add_argument("filename")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="processes parsing and loading the file in parallel",
+    )
+    parser.add_argument(
+        "--sync",
+        choices=["delta", "swap"],
+        help="refresh the vendor table in place instead of importing into it",
+    )
+    args = parser.parse_args()
+    if args.sync:
+        db_sync(args.filename, args.sync)
+    else:
+        db_import(args.filename, workers=args.workers)
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+"""Backends looking up the vendors matching the extracted VAT ID, name and address."""
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from functools import lru_cache
+from itertools import count, islice
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from psycopg2.extensions import QueryCanceledError
+
+from database.database import DeadlineExceeded
+from fuzzy_vendor_matching_webhook_python import config
+from fuzzy_vendor_matching_webhook_python.cache import LRUCache, MISSING
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import (
+    db,
+    db_vendor_data_version,
+    NAME_SEARCH_EXPRESSION,
+    ADDRESS_SEARCH_EXPRESSION,
+    VAT_ID_SEARCH_EXPRESSION,
+    LABEL_EXPRESSION,
+)
+from fuzzy_vendor_matching_webhook_python.metrics import SIMILARITY_THRESHOLD_TIERS, VAT_ID_LOOKUPS
+
+# Vendors sent to the database at once by SqlVendorMatcher.match_many
+MATCH_BATCH_SIZE = 1000
+
+# The setting `%` compares trigram similarities to, set by each fuzzy query
+THRESHOLD_SETTING = "pg_trgm.similarity_threshold"
+
+# Breaks ties between equally distant vendors in byte order, which is code point order
+# in UTF-8, rather than in the collation of the database
+ID_ORDER = 'id COLLATE "C"'
+
+
+class MatchDeadlineExceeded(Exception):
+    """A lookup ran out of the deadline of the request, see Database.deadline. `results`
+    are the vendors the exact lookup of the VAT ID found before, if any."""
+
+    def __init__(self, results: List[Tuple[str, str]]):
+        super().__init__("Vendor lookup deadline exceeded")
+        self.results = results
+
+
+class VendorScope(NamedTuple):
+    """The slice of the vendor table a lookup searches: the vendors of a country,
+    which is the partition key of the table, and of a vendor file, i.e. a tenant.
+    Empty fields do not restrict the lookup."""
+
+    country: str = ""
+    file_id: str = ""
+
+
+ALL_VENDORS = VendorScope()
+
+
+def scope_conditions(country: Optional[str], file_id: Optional[str]) -> List[str]:
+    """Conditions restricting a query to the scope given as SQL expressions, None
+    for the fields not restricting it. Postgres prunes the partitions of other countries,
+    also at execution time when the country is a statement parameter."""
+    conditions = []
+    if country is not None:
+        conditions.append(f"country = {country}")
+    if file_id is not None:
+        conditions.append(f"file_id = {file_id}")
+    return conditions
+
+
+def match_vendor_query(
+    vat_id: Optional[str],
+    name: Optional[str],
+    address: Optional[str],
+    limit: str,
+    threshold: str,
+    ranked=False,
+    country: Optional[str] = None,
+    file_id: Optional[str] = None,
+) -> str:
+    """The query matching vendors to the normalized inputs given as SQL expressions.
+    Inputs given as None are empty and neither filter nor rank the vendors. The
+    vendors are restricted to the `country` and `file_id` unless None.
+
+    Candidates are ranked by a single distance combining the inputs: the trigram
+    distances of the name and of the address, plus 1 unless the VAT ID is equal.
+    Equally distant vendors are ranked by id in code point order (ID_ORDER), like the
+    in-memory backend ranks them, also where `limit` cuts them off. With just a name or
+    an address, the distance is the trigram distance alone, which the GiST index serves
+    in KNN mode, so that Postgres sorts only the ties by id rather than all candidates
+    (Incremental Sort) and stops after `limit` candidates. Leaving the conditions
+    of empty inputs out of the query, rather than guarding them with `input = '' OR`, lets
+    the planner use the trigram indexes also when the inputs are parameters or columns.
+    With `ranked`, the ranking keys are selected as `rank`.
+
+    The `threshold` is set as the similarity threshold by a condition Postgres evaluates
+    once before the scan (a One-Time Filter), so that each query brings its own threshold
+    in the same round trip. The setting lasts until the transaction ends."""
+    conditions = scope_conditions(country, file_id)
+    conditions.append(
+        f"(SELECT set_config('{THRESHOLD_SETTING}', {threshold}::float8::text, true))"
+        " IS NOT NULL"
+    )
+    distances = []
+    if vat_id is not None:
+        conditions.append(
+            f"({VAT_ID_SEARCH_EXPRESSION} IS NULL OR {VAT_ID_SEARCH_EXPRESSION} = {vat_id})"
+        )
+    if name is not None:
+        conditions.append(f"{NAME_SEARCH_EXPRESSION} %% {name}")
+        distances.append(f"({NAME_SEARCH_EXPRESSION} <-> {name})")
+    if address is not None:
+        conditions.append(f"{ADDRESS_SEARCH_EXPRESSION} %% {address}")
+        distances.append(f"({ADDRESS_SEARCH_EXPRESSION} <-> {address})")
+    if vat_id is not None:
+        distances.append(f"({VAT_ID_SEARCH_EXPRESSION} IS DISTINCT FROM {vat_id})::int::real")
+    distance = " + ".join(distances) or "0"
+    rank = f", ROW(distance, {ID_ORDER}) AS rank" if ranked else ""
+    return f"""
+    SELECT taxid1, vendor{rank} FROM (
+        SELECT id, taxid1, {LABEL_EXPRESSION} AS vendor, {distance} AS distance
+            FROM vendor_data
+            WHERE {" AND ".join(conditions) or "TRUE"}
+            ORDER BY {distance}, {ID_ORDER}
+            LIMIT {limit}
+    ) AS candidates
+        ORDER BY distance, {ID_ORDER}
+    """
+
+
+def match_vendors_query(
+    has_vat_id: bool,
+    has_name: bool,
+    has_address: bool,
+    has_country: bool = False,
+    has_file_id: bool = False,
+) -> str:
+    """The query matching all inputs of the arrays, which have the given inputs
+    non-empty, returning the matches of each input in turn. The scope of all the
+    inputs is given as %(country)s and %(file_id)s, the similarity threshold as
+    %(threshold)s."""
+    inputs = [
+        f"input.{column}" if present else None
+        for column, present in (
+            ("vat_id", has_vat_id),
+            ("name", has_name),
+            ("address", has_address),
+        )
+    ]
+    query = match_vendor_query(
+        *inputs,
+        "%(limit)s",
+        "%(threshold)s",
+        ranked=True,
+        country="%(country)s" if has_country else None,
+        file_id="%(file_id)s" if has_file_id else None,
+    )
+    return f"""
+    SELECT input.position, match.taxid1, match.vendor
+        FROM UNNEST(%(vat_ids)s::text[], %(names)s::text[], %(addresses)s::text[])
+            WITH ORDINALITY AS input(vat_id, name, address, position)
+        CROSS JOIN LATERAL ({query}) AS match
+        ORDER BY input.position, match.rank
+    """
+
+
+@lru_cache(maxsize=None)
+def vat_id_statement(has_country: bool = False, has_file_id: bool = False) -> Tuple[str, str]:
+    """Name and text of the statement looking up the vendors having a VAT ID, served by
+    the hash index over it. Two rows are enough to tell a unique hit from an ambiguous
+    one. Its parameters are the VAT ID followed by the non-empty fields of the scope."""
+    parameters = (f"${number}" for number in count(2))
+    conditions = scope_conditions(
+        next(parameters) if has_country else None, next(parameters) if has_file_id else None
+    )
+    conditions.append(f"{VAT_ID_SEARCH_EXPRESSION} = $1")
+    return (
+        f"match_vendor_vat_id_{int(has_country)}{int(has_file_id)}",
+        f"""SELECT taxid1, {LABEL_EXPRESSION} AS vendor FROM vendor_data
+            WHERE {" AND ".join(conditions)} LIMIT 2""",
+    )
+
+
+def vat_ids_query(has_country: bool = False, has_file_id: bool = False) -> str:
+    """The VAT ID lookup of all VAT IDs of a batch, within the scope given as in
+    match_vendors_query."""
+    conditions = scope_conditions(
+        "%(country)s" if has_country else None, "%(file_id)s" if has_file_id else None
+    )
+    conditions.append(f"{VAT_ID_SEARCH_EXPRESSION} = ANY(%(vat_ids)s::text[])")
+    return f"""
+    SELECT {VAT_ID_SEARCH_EXPRESSION}, taxid1, {LABEL_EXPRESSION} AS vendor FROM vendor_data
+        WHERE {" AND ".join(conditions)}
+    """
+
+
+def threshold_tiers(name: str, address: str) -> List[float]:
+    """Similarity thresholds to match the normalized name and address at in turn, strictest
+    first, see ADAPTIVE_THRESHOLDS. The tiers of a short lookup are a prefix of those of a
+    long one. Empty unless matching is adaptive and a name or address is given."""
+    if not (config.ADAPTIVE_THRESHOLDS and (name or address)):
+        return []
+    tiers = sorted({*config.ADAPTIVE_THRESHOLDS, config.SIMILARITY_THRESHOLD}, reverse=True)
+    if max(len(name), len(address)) >= config.LONG_INPUT_LENGTH:
+        return tiers
+    return [threshold for threshold in tiers if threshold >= config.SIMILARITY_THRESHOLD]
+
+
+def enough_candidates(results: List[Tuple[str, str]], limit: int) -> bool:
+    """Tell whether adaptive matching can stop relaxing the threshold."""
+    return len(results) >= min(config.MIN_VENDOR_CANDIDATES, limit)
+
+
+def match_adaptively(
+    match: Callable[[float], List[Tuple[str, str]]], name: str, address: str, limit: int,
+) -> List[Tuple[str, str]]:
+    """Call `match` with each of the threshold_tiers of a lookup until enough vendors
+    match, or once with SIMILARITY_THRESHOLD unless matching is adaptive."""
+    tiers = threshold_tiers(name, address)
+    if not tiers:
+        return match(config.SIMILARITY_THRESHOLD)
+    for threshold in tiers:
+        results = match(threshold)
+        if enough_candidates(results, limit):
+            break
+    SIMILARITY_THRESHOLD_TIERS.labels(str(threshold)).inc()
+    return results
+
+
+def unique_vat_id_hit(hits: int) -> bool:
+    """Tell whether the exact lookup of a VAT ID decides the match, i.e. exactly one
+    vendor has it. Otherwise the fuzzy search takes over."""
+    VAT_ID_LOOKUPS.labels("unique" if hits == 1 else "ambiguous" if hits else "miss").inc()
+    return hits == 1
+
+
+@lru_cache(maxsize=None)
+def match_vendor_statement(
+    has_vat_id: bool,
+    has_name: bool,
+    has_address: bool,
+    has_country: bool = False,
+    has_file_id: bool = False,
+) -> Tuple[str, str]:
+    """Name and text of the statement to prepare for matching vendors by the given
+    inputs within the given scope. Its parameters are the non-empty inputs, followed
+    by the non-empty fields of the scope, the limit and the similarity threshold, see
+    match_vendor_query."""
+    present = (has_vat_id, has_name, has_address, has_country, has_file_id)
+    parameters = (f"${number}" for number in count(1))
+    vat_id, name, address, country, file_id = [
+        next(parameters) if value else None for value in present
+    ]
+    statement_name = "match_vendor_" + "".join(str(int(value)) for value in present)
+    query = match_vendor_query(
+        vat_id, name, address, next(parameters), next(parameters), country=country, file_id=file_id,
+    )
+    # the statement is prepared as is, not formatted with parameters
+    return statement_name, query.replace("%%", "%")
+
+
+class VendorMatcher(ABC):
+    """Looks up vendors matching a VAT ID, a name and an address.
+
+    The inputs are expected normalized like the vendors are at import time, by
+    normalize_lookup once where they enter the service, e.g. webhook.vendor_lookup
+    and batch.match_batch, and are ignored when empty. A vendor matches when
+    its VAT ID is equal or missing and its name and address are trigram-similar
+    to the inputs. No vendor matches a lookup with all inputs empty.
+
+    A VAT ID is looked up exactly first: the only vendor having it is the only
+    match, regardless of the name and address.
+
+    Only the vendors within the `scope` of a lookup are matched, see VendorScope.
+    A lookup running out of the deadline of the request raises MatchDeadlineExceeded."""
+
+    @abstractmethod
+    def match(
+        self, vat_id: str, name: str, address: str, limit: int, scope: VendorScope = ALL_VENDORS
+    ) -> List[Tuple[str, str]]:
+        """Return at most `limit` (VAT ID, label) pairs of matching vendors, best match first."""
+
+    def match_many(
+        self, queries: Iterable[Tuple[str, str, str]], limit: int, scope: VendorScope = ALL_VENDORS,
+    ) -> Iterator[List[Tuple[str, str]]]:
+        """Match each (VAT ID, name, address) triple like match() does, yielding the
+        results in the order of the queries."""
+        for vat_id, name, address in queries:
+            yield self.match(vat_id, name, address, limit, scope)
+
+
+class SqlVendorMatcher(VendorMatcher):
+    """Matches vendors by querying the vendor table with pg_trgm, after an exact
+    lookup of the VAT ID.
+
+    Each combination of non-empty inputs has its own prepared statement, planned
+    for just the conditions in effect and parsed once per database connection.
+
+    Each fuzzy statement sets its similarity threshold itself, see match_vendor_query,
+    so every tier of adaptive matching takes one round trip."""
+
+    def match(
+        self, vat_id: str, name: str, address: str, limit: int, scope: VendorScope = ALL_VENDORS
+    ) -> List[Tuple[str, str]]:
+        inputs = [value for value in (vat_id, name, address) if value]
+        if not inputs:
+            return []
+        scoped = [value for value in scope if value]
+        vat_id_hits = []
+        try:
+            if vat_id:
+                vat_id_hits = db.execute_prepared_and_fetchall(
+                    *vat_id_statement(*map(bool, scope)), [vat_id] + scoped
+                )
+                if unique_vat_id_hit(len(vat_id_hits)):
+                    return vat_id_hits
+            statement_name, statement = match_vendor_statement(
+                bool(vat_id), bool(name), bool(address), *map(bool, scope)
+            )
+            return match_adaptively(
+                lambda threshold: db.execute_prepared_and_fetchall(
+                    statement_name, statement, inputs + scoped + [limit, threshold]
+                ),
+                name,
+                address,
+                limit,
+            )
+        except QueryCanceledError as error:
+            # the cancelled query aborted the transaction, which holds nothing else of a lookup
+            db.rollback()
+            raise MatchDeadlineExceeded(vat_id_hits) from error
+        except DeadlineExceeded as error:
+            raise MatchDeadlineExceeded(vat_id_hits) from error
+
+    def match_many(
+        self, queries: Iterable[Tuple[str, str, str]], limit: int, scope: VendorScope = ALL_VENDORS,
+    ) -> Iterator[List[Tuple[str, str]]]:
+        """Match the queries MATCH_BATCH_SIZE at a time, with a single query for the
+        VAT IDs of a batch and one for the remaining queries having the same inputs
+        non-empty."""
+        queries = iter(queries)
+        while True:
+            batch = list(islice(queries, MATCH_BATCH_SIZE))
+            if not batch:
+                return
+            results = [[] for _ in batch]
+            hits = self._vat_id_hits({vat_id for vat_id, _, _ in batch if vat_id}, scope)
+            groups = defaultdict(list)
+            for i, query in enumerate(batch):
+                vat_id = query[0]
+                if vat_id and unique_vat_id_hit(len(hits[vat_id])):
+                    results[i] = hits[vat_id]
+                    continue
+                present = tuple(bool(value) for value in query)
+                if any(present):
+                    groups[present].append(i)
+            for present, group in groups.items():
+                query = match_vendors_query(*present, *map(bool, scope))
+                for i, matches in self._match_group(query, batch, group, limit, scope):
+                    results[i] = matches
+            yield from results
+
+    @staticmethod
+    def _match_group(
+        query: str,
+        batch: List[Tuple[str, str, str]],
+        group: List[int],
+        limit: int,
+        scope: VendorScope,
+    ) -> Iterator[Tuple[int, List[Tuple[str, str]]]]:
+        """Yield the position and matches of each query of the batch at the positions
+        of the group, all matched by `query`. With adaptive matching, the queries lacking
+        candidates are matched again at the next threshold tier, all at once."""
+        tiers = {i: threshold_tiers(*batch[i][1:]) for i in group}
+        pending = group
+        for tier in count():
+            adaptive = bool(tiers[pending[0]])
+            threshold = tiers[pending[0]][tier] if adaptive else config.SIMILARITY_THRESHOLD
+            vat_ids, names, addresses = zip(*(batch[i] for i in pending))
+            parameters = {
+                "vat_ids": list(vat_ids),
+                "names": list(names),
+                "addresses": list(addresses),
+                "limit": limit,
+                "threshold": threshold,
+                **scope._asdict(),
+            }
+            rows = db.execute_and_fetchall(query, parameters)
+            matches = defaultdict(list)
+            for position, taxid1, vendor in rows:
+                matches[pending[position - 1]].append((taxid1, vendor))
+            relaxed = []
+            for i in pending:
+                if not adaptive:
+                    yield i, matches[i]
+                elif tier + 1 < len(tiers[i]) and not enough_candidates(matches[i], limit):
+                    relaxed.append(i)
+                else:
+                    SIMILARITY_THRESHOLD_TIERS.labels(str(threshold)).inc()
+                    yield i, matches[i]
+            if not relaxed:
+                return
+            pending = relaxed
+
+    @staticmethod
+    def _vat_id_hits(vat_ids: Set[str], scope: VendorScope) -> Dict[str, List[Tuple[str, str]]]:
+        """The vendors within the scope having each of the VAT IDs."""
+        hits = defaultdict(list)
+        if vat_ids:
+            for vat_id, taxid1, vendor in db.execute_and_fetchall(
+                vat_ids_query(*map(bool, scope)), {"vat_ids": sorted(vat_ids), **scope._asdict()}
+            ):
+                hits[vat_id].append((taxid1, vendor))
+        return hits
+
+
+class CachedVendorMatcher(VendorMatcher):
+    """Serves repeated lookups of another matcher from an LRU cache."""
+
+    def __init__(self, matcher: VendorMatcher, cache: LRUCache):
+        self.matcher = matcher
+        self.cache = cache
+
+    def match(
+        self, vat_id: str, name: str, address: str, limit: int, scope: VendorScope = ALL_VENDORS
+    ) -> List[Tuple[str, str]]:
+        key = (vat_id, name, address, limit, scope)
+        results = self.cache.get(key)
+        if results is MISSING:
+            results = self.matcher.match(vat_id, name, address, limit, scope)
+            self.cache.put(key, results)
+        return results
+
+    def match_many(
+        self, queries: Iterable[Tuple[str, str, str]], limit: int, scope: VendorScope = ALL_VENDORS,
+    ) -> Iterator[List[Tuple[str, str]]]:
+        """Match the queries missing in the cache with one match_many() call per
+        MATCH_BATCH_SIZE queries."""
+        queries = iter(queries)
+        while True:
+            batch = list(islice(queries, MATCH_BATCH_SIZE))
+            if not batch:
+                return
+            keys = [(*query, limit, scope) for query in batch]
+            results = [self.cache.get(key) for key in keys]
+            missing = [i for i, result in enumerate(results) if result is MISSING]
+            matched = self.matcher.match_many([batch[i] for i in missing], limit, scope)
+            for i, result in zip(missing, matched):
+                results[i] = result
+                self.cache.put(keys[i], result)
+            yield from results
+
+
+_matcher = None
+_vendor_data_version = None
+_vendor_data_checked_at = float("-inf")
+# guards the matcher and the vendor data version it was created from
+_matcher_lock = threading.Lock()
+# held by the thread creating a new matcher
+_creating_lock = threading.Lock()
+
+
+def create_matcher() -> VendorMatcher:
+    """Create the matcher of the backend selected by VENDOR_MATCHER, behind a cache
+    unless disabled by MATCH_CACHE_SIZE."""
+    if config.VENDOR_MATCHER == "sql":
+        matcher = SqlVendorMatcher()
+    elif config.VENDOR_MATCHER == "memory":
+        # numpy is only needed by this backend
+        from fuzzy_vendor_matching_webhook_python.trigram_index import InMemoryVendorMatcher
+
+        if config.VENDOR_INDEX_FILE:
+            matcher = InMemoryVendorMatcher.from_index_file(config.VENDOR_INDEX_FILE)
+        else:
+            matcher = InMemoryVendorMatcher.from_database()
+    else:
+        raise ValueError(f"Unknown vendor matcher {config.VENDOR_MATCHER!r}")
+    if config.MATCH_CACHE_SIZE > 0:
+        matcher = CachedVendorMatcher(
+            matcher, LRUCache(config.MATCH_CACHE_SIZE, config.MATCH_CACHE_TTL)
+        )
+    return matcher
+
+
+def get_matcher() -> VendorMatcher:
+    """Return the vendor matcher, creating it on first use and again whenever the
+    vendor table changed, which is checked every VENDOR_DATA_CHECK_INTERVAL seconds.
+
+    Neither the check nor the creation of a matcher holds up the other threads: they
+    go on with the previous matcher until the new one replaces it, and only wait on
+    first use, when there is none."""
+    global _matcher, _vendor_data_version, _vendor_data_checked_at
+    keeps_vendor_data = config.VENDOR_MATCHER != "sql" or config.MATCH_CACHE_SIZE > 0
+    with _matcher_lock:
+        matcher, version = _matcher, _vendor_data_version
+        now = time.monotonic()
+        check = keeps_vendor_data and (
+            matcher is None or now - _vendor_data_checked_at >= config.VENDOR_DATA_CHECK_INTERVAL
+        )
+        if check:
+            _vendor_data_checked_at = now
+    if check:
+        version = probe_vendor_data_version()
+    if matcher is not None and version == _vendor_data_version:
+        return matcher
+    if not _creating_lock.acquire(blocking=matcher is None):
+        return matcher  # another thread is creating the new one
+    try:
+        with _matcher_lock:
+            if _matcher is not None and _vendor_data_version == version:
+                return _matcher
+        # a new matcher serves many requests, the one creating it is not to cancel it
+        with db.outside_deadline():
+            matcher = create_matcher()
+        with _matcher_lock:
+            _matcher, _vendor_data_version = matcher, version
+        return matcher
+    finally:
+        _creating_lock.release()
+
+
+def probe_vendor_data_version() -> Optional[int]:
+    """The version of the vendor table, read in a transaction of its own, so that the
+    lookup after it starts a new one and gets retried when the connection dropped."""
+    try:
+        return db_vendor_data_version()
+    finally:
+        db.release()
+
+
+def reset_matcher():
+    """Drop the vendor matcher along with its cache, to be created again on next use."""
+    global _matcher, _vendor_data_checked_at
+    with _matcher_lock:
+        _matcher = None
+        _vendor_data_checked_at = float("-inf")
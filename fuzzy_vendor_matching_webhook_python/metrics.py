@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Prometheus metrics of the vendor matching webhook."""
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Enum, Histogram, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+
+SHORT_CIRCUITED_CALLS = Counter(
+    "vendor_matching_short_circuited_calls",
+    "Webhook calls answered without a database lookup as no matched datapoint changed.",
+)
+
+DB_RETRIES = Counter(
+    "vendor_matching_db_retries", "Database queries retried after a connection failure."
+)
+
+DB_CIRCUIT_BREAKER_STATE = Enum(
+    "vendor_matching_db_circuit_breaker_state",
+    "State of the circuit breaker guarding the database.",
+    states=["closed", "open", "half_open"],
+)
+
+MATCH_CACHE_REQUESTS = Counter(
+    "vendor_matching_cache_requests",
+    "Lookups of the vendor match cache, by result (hit or miss).",
+    ["result"],
+)
+
+VAT_ID_LOOKUPS = Counter(
+    "vendor_matching_vat_id_lookups",
+    "Exact lookups of a VAT ID, by result (unique, ambiguous or miss), "
+    "not counting the lookups served from the match cache.",
+    ["result"],
+)
+
+SIMILARITY_THRESHOLD_TIERS = Counter(
+    "vendor_matching_similarity_threshold_tiers",
+    "Fuzzy lookups of adaptive matching, by the similarity threshold they ended at.",
+    ["threshold"],
+)
+
+MATCH_DEADLINES_EXCEEDED = Counter(
+    "vendor_matching_deadlines_exceeded",
+    "Webhook calls that ran out of REQUEST_DEADLINE while matching vendors.",
+)
+
+STAGE_SECONDS = Histogram(
+    "vendor_matching_stage_seconds",
+    "Time spent in each stage of handling a webhook call.",
+    ["stage"],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+SIGNATURE_SECONDS = STAGE_SECONDS.labels("signature")
+PARSE_SECONDS = STAGE_SECONDS.labels("parse")
+TREE_LOOKUP_SECONDS = STAGE_SECONDS.labels("tree_lookup")
+MATCH_SECONDS = STAGE_SECONDS.labels("match")
+SQL_SECONDS = STAGE_SECONDS.labels("sql")
+SERIALIZE_SECONDS = STAGE_SECONDS.labels("serialize")
+
+MATCH_CANDIDATES = Histogram(
+    "vendor_matching_candidates",
+    "Number of vendors offered per lookup.",
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100),
+)
+
+VENDORS_NOT_FOUND = Counter(
+    "vendor_matching_vendors_not_found", 'Lookups answered with "Vendor not found.".'
+)
+
+
+def latest_metrics() -> bytes:
+    """The metrics in the Prometheus text format, served on /metrics by the applications.
+
+    With PROMETHEUS_MULTIPROC_DIR set, e.g. for the pre-forked workers, the processes
+    write their samples to files there, and the metrics of all of them are served
+    added up, whichever process answers. The circuit breaker state, an Enum, is left
+    out then, prometheus_client does not support it across processes."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
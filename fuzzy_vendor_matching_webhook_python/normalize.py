@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Normalization of vendor names, addresses and VAT IDs, applied alike to the
+vendors at import time and to the inputs of a lookup.
+
+Normalized texts are upper case ASCII words separated by single spaces, with
+umlauts and ß spelled out (Müller -> MUELLER) and accents dropped. Punctuation
+is dropped too, which pg_trgm ignores anyway."""
+import re
+import unicodedata
+from typing import Optional, Tuple
+
+# Legal forms dropped from the end of normalized names, as normalized words
+LEGAL_FORMS = [
+    ("GMBH", "CO", "KGAA"),
+    ("GMBH", "CO", "KG"),
+    ("GMBH", "CO", "OHG"),
+    ("AG", "CO", "KG"),
+    ("UG", "HAFTUNGSBESCHRAENKT"),
+    ("GMBH",),
+    ("MBH",),
+    ("AG",),
+    ("KG",),
+    ("KGAA",),
+    ("OHG",),
+    ("GBR",),
+    ("UG",),
+    ("SE",),
+    ("E", "K"),
+    ("E", "KFM"),
+    ("E", "V"),
+    ("LTD",),
+    ("LIMITED",),
+    ("PLC",),
+    ("INC",),
+    ("LLC",),
+    ("CORP",),
+    ("SA",),
+    ("SARL",),
+    ("SRL",),
+    ("BV",),
+    ("NV",),
+]
+
+SPELLED_OUT = str.maketrans(
+    {"ä": "ae", "ö": "oe", "ü": "ue", "Ä": "AE", "Ö": "OE", "Ü": "UE", "ß": "ss", "ẞ": "SS"}
+)
+NON_WORD_RE = re.compile(r"[\W_]+")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def fold(text: Optional[str]) -> str:
+    """Upper case ASCII words of a text, see the module docstring."""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", text.translate(SPELLED_OUT))
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return NON_WORD_RE.sub(" ", text).upper().strip()
+
+
+def normalize_name(name: Optional[str]) -> str:
+    """Fold a company name and drop its legal forms, unless the name is nothing else."""
+    words = fold(name).split()
+    stripped = True
+    while stripped:
+        stripped = False
+        for legal_form in LEGAL_FORMS:
+            if len(words) > len(legal_form) and tuple(words[-len(legal_form) :]) == legal_form:
+                del words[-len(legal_form) :]
+                stripped = True
+                break
+    return " ".join(words)
+
+
+def normalize_address(*parts: Optional[str]) -> str:
+    """Fold the parts of an address into a single line."""
+    return " ".join(folded for folded in map(fold, parts) if folded)
+
+
+def normalize_vat_id(vat_id: Optional[str]) -> str:
+    """Drop the whitespace of a VAT ID, e.g. "DE 123 456 789" -> "DE123456789"."""
+    return WHITESPACE_RE.sub("", vat_id or "").upper()
+
+
+def normalize_lookup(
+    vat_id: Optional[str], name: Optional[str], address: Optional[str]
+) -> Tuple[str, str, str]:
+    """Normalize the VAT ID, name and address of a lookup like the vendors are at import time."""
+    return normalize_vat_id(vat_id), normalize_name(name), normalize_address(address)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Serve the webhook from pre-forked gunicorn worker processes.
+
+The application and the vendor matcher, including the vendor index of the
+"memory" backend, are created once in the parent process. The workers forked
+from it share that memory copy-on-write instead of each loading a copy of
+their own; gc.freeze() keeps the garbage collector from writing to the shared
+objects and so copying their pages.
+
+Each worker has metrics of its own. For /metrics to serve those of all the workers,
+set PROMETHEUS_MULTIPROC_DIR to an empty directory the workers write them to."""
+import argparse
+import gc
+import logging
+import os
+import time
+from typing import Dict
+
+from gunicorn.app.base import BaseApplication
+from prometheus_client import multiprocess
+
+from fuzzy_vendor_matching_webhook_python import config
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import db
+from fuzzy_vendor_matching_webhook_python.matching import get_matcher
+
+started_at = time.monotonic()
+
+
+def default_workers() -> int:
+    """One worker per core available to the process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def memory_usage() -> Dict[str, int]:
+    """Resident ("rss"), proportional ("pss") and shared ("shared") memory of the
+    process in kB. The shared pages of pre-forked workers count fully towards the
+    RSS of each of them, but only by their share towards the PSS."""
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as smaps:
+            for line in smaps:
+                key, value = line.split(":", 1)
+                if key in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty"):
+                    usage[key] = int(value.split()[0])
+    except OSError:
+        import resource
+
+        return {"rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    return {
+        "rss": usage["Rss"],
+        "pss": usage["Pss"],
+        "shared": usage["Shared_Clean"] + usage["Shared_Dirty"],
+    }
+
+
+def format_memory_usage(usage: Dict[str, int]) -> str:
+    return ", ".join(f"{key.upper()} {value / 1024:.1f} MB" for key, value in usage.items())
+
+
+def preload():
+    """Create the application and the vendor matcher, to be inherited by the workers."""
+    from fuzzy_vendor_matching_webhook_python.app import app
+
+    if config.VENDOR_MATCHER != "sql" or config.MATCH_CACHE_SIZE > 0:
+        start = time.monotonic()
+        get_matcher()
+        logging.info(
+            "Created the %r vendor matcher in %.2f s",
+            config.VENDOR_MATCHER,
+            time.monotonic() - start,
+        )
+    # every worker opens its own connections
+    db.close()
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    return app
+
+
+def when_ready(server):
+    server.log.info(
+        "Started in %.2f s, %s", time.monotonic() - started_at, format_memory_usage(memory_usage())
+    )
+
+
+def post_worker_init(worker):
+    worker.log.info("Worker %s started, %s", worker.pid, format_memory_usage(memory_usage()))
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def clear_metrics_directory():
+    """Remove the metrics a previous run left in PROMETHEUS_MULTIPROC_DIR, or warn that
+    /metrics serves those of one worker at a time when it is not set."""
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not directory:
+        logging.warning(
+            "PROMETHEUS_MULTIPROC_DIR is not set, /metrics serves the metrics of one worker"
+        )
+        return
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".db"):
+            os.remove(entry.path)
+
+
+class PreforkApplication(BaseApplication):
+    """gunicorn running the webhook with the application preloaded in the parent."""
+
+    def __init__(self, options: Dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return preload()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serve the vendor matching webhook.")
+    parser.add_argument("--bind", default=os.getenv("BIND", "0.0.0.0:5000"))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("WEB_CONCURRENCY", "0")) or default_workers(),
+        help="worker processes, one per available core by default",
+    )
+    parser.add_argument("--threads", type=int, default=int(os.getenv("THREADS", "1")))
+    args = parser.parse_args()
+    clear_metrics_directory()
+    PreforkApplication(
+        {
+            "bind": args.bind,
+            "workers": args.workers,
+            "threads": args.threads,
+            "preload_app": True,
+            "when_ready": when_ready,
+            "post_worker_init": post_worker_init,
+            "child_exit": child_exit,
+        }
+    ).run()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""JSON encoding of webhook responses, with orjson when selected by JSON_SERIALIZER
+and installed, the standard library json otherwise.
+
+With orjson, the options of the vendor enum are encoded once per vendor and embedded
+in the responses as they are, rather than escaped again on every call. Responses are
+built of plain values either way."""
+import json
+import logging
+from functools import lru_cache
+from typing import Any
+
+from fuzzy_vendor_matching_webhook_python import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_SERIALIZERS = ("orjson", "json")
+
+# Vendor options kept encoded, about 100 bytes each
+OPTION_CACHE_SIZE = 100_000
+
+
+def use_orjson(serializer: str) -> bool:
+    """Whether to encode with orjson, which needs orjson.Fragment of orjson 3.9 or later."""
+    if serializer not in JSON_SERIALIZERS:
+        raise ValueError(f"Unknown JSON serializer {serializer!r}")
+    if serializer == "json":
+        return False
+    if orjson is None or not hasattr(orjson, "Fragment"):
+        logging.warning("orjson 3.9 or later is not installed, falling back to json")
+        return False
+    return True
+
+
+USE_ORJSON = use_orjson(config.JSON_SERIALIZER)
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode a response body. With orjson, the options of its operations are embedded
+    as encoded by encoded_option."""
+    if USE_ORJSON:
+        return orjson.dumps(with_encoded_options(obj))
+    return json.dumps(obj).encode()
+
+
+def with_encoded_options(obj: Any) -> Any:
+    """A webhook response with the vendor options of its operations replaced by their
+    encoded_option, copying just the containers on the way to them."""
+    if not (isinstance(obj, dict) and obj.get("operations")):
+        return obj
+    operations = []
+    for operation in obj["operations"]:
+        value = operation.get("value")
+        if isinstance(value, dict) and "options" in value:
+            options = [
+                encoded_option(option["value"], option["label"]) for option in value["options"]
+            ]
+            operation = {**operation, "value": {**value, "options": options}}
+        operations.append(operation)
+    return {**obj, "operations": operations}
+
+
+@lru_cache(maxsize=OPTION_CACHE_SIZE)
+def encoded_option(value: str, label: str) -> "orjson.Fragment":
+    """A vendor option encoded with orjson, once per vendor."""
+    return orjson.Fragment(orjson.dumps({"value": value, "label": label}))
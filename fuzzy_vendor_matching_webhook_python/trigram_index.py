@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""In-process vendor matching over trigram posting lists.
+
+Trigrams are extracted the way pg_trgm does it, and similarities are computed
+in single precision like pg_trgm does, so that the `%` threshold admits the
+same vendors as the SQL backend.
+
+The index can be saved to a file and memory-mapped from it, see
+InMemoryVendorMatcher.from_index_file. To build the file ahead of time, run
+
+    python -m fuzzy_vendor_matching_webhook_python.trigram_index INDEX_FILE
+"""
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+from contextlib import contextmanager
+from itertools import chain
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where index files are built without a lock
+    fcntl = None
+
+from fuzzy_vendor_matching_webhook_python import config
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import (
+    db,
+    db_vendor_data_version,
+    NAME_SEARCH_EXPRESSION,
+    ADDRESS_SEARCH_EXPRESSION,
+    VAT_ID_SEARCH_EXPRESSION,
+    LABEL_EXPRESSION,
+)
+from fuzzy_vendor_matching_webhook_python.matching import (
+    ALL_VENDORS,
+    match_adaptively,
+    unique_vat_id_hit,
+    VendorMatcher,
+    VendorScope,
+)
+
+WORD_RE = re.compile(r"[^\W_]+")
+
+# Code of a NULL value of a coded column, and of a value no vendor has, see encode
+NULL_CODE = -1
+UNKNOWN_CODE = -2
+
+# VAT ID code of vendors without a VAT ID, and of a VAT ID no vendor has
+NO_VAT_ID = NULL_CODE
+UNKNOWN_VAT_ID = UNKNOWN_CODE
+
+# Arrays of TrigramPostings and StringTable, in the order of their constructor arguments
+POSTINGS_ARRAYS = ("keys", "offsets", "postings", "lengths")
+STRING_TABLE_ARRAYS = ("data", "offsets", "nulls")
+
+# Start of an index file, followed by the length of its JSON header, the header and
+# the arrays, each aligned to ALIGNMENT bytes from the end of the header
+INDEX_MAGIC = b"VNDRIDX2"
+ALIGNMENT = 64
+# Permissions of an index file, readable by the processes of other users serving it
+INDEX_FILE_MODE = 0o644
+
+
+def trigrams(text: str) -> Set[str]:
+    """Trigrams of the lower-cased alphanumeric words of a text, each word padded
+    with two spaces in front and one behind."""
+    result = set()
+    for word in WORD_RE.findall(text.lower()):
+        padded = f"  {word} "
+        result.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def trigram_keys(text: str) -> np.ndarray:
+    """Sorted trigrams of a text, each packed losslessly into an integer."""
+    keys = sorted((ord(a) << 42) | (ord(b) << 21) | ord(c) for a, b, c in trigrams(text))
+    return np.array(keys, dtype=np.uint64)
+
+
+class TrigramPostings:
+    """Posting lists from trigram to the vendors having it in one of their texts.
+
+    All posting lists are stored back to back in one array, `offsets` point
+    at the list of each trigram in sorted `keys`."""
+
+    def __init__(self, keys: np.ndarray, offsets: np.ndarray, postings: np.ndarray, lengths):
+        self.keys = keys
+        self.offsets = offsets
+        self.postings = postings
+        # number of distinct trigrams of each vendor's text
+        self.lengths = lengths
+
+    @classmethod
+    def build(cls, texts: Sequence[str]) -> "TrigramPostings":
+        keys_per_text = [trigram_keys(text) for text in texts]
+        lengths = np.array([len(keys) for keys in keys_per_text], dtype=np.int32)
+        flat_keys = np.fromiter(chain.from_iterable(keys_per_text), np.uint64, int(lengths.sum()))
+        flat_postings = np.repeat(np.arange(len(texts), dtype=np.int32), lengths)
+        # a stable sort keeps each posting list in ascending vendor order
+        order = np.argsort(flat_keys, kind="stable")
+        keys, starts = np.unique(flat_keys[order], return_index=True)
+        offsets = np.append(starts, len(order)).astype(np.int64)
+        return cls(keys, offsets, flat_postings[order], lengths)
+
+    def search(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return vendors sharing a trigram with the text, in ascending order,
+        and the pg_trgm similarity of their text to it."""
+        query = trigram_keys(text)
+        positions = np.searchsorted(self.keys, query)
+        inside = positions < len(self.keys)
+        positions = positions[inside][self.keys[positions[inside]] == query[inside]]
+        if not positions.size:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        vendors, common = np.unique(
+            np.concatenate(
+                [self.postings[self.offsets[p] : self.offsets[p + 1]] for p in positions]
+            ),
+            return_counts=True,
+        )
+        union = len(query) + self.lengths[vendors] - common
+        return vendors, common.astype(np.float32) / union.astype(np.float32)
+
+
+class StringTable:
+    """Strings stored back to back as UTF-8 in one array, `offsets` point at each
+    of them. None is stored as an empty string flagged in `nulls`."""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray, nulls: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls
+
+    @classmethod
+    def build(cls, strings: Sequence[Optional[str]]) -> "StringTable":
+        encoded = [b"" if string is None else string.encode() for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        nulls = np.array([string is None for string in strings], dtype=np.bool_)
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, nulls)
+
+    def __len__(self) -> int:
+        return len(self.nulls)
+
+    def __getitem__(self, index: int) -> Optional[str]:
+        if self.nulls[index]:
+            return None
+        return self.data[self.offsets[index] : self.offsets[index + 1]].tobytes().decode()
+
+
+def encode(values: Sequence[Optional[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorted distinct values of a column as bytes, and the code of each value of the
+    column, its position among them or NULL_CODE for None."""
+    table = sorted({value.encode() for value in values if value is not None})
+    codes = {value: code for code, value in enumerate(table)}
+    return (
+        np.array(table, dtype=np.bytes_),
+        np.array(
+            [NULL_CODE if value is None else codes[value.encode()] for value in values],
+            dtype=np.int32,
+        ),
+    )
+
+
+def code_of(table: np.ndarray, value: str) -> int:
+    """Code of a value in the table made by encode, UNKNOWN_CODE if not in it."""
+    key = value.encode()
+    position = int(np.searchsorted(table, key))
+    if position < len(table) and table[position] == key:
+        return position
+    return UNKNOWN_CODE
+
+
+def write_arrays(filename: str, arrays: Dict[str, np.ndarray], version: int):
+    """Write named arrays to an index file, see read_arrays. The file is replaced
+    atomically, so that processes reading the old one keep a consistent view."""
+    header = {"version": version, "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(INDEX_MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+        try:
+            file.write(INDEX_MAGIC + struct.pack("<Q", len(header_bytes)) + header_bytes)
+            for name, array in arrays.items():
+                file.seek(data_start + header["arrays"][name]["offset"])
+                file.write(np.ascontiguousarray(array).tobytes())
+            file.truncate(data_start + offset)
+            os.chmod(file.name, INDEX_FILE_MODE)
+        except BaseException:
+            os.remove(file.name)
+            raise
+    os.replace(file.name, filename)
+
+
+@contextmanager
+def index_file_lock(filename: str):
+    """Hold an exclusive lock on the lock file next to an index file, for one process
+    or thread at a time to build it."""
+    with open(filename + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # closing the file releases the lock
+        yield
+
+
+def read_index_file(filename: str) -> Tuple[Optional[Dict[str, np.ndarray]], Optional[int]]:
+    """read_arrays of an index file, (None, None) when missing or unreadable."""
+    try:
+        return read_arrays(filename)
+    except (OSError, ValueError):
+        return None, None
+
+
+def read_arrays(filename: str) -> Tuple[Dict[str, np.ndarray], int]:
+    """Map an index file into memory and return its arrays, backed by the mapping
+    without copying, along with the vendor data version it was built from."""
+    with open(filename, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapping[: len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise ValueError(f"{filename} is not a vendor index file")
+    (header_length,) = struct.unpack_from("<Q", mapping, len(INDEX_MAGIC))
+    header_start = len(INDEX_MAGIC) + 8
+    header = json.loads(mapping[header_start : header_start + header_length])
+    data_start = -(-(header_start + header_length) // ALIGNMENT) * ALIGNMENT
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype, shape = np.dtype(spec["dtype"]), tuple(spec["shape"])
+        arrays[name] = np.frombuffer(
+            mapping, dtype, int(np.prod(shape)), data_start + spec["offset"]
+        ).reshape(shape)
+    return arrays, header["version"]
+
+
+class InMemoryVendorMatcher(VendorMatcher):
+    """Matches vendors against trigram posting lists held in process memory,
+    with the semantics of the SQL backend.
+
+    All its data are arrays, which can be saved to an index file and mapped
+    into memory from it, see from_index_file."""
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.names = TrigramPostings(*(arrays[f"names.{key}"] for key in POSTINGS_ARRAYS))
+        self.addresses = TrigramPostings(*(arrays[f"addresses.{key}"] for key in POSTINGS_ARRAYS))
+        self.taxids = StringTable(*(arrays[f"taxids.{key}"] for key in STRING_TABLE_ARRAYS))
+        self.labels = StringTable(*(arrays[f"labels.{key}"] for key in STRING_TABLE_ARRAYS))
+        # sorted distinct VAT IDs, the VAT ID code of a vendor is the position of its VAT ID
+        self.vat_id_table = arrays["vat_id_table"]
+        self.vendor_vat_id_codes = arrays["vendor_vat_id_codes"]
+        # number of vendors having each VAT ID and one of them, for the exact VAT ID lookup
+        self.vat_id_counts = arrays["vat_id_counts"]
+        self.vat_id_vendors = arrays["vat_id_vendors"]
+        # sorted distinct countries and vendor files and their codes, for scoped lookups
+        self.country_table = arrays["country_table"]
+        self.vendor_country_codes = arrays["vendor_country_codes"]
+        self.file_id_table = arrays["file_id_table"]
+        self.vendor_file_id_codes = arrays["vendor_file_id_codes"]
+        # tie breaker of the ranking, the position of each vendor ordered by id
+        self.id_ranks = arrays["id_ranks"]
+        self.arrays = arrays
+
+    @classmethod
+    def build(
+        cls,
+        ids: Sequence[str],
+        names: Sequence[str],
+        addresses: Sequence[str],
+        vat_ids: Sequence[Optional[str]],
+        taxids: Sequence[Optional[str]],
+        labels: Sequence[str],
+        countries: Sequence[str],
+        file_ids: Sequence[Optional[str]],
+    ) -> "InMemoryVendorMatcher":
+        """Build the matcher from the vendor columns. `names`, `addresses` and `vat_ids`
+        are the normalized search columns, `taxids` the VAT IDs returned with the labels,
+        `countries` and `file_ids` the columns lookups are scoped by."""
+        arrays = {}
+        for prefix, texts in (("names", names), ("addresses", addresses)):
+            postings = TrigramPostings.build(texts)
+            arrays.update({f"{prefix}.{key}": getattr(postings, key) for key in POSTINGS_ARRAYS})
+        for prefix, strings in (("taxids", taxids), ("labels", labels)):
+            table = StringTable.build(strings)
+            arrays.update({f"{prefix}.{key}": getattr(table, key) for key in STRING_TABLE_ARRAYS})
+
+        vat_id_table, vendor_vat_id_codes = encode(vat_ids)
+        has_vat_id = np.flatnonzero(vendor_vat_id_codes >= 0)
+        vat_id_vendors = np.empty(len(vat_id_table), dtype=np.int32)
+        vat_id_vendors[vendor_vat_id_codes[has_vat_id]] = has_vat_id
+        # ids in code point order, like matching.ID_ORDER sorts them
+        id_ranks = np.empty(len(ids), dtype=np.int32)
+        id_ranks[sorted(range(len(ids)), key=ids.__getitem__)] = np.arange(len(ids))
+        country_table, vendor_country_codes = encode(countries)
+        file_id_table, vendor_file_id_codes = encode(file_ids)
+        arrays.update(
+            vat_id_table=vat_id_table,
+            vendor_vat_id_codes=vendor_vat_id_codes,
+            vat_id_counts=np.bincount(vendor_vat_id_codes[has_vat_id], minlength=len(vat_id_table)),
+            vat_id_vendors=vat_id_vendors,
+            country_table=country_table,
+            vendor_country_codes=vendor_country_codes,
+            file_id_table=file_id_table,
+            vendor_file_id_codes=vendor_file_id_codes,
+            id_ranks=id_ranks,
+        )
+        return cls(arrays)
+
+    @classmethod
+    def from_database(cls) -> "InMemoryVendorMatcher":
+        """Build the matcher from the vendor table, with the search texts the SQL backend uses."""
+        rows = db.execute_and_fetchall(
+            f"""SELECT id, {NAME_SEARCH_EXPRESSION}, {ADDRESS_SEARCH_EXPRESSION},
+                    {VAT_ID_SEARCH_EXPRESSION}, taxid1, {LABEL_EXPRESSION}, country, file_id
+                FROM vendor_data"""
+        )
+        return cls.build(*(zip(*rows) if rows else ([],) * 8))
+
+    @classmethod
+    def from_index_file(cls, filename: str) -> "InMemoryVendorMatcher":
+        """Map the matcher from an index file into memory, after building the file
+        from the vendor table unless it is up to date. The processes mapping the same
+        file share its pages, and mapping it takes no time regardless of its size.
+        Of the processes finding the file out of date, one builds it while the
+        others wait for it, see index_file_lock."""
+        version = db_vendor_data_version()
+        arrays, file_version = read_index_file(filename)
+        if file_version != version:
+            with index_file_lock(filename):
+                # built by another process or thread while waiting for the lock
+                arrays, file_version = read_index_file(filename)
+                if file_version != version:
+                    cls.from_database().save(filename, version)
+                    arrays, _ = read_arrays(filename)
+        return cls(arrays)
+
+    def save(self, filename: str, version: int):
+        """Write the matcher to an index file built from the given vendor data version."""
+        write_arrays(filename, self.arrays, version)
+
+    def vat_id_code(self, vat_id: str) -> int:
+        """Position of a VAT ID in the VAT ID table, UNKNOWN_VAT_ID if no vendor has it."""
+        return code_of(self.vat_id_table, vat_id)
+
+    def scope_mask(self, scope: VendorScope) -> Optional[np.ndarray]:
+        """Which vendors are within the scope, None when all are."""
+        mask = None
+        for value, table, codes in (
+            (scope.country, self.country_table, self.vendor_country_codes),
+            (scope.file_id, self.file_id_table, self.vendor_file_id_codes),
+        ):
+            if value:
+                within = codes == code_of(table, value)
+                mask = within if mask is None else mask & within
+        return mask
+
+    def match(
+        self,
+        vat_id: str,
+        name: str,
+        address: str,
+        limit: int,
+        scope: VendorScope = ALL_VENDORS,
+        threshold: Optional[float] = None,
+    ) -> List[Tuple[str, str]]:
+        """See VendorMatcher.match, at the given similarity `threshold` rather than
+        the configured, possibly adaptive one when given."""
+        if not (vat_id or name or address):
+            return []
+        in_scope = self.scope_mask(scope)
+        vat_id_code = self.vat_id_code(vat_id) if vat_id else NO_VAT_ID
+        if vat_id:
+            hits, vendor = 0, None
+            if vat_id_code >= 0 and in_scope is None:
+                hits, vendor = self.vat_id_counts[vat_id_code], self.vat_id_vendors[vat_id_code]
+            elif vat_id_code >= 0:
+                found = np.flatnonzero((self.vendor_vat_id_codes == vat_id_code) & in_scope)
+                hits, vendor = len(found), found[0] if len(found) else None
+            if unique_vat_id_hit(int(hits)):
+                return [(self.taxids[vendor], self.labels[vendor])]
+
+        def rank(threshold: float) -> List[Tuple[str, str]]:
+            return self._rank(vat_id, vat_id_code, name, address, limit, in_scope, threshold)
+
+        if threshold is not None:
+            return rank(threshold)
+        return match_adaptively(rank, name, address, limit)
+
+    def _rank(
+        self,
+        vat_id: str,
+        vat_id_code: int,
+        name: str,
+        address: str,
+        limit: int,
+        in_scope: Optional[np.ndarray],
+        threshold: float,
+    ) -> List[Tuple[str, str]]:
+        """The fuzzy search of match, at a similarity threshold."""
+        vendors = None
+        # distance of each candidate to the name and address, 1 for inputs not given
+        distances = []
+        for text, postings in ((name, self.names), (address, self.addresses)):
+            if not text:
+                continue
+            found, similarities = postings.search(text)
+            # compare in double precision like pg_trgm does
+            similar = similarities.astype(np.float64) >= threshold
+            found, distance = found[similar], 1 - similarities[similar]
+            if vendors is None:
+                vendors = found
+            else:
+                vendors, kept, kept_found = np.intersect1d(
+                    vendors, found, assume_unique=True, return_indices=True
+                )
+                distances = [d[kept] for d in distances]
+                distance = distance[kept_found]
+            distances.append(distance)
+
+        if vat_id:
+            if vendors is None:
+                vendors = np.flatnonzero(
+                    np.isin(self.vendor_vat_id_codes, (NO_VAT_ID, vat_id_code))
+                ).astype(np.int32)
+            else:
+                same_vat_id = np.isin(self.vendor_vat_id_codes[vendors], (NO_VAT_ID, vat_id_code))
+                vendors = vendors[same_vat_id]
+                distances = [d[same_vat_id] for d in distances]
+        if vendors is None:
+            vendors = np.arange(len(self.labels), dtype=np.int32)
+        if in_scope is not None:
+            within = in_scope[vendors]
+            vendors = vendors[within]
+            distances = [d[within] for d in distances]
+
+        # the distance match_vendor_query ranks by, summed in single precision like there
+        distance = np.zeros(len(vendors), dtype=np.float32)
+        for input_distance in distances:
+            distance += input_distance
+        if vat_id:
+            distance += self.vendor_vat_id_codes[vendors] != vat_id_code
+        ranking = np.lexsort((self.id_ranks[vendors], distance))
+        return [(self.taxids[v], self.labels[v]) for v in vendors[ranking[:limit]]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the vendor index file.")
+    parser.add_argument("filename")
+    args = parser.parse_args()
+    InMemoryVendorMatcher.from_index_file(args.filename)
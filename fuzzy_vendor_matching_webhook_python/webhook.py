@@ -4,103 +4,292 @@
 """A vendor matching Python webhook implemented using Flask."""
 import hashlib
 import hmac
+import json
+import time
 from functools import wraps
-from typing import List, Dict
+from itertools import chain, islice
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple
 
-from flask import request, jsonify
+from flask import Response, g, request, stream_with_context
+from psycopg2.extensions import QueryCanceledError
 from werkzeug.exceptions import abort
 
-from fuzzy_vendor_matching_webhook_python.config import SECRET_KEY
+from database.database import DatabaseUnavailable, DeadlineExceeded
+from fuzzy_vendor_matching_webhook_python.batch import check_vendors, match_batch
+from fuzzy_vendor_matching_webhook_python.config import (
+    MAX_VENDOR_OPTIONS,
+    REQUEST_DEADLINE,
+    SECRET_KEY,
+)
 from fuzzy_vendor_matching_webhook_python.import_vendor_data import db
+from fuzzy_vendor_matching_webhook_python.matching import (
+    ALL_VENDORS,
+    get_matcher,
+    MatchDeadlineExceeded,
+    VendorScope,
+)
+from fuzzy_vendor_matching_webhook_python.metrics import (
+    MATCH_CANDIDATES,
+    MATCH_DEADLINES_EXCEEDED,
+    MATCH_SECONDS,
+    PARSE_SECONDS,
+    SERIALIZE_SECONDS,
+    SHORT_CIRCUITED_CALLS,
+    SIGNATURE_SECONDS,
+    TREE_LOOKUP_SECONDS,
+    VENDORS_NOT_FOUND,
+)
+from fuzzy_vendor_matching_webhook_python.normalize import normalize_lookup
+from fuzzy_vendor_matching_webhook_python.serialization import dumps
+
+# Datapoints match_vendor reads from the annotation
+MATCHED_SCHEMA_IDS = ("vendor_match", "vendor_vat_id", "sender_name", "sender_address")
+
+# Bytes of the request body read and hashed at once
+BODY_CHUNK_SIZE = 64 * 1024
+
+# Stands in for the annotation nodes match_vendor does not read, read-only as it is
+# shared by all of them
+PRUNED_NODE = MappingProxyType({"id": None, "schema_id": None})
+
+
+class VendorLookup(NamedTuple):
+    """The vendor enum datapoint of an annotation and the normalized inputs to match vendors by."""
+
+    vendor: Dict
+    vat_id: str
+    name: str
+    address: str
+
+
+def body_hmac():
+    """A new HMAC of a request body, to be updated as the body streams in."""
+    return hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha1)
+
+
+def check_signature(body_mac, signature_header: str) -> Optional[str]:
+    """Return why the X-Elis-Signature header is not a valid signature of the body
+    hashed by body_mac, or None if it is."""
+    digest = body_mac.hexdigest()
+    try:
+        prefix, signature = signature_header.split("=")
+    except ValueError:
+        return "Incorrect header format"
+    if not (prefix == "sha1" and hmac.compare_digest(signature, digest)):
+        return "Authorization failed."
+    return None
+
+
+def read_signed_body(stream, chunk_size: int = BODY_CHUNK_SIZE) -> Tuple[bytearray, hmac.HMAC]:
+    """Read a request body, hashing each chunk as it arrives rather than the whole
+    body once read. The chunks are collected in a single buffer."""
+    body = bytearray()
+    body_mac = body_hmac()
+    hashing = 0.0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        body += chunk
+        start = time.perf_counter()
+        body_mac.update(chunk)
+        hashing += time.perf_counter() - start
+    SIGNATURE_SECONDS.observe(hashing)
+    return body, body_mac
 
 
 def hmac_signature_required(f):
     @wraps(f)
     def authorize_request(*args, **kwargs):
-        """Verify the validity of the request coming from Rossum."""
-        digest = hmac.new(SECRET_KEY.encode(), request.data, hashlib.sha1).hexdigest()
-        try:
-            prefix, signature = request.headers["X-Elis-Signature"].split("=")
-        except ValueError:
-            abort(401, "Incorrect header format")
-        if not (prefix == "sha1" and hmac.compare_digest(signature, digest)):
-            abort(401, "Authorization failed.")
+        """Verify the validity of the request coming from Rossum. The body is left
+        in g.request_body for the view to parse."""
+        body, body_mac = read_signed_body(request.stream)
+        error = check_signature(body_mac, request.headers.get("X-Elis-Signature", ""))
+        if error:
+            abort(401, error)
+        g.request_body = body
         return f(*args, **kwargs)
 
     return authorize_request
 
 
+def prune_node(obj: Dict) -> Mapping:
+    """Replace annotation nodes match_vendor does not read, and sections of only such
+    nodes, by PRUNED_NODE as soon as they are parsed, so that e.g. big line item
+    tables are dropped while parsing rather than kept for the whole request.
+
+    This trades parse time for memory: benchmarks/bench_annotation_tree.py parses
+    annotations in about 1.7 times the time of json.loads, at a peak of about the
+    size of the body rather than 7 times it."""
+    schema_id = obj.get("schema_id")
+    if schema_id is None or schema_id in MATCHED_SCHEMA_IDS:
+        return obj
+    if any(child is not PRUNED_NODE for child in obj.get("children", ())):
+        return obj
+    return PRUNED_NODE
+
+
+ANNOTATION_DECODER = json.JSONDecoder(object_hook=prune_node)
+
+
+def parse_json(body: bytes, decoder: json.JSONDecoder = ANNOTATION_DECODER):
+    """Parse a JSON request body, by default pruned of the nodes match_vendor does not read."""
+    with PARSE_SECONDS.time():
+        return decoder.decode(body.decode(json.detect_encoding(body)))
+
+
+def parse_request_body(decoder: json.JSONDecoder = ANNOTATION_DECODER):
+    """Parse the JSON body read by hmac_signature_required, see parse_json."""
+    try:
+        return parse_json(g.request_body, decoder)
+    except ValueError:
+        abort(400, "Invalid JSON.")
+
+
+def index_by_schema_id(annotation_tree: List[Dict], schema_ids: Iterable[str]) -> Dict[str, Dict]:
+    """Find the first node of each given id (as specified in schema) in the annotation tree.
+
+    The tree is walked once, depth first, and the walk stops as soon as all the
+    ids are found. Ids not present in the tree are missing from the result."""
+    wanted = set(schema_ids)
+    nodes = {}
+    # iterators over the children of the nodes on the path to the current node
+    stack = [iter(annotation_tree)]
+    while stack:
+        for node in stack[-1]:
+            schema_id = node["schema_id"]
+            if schema_id in wanted and schema_id not in nodes:
+                nodes[schema_id] = node
+                if len(nodes) == len(wanted):
+                    return nodes
+            if "children" in node:
+                stack.append(iter(node["children"]))
+                break
+        else:
+            stack.pop()
+    return nodes
+
+
 def find_by_schema_id(annotation_tree: List[Dict], schema_id: str):
     """Find a node with a given id (as specified in schema) in the annotation tree."""
-    for node in annotation_tree:
-        if node["schema_id"] == schema_id:
-            return node
-        elif "children" in node:
-            node = find_by_schema_id(node["children"], schema_id)
-            if node is not None:
-                return node
-    return None
+    return index_by_schema_id(annotation_tree, [schema_id]).get(schema_id)
+
+
+def vendor_scope(settings: Optional[Dict]) -> VendorScope:
+    """The vendors to match, restricted by the "country" and "file_id" of the hook
+    settings when given, e.g. {"country": "DE"} for a queue of German invoices.
+    Raise ValueError unless the settings are an object with string fields."""
+    settings = settings or {}
+    if not isinstance(settings, dict):
+        raise ValueError("The hook settings must be an object")
+    country, file_id = settings.get("country") or "", settings.get("file_id") or ""
+    if not (isinstance(country, str) and isinstance(file_id, str)):
+        raise ValueError('"country" and "file_id" of the hook settings must be strings')
+    return VendorScope(country=country.strip().upper(), file_id=file_id.strip())
 
 
-def match_vendor(annotation_tree: List[dict], updated_datapoints: List[int], action: str):
+def request_scope(payload: Dict) -> VendorScope:
+    """The vendor_scope of the settings of a request, aborting it with 400 when invalid."""
+    if not isinstance(payload, dict):
+        abort(400, "The request body must be an object")
+    try:
+        return vendor_scope(payload.get("settings"))
+    except ValueError as error:
+        abort(400, str(error))
+
+
+def match_vendor(
+    annotation_tree: List[dict],
+    updated_datapoints: List[int],
+    action: str,
+    scope: VendorScope = ALL_VENDORS,
+):
     """Vendor matching based on vendor name.
 
     How it works: vendor_name contains the name of the vendor to be matched.
     This pre-populates a vendor enum by (even partially) matching vendors
     in the database, to let the user make a final pick in case of ambiguity.
+    Only the vendors within `scope` are matched.
+    At most MAX_VENDOR_OPTIONS candidates are offered, best match first.
     It is possible to match also based on vendor's address or VAT ID. In the
     exported data, the matched value holds the vendor id (not the label).
 
     In case no vendor is matched, "---" is pre-populated in the enum
-    and an error is displayed."""
-
-    vendor = find_by_schema_id(annotation_tree, "vendor_match")
-    vendor_vat_id = find_by_schema_id(annotation_tree, "vendor_vat_id")
-    vendor_vat_id_norm = vendor_vat_id["content"]["value"].replace(" ", "")
-    vendor_name = find_by_schema_id(annotation_tree, "sender_name")
-    vendor_address = find_by_schema_id(annotation_tree, "sender_address")
-
-    results = db.execute_and_fetchall(
-        """
-        SELECT taxid1, CONCAT(name, ', ', address1, ', ', city, ' (', id, ')') AS vendor FROM vendor_data
-            WHERE (%s = '' OR (taxid1 IS NULL OR taxid1 = %s))
-                AND (%s = '' OR UPPER(name) %% UPPER(%s))
-                AND (%s = '' OR UPPER(CONCAT(address1, ' ', address2, ' ', address3, ' ', city, ' ', zipcode
-                )) %% UPPER(%s))
-        """,
-        (
-            vendor_vat_id_norm,
-            vendor_vat_id_norm,
-            vendor_name["content"]["value"],
-            vendor_name["content"]["value"],
-            vendor_address["content"]["value"],
-            vendor_address["content"]["value"],
-        ),
-    )
+    and an error is displayed. Calls updating none of the matched datapoints
+    are answered with no messages and operations, without querying the database.
+    A lookup running out of the request deadline is answered by deadline_operations."""
+
+    lookup = vendor_lookup(annotation_tree, updated_datapoints, action)
+    if lookup is None:
+        return [], []
+    if lookup.vat_id or lookup.name or lookup.address:
+        try:
+            matcher = get_matcher()
+            with MATCH_SECONDS.time():
+                results = matcher.match(
+                    lookup.vat_id, lookup.name, lookup.address, MAX_VENDOR_OPTIONS, scope
+                )
+        except MatchDeadlineExceeded as error:
+            return deadline_operations(lookup.vendor, error.results)
+        except (DeadlineExceeded, QueryCanceledError):
+            # the check of the vendor data version ran out of the deadline, in a
+            # transaction of its own already ended by get_matcher
+            return deadline_operations(lookup.vendor, [])
+    else:
+        results = []
+    return vendor_operations(lookup.vendor, results)
 
-    # Do not update the list unless we have a reason.
+
+def vendor_lookup(
+    annotation_tree: List[dict], updated_datapoints: List[int], action: str
+) -> Optional[VendorLookup]:
+    """Read the inputs of vendor matching from the annotation, or return None when
+    the call updates none of them and the vendor enum is to be left as it is."""
+    with TREE_LOOKUP_SECONDS.time():
+        nodes = index_by_schema_id(annotation_tree, MATCHED_SCHEMA_IDS)
+    vendor = nodes["vendor_match"]
+    vendor_vat_id = nodes["vendor_vat_id"]
+    vendor_name = nodes["sender_name"]
+    vendor_address = nodes["sender_address"]
+
+    # Do not update the list unless we have a reason, and in that case do not touch the database.
     if not (
         action == "initialize"
         or vendor_vat_id["id"] in updated_datapoints
         or vendor_name["id"] in updated_datapoints
         or vendor_address["id"] in updated_datapoints
     ):
-        return
+        SHORT_CIRCUITED_CALLS.inc()
+        return None
+    return VendorLookup(
+        vendor,
+        *normalize_lookup(
+            vendor_vat_id["content"]["value"],
+            vendor_name["content"]["value"],
+            vendor_address["content"]["value"],
+        ),
+    )
+
 
+def vendor_operations(vendor: Dict, results: List[Tuple[str, str]]) -> Tuple[List, List]:
+    """Messages and operations filling the vendor enum with the matched vendors."""
     messages = []
-    if results and (
-        vendor_vat_id_norm or vendor_name["content"]["value"] or vendor_address["content"]["value"]
-    ):
-        vendor_options = [{"value": id, "label": vendor} for id, vendor in results]
+    MATCH_CANDIDATES.observe(len(results))
+    if results:
+        vendor_options = [{"value": id, "label": label} for id, label in results]
+        first_value = results[0][0]
     else:
         vendor_options = [{"value": "---", "label": "---"}]
+        first_value = "---"
         messages = [{"id": vendor["id"], "type": "error", "content": "Vendor not found."}]
+        VENDORS_NOT_FOUND.inc()
     operations = [
         {
             "op": "replace",
             "id": vendor["id"],
             "value": {
-                "content": {"value": vendor_options[0]["value"]},
+                "content": {"value": first_value},
                 "options": vendor_options,
                 "validation_sources": ["connector"],
             },
@@ -109,11 +298,64 @@ def match_vendor(annotation_tree: List[dict], updated_datapoints: List[int], act
     return messages, operations
 
 
+def deadline_operations(vendor: Dict, results: List[Tuple[str, str]]) -> Tuple[List, List]:
+    """Messages and operations of a lookup that ran out of the request deadline: the
+    vendors having the VAT ID if the exact lookup found any, otherwise no operations,
+    leaving the vendor enum as it is. A warning tells the user either way."""
+    MATCH_DEADLINES_EXCEEDED.inc()
+    warning = {
+        "id": vendor["id"],
+        "type": "warning",
+        "content": "Vendor matching timed out, the vendor was not matched by name and address.",
+    }
+    if not results:
+        return [warning], []
+    messages, operations = vendor_operations(vendor, results)
+    return messages + [warning], operations
+
+
 @hmac_signature_required
 def vendor_matching():
-    """Validate vendor name."""
-    annotation_tree = request.json["annotation"]["content"]
-    updated_datapoints = request.json["updated_datapoints"]
-    action = request.json["action"]
-    messages, operations = match_vendor(annotation_tree, updated_datapoints, action)
-    return jsonify({"messages": messages, "operations": operations})
+    """Validate vendor name, within REQUEST_DEADLINE."""
+    with db.deadline(REQUEST_DEADLINE):
+        payload = parse_request_body()
+        annotation_tree = payload["annotation"]["content"]
+        updated_datapoints = payload["updated_datapoints"]
+        action = payload["action"]
+        scope = request_scope(payload)
+        messages, operations = match_vendor(annotation_tree, updated_datapoints, action, scope)
+    with SERIALIZE_SECONDS.time():
+        body = dumps({"messages": messages, "operations": operations})
+    return Response(body, mimetype="application/json")
+
+
+@hmac_signature_required
+def vendor_matching_batch():
+    """Match the vendors listed as "vendors", see batch.match_batch, within the scope
+    given by "settings" like for vendor_matching. Invalid vendors, see
+    batch.check_vendors, are answered with 400 before any is matched.
+
+    The results are streamed back as NDJSON, a line per vendor in the order of the request.
+    The first vendors are matched before the response starts, so that the request fails
+    with 503 while the database is down; a later failure ends the stream with an error line."""
+    payload = parse_request_body(json.JSONDecoder())
+    scope = request_scope(payload)
+    try:
+        vendors = check_vendors(payload.get("vendors"))
+    except ValueError as error:
+        abort(400, str(error))
+    matched = match_batch(vendors, scope)
+    first = list(islice(matched, 1))
+    return Response(
+        stream_with_context(ndjson_lines(chain(first, matched))), mimetype="application/x-ndjson"
+    )
+
+
+def ndjson_lines(vendors: Iterable[Dict]) -> Iterator[bytes]:
+    """NDJSON lines of the matched vendors, the last one an object with an "error" when
+    the database became unavailable meanwhile."""
+    try:
+        for vendor in vendors:
+            yield dumps(vendor) + b"\n"
+    except DatabaseUnavailable as error:
+        yield dumps({"error": f"Database unavailable: {error}"}) + b"\n"
@@ -38,17 +38,34 @@ setup(
         "Jinja2",
         "MarkupSafe",
         "openpyxl",
+        "prometheus_client",
         "psycopg2",
         "Werkzeug",
     ],
+    extras_require={
+        "asgi": ["asyncpg", "uvicorn"],
+        "memory": ["numpy"],
+        "orjson": ["orjson>=3.9"],
+        "prefork": ["gunicorn"],
+    },
     python_requires=">=3.6",
     setup_requires=["pytest-runner"],
-    tests_require=["pytest", "pytest-cov", "pytest-flask", "pytest-postgresql"],
+    tests_require=[
+        "asyncpg",
+        "gunicorn",
+        "numpy",
+        "orjson>=3.9",
+        "pytest",
+        "pytest-cov",
+        "pytest-flask",
+        "pytest-postgresql",
+    ],
     zip_safe=False,
     entry_points={
         "console_scripts": [
             "fuzzy_vendor_matching_webhook_python"
-            "= fuzzy_vendor_matching_webhook_python.app:entry_point"
+            "= fuzzy_vendor_matching_webhook_python.app:entry_point",
+            "fuzzy_vendor_matching_batch = fuzzy_vendor_matching_webhook_python.batch:main",
         ]
     },
 )
@@ -8,6 +8,7 @@ from typing import List
 
 from fuzzy_vendor_matching_webhook_python import create_app, config
 from fuzzy_vendor_matching_webhook_python.import_vendor_data import db_import, db_drop_vendor_data
+from fuzzy_vendor_matching_webhook_python.matching import reset_matcher
 from tests import GENERATED_SECRET_KEY, COMPANIES_FILE
 from tests.database_janitor import DatabaseJanitor
 
@@ -85,7 +86,21 @@ def app(database):
 
 
 @pytest.fixture
-def fill_vendor_data_table():
+def fill_vendor_data_table(database):
     db_import(COMPANIES_FILE)
+    reset_matcher()
     yield
     db_drop_vendor_data()
+    reset_matcher()
+
+
+@pytest.fixture
+def changed_vendor_file(tmp_path):
+    """The test vendors with one renamed, one removed and one added."""
+    with open(COMPANIES_FILE) as csvfile:
+        lines = csvfile.read().splitlines()
+    lines = [line.replace("Bosco Ltd", "Bosco Limited") for line in lines if "Roodel" not in line]
+    lines.append("9999;Newcomer AG;Street 1;;;City;;12345;DE;;FF;Retail trade;DE1;1;345")
+    vendor_file = tmp_path / "vendors.csv"
+    vendor_file.write_text("\n".join(lines) + "\n")
+    return str(vendor_file)
@@ -0,0 +1,151 @@
+import asyncio
+import json
+
+import pytest
+from prometheus_client import REGISTRY
+
+from fuzzy_vendor_matching_webhook_python import asgi, config
+from tests.conftest import create_annotation_tree, create_hashed_signature, WEBHOOK_URL
+from tests.test_webhook import DEADLINE_WARNING, post_annotation, slow_statement
+
+
+def call_asgi(body: bytes, signature: str, path="/vendor_matching", method="POST"):
+    """Run one request through the ASGI application, return its status and decoded body."""
+    sent = asgi_request(body, signature, path, method)
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+def asgi_request(body: bytes, signature: str, path: str, method: str):
+    """Run one request through the ASGI application, return the messages it sent."""
+    messages = [
+        {"type": "http.request", "body": body[:10], "more_body": True},
+        {"type": "http.request", "body": body[10:], "more_body": False},
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def request():
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "headers": [(b"x-elis-signature", signature.encode())],
+        }
+        try:
+            await asgi.app(scope, receive, send)
+        finally:
+            # the pool belongs to the event loop of this request
+            await asgi.matcher.close()
+
+    asyncio.run(request())
+    return sent
+
+
+def annotation_body(annotation_tree) -> bytes:
+    webhook_schema = {
+        "action": "initialize",
+        "updated_datapoints": [],
+        "hook": WEBHOOK_URL,
+        "annotation": {"content": annotation_tree},
+    }
+    return json.dumps(webhook_schema).encode("utf-8")
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestAsgi:
+    @pytest.mark.parametrize(
+        "annotation_tree",
+        [
+            create_annotation_tree(sender_name="Bernhard"),
+            create_annotation_tree(vendor_vat_id="DE758402667"),
+            create_annotation_tree(sender_address="Flotowstr. 65"),
+            create_annotation_tree(sender_name="Nonexistent Vendor"),
+        ],
+    )
+    def test_same_as_flask(self, client, annotation_tree):
+        body = annotation_body(annotation_tree)
+
+        status, response = call_asgi(body, f"sha1={create_hashed_signature(body)}")
+
+        assert status == 200
+        assert response == post_annotation(client, annotation_tree).json
+
+    @pytest.mark.parametrize(
+        "annotation_tree",
+        [
+            create_annotation_tree(sender_name="Bernhard Bosco"),
+            create_annotation_tree(sender_name="Schroder ano Sons International Trading"),
+        ],
+    )
+    def test_adaptive_same_as_flask(self, client, annotation_tree, monkeypatch):
+        monkeypatch.setattr(config, "ADAPTIVE_THRESHOLDS", [0.6, 0.44, 0.2])
+        body = annotation_body(annotation_tree)
+
+        status, response = call_asgi(body, f"sha1={create_hashed_signature(body)}")
+
+        assert status == 200
+        assert response == post_annotation(client, annotation_tree).json
+
+    def test_deadline(self, monkeypatch):
+        monkeypatch.setattr(config, "REQUEST_DEADLINE", 0.2)
+        monkeypatch.setattr(asgi, "match_vendor_statement", slow_statement)
+        monkeypatch.setattr(asgi.matcher, "cache", None)
+        body = annotation_body(create_annotation_tree(sender_name="Bernhard"))
+
+        status, response = call_asgi(body, f"sha1={create_hashed_signature(body)}")
+
+        assert status == 200
+        assert response == {"messages": [DEADLINE_WARNING], "operations": []}
+
+    def test_deadline_in_vendor_data_check(self, monkeypatch):
+        monkeypatch.setattr(config, "REQUEST_DEADLINE", 0.2)
+        monkeypatch.setattr(config, "VENDOR_DATA_CHECK_INTERVAL", 0)
+        monkeypatch.setattr(
+            asgi,
+            "VENDOR_DATA_VERSION_QUERY",
+            "SELECT version FROM vendor_data_version, pg_sleep(1);",
+        )
+        body = annotation_body(create_annotation_tree(sender_name="Bernhard"))
+
+        status, response = call_asgi(body, f"sha1={create_hashed_signature(body)}")
+
+        assert status == 200
+        assert response == {"messages": [DEADLINE_WARNING], "operations": []}
+
+    def test_cache_hits_not_counted_as_vat_id_lookups(self):
+        body = annotation_body(create_annotation_tree(vendor_vat_id="DE758402667"))
+        signature = f"sha1={create_hashed_signature(body)}"
+        call_asgi(body, signature)
+        before = REGISTRY.get_sample_value(
+            "vendor_matching_vat_id_lookups_total", {"result": "unique"}
+        )
+
+        call_asgi(body, signature)
+
+        assert (
+            REGISTRY.get_sample_value("vendor_matching_vat_id_lookups_total", {"result": "unique"})
+            == before
+        )
+
+    def test_invalid_signature(self):
+        body = annotation_body(create_annotation_tree(sender_name="Bernhard"))
+
+        status, response = call_asgi(body, "sha1=0000")
+
+        assert status == 401
+
+    def test_unknown_path(self):
+        status, response = call_asgi(b"", "", path="/other")
+
+        assert status == 404
+
+    def test_metrics(self):
+        sent = asgi_request(b"", "", path="/metrics", method="GET")
+
+        assert sent[0]["status"] == 200
+        assert b"vendor_matching_stage_seconds_bucket" in sent[1]["body"]
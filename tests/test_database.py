@@ -0,0 +1,201 @@
+import threading
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+from psycopg2.extensions import QueryCanceledError
+
+from database.database import (
+    CircuitBreaker,
+    ConnectionPool,
+    DatabaseUnavailable,
+    DeadlineExceeded,
+    PoolTimeout,
+    VendorDatabase,
+)
+
+
+@pytest.fixture
+def vendor_db(database):
+    vendor_db = VendorDatabase()
+    vendor_db.pool  # reads the connection parameters
+    yield vendor_db
+    vendor_db.release()
+    vendor_db.pool.closeall()
+
+
+@pytest.fixture
+def unreachable_db(database, monkeypatch):
+    monkeypatch.setenv("DB_PORT", "1")
+    unreachable_db = VendorDatabase()
+    unreachable_db.retry_backoff = 0.001
+    yield unreachable_db
+
+
+class TestConnectionPool:
+    def test_threads_use_separate_connections(self, vendor_db):
+        barrier = threading.Barrier(3)
+        backend_pids = []
+
+        def query():
+            backend_pids.append(vendor_db.execute_and_fetch("SELECT pg_backend_pid()")[0])
+            barrier.wait()
+            vendor_db.release()
+
+        threads = [threading.Thread(target=query) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(set(backend_pids)) == 3
+
+    def test_released_connection_is_reused(self, vendor_db):
+        first = vendor_db.execute_and_fetch("SELECT pg_backend_pid()")[0]
+        vendor_db.release()
+
+        assert vendor_db.execute_and_fetch("SELECT pg_backend_pid()")[0] == first
+
+    def test_checkout_timeout(self, vendor_db):
+        pool = ConnectionPool(vendor_db._connect, min_size=0, max_size=1, timeout=0.1)
+        conn = pool.getconn()
+
+        with pytest.raises(PoolTimeout):
+            pool.getconn()
+
+        pool.putconn(conn)
+        assert pool.getconn() is conn
+
+    def test_broken_connection_is_replaced(self, vendor_db):
+        pool = ConnectionPool(vendor_db._connect, min_size=1, max_size=1, timeout=0.1)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.close()
+
+        replacement = pool.getconn()
+
+        assert replacement is not conn
+        assert not replacement.closed
+
+
+class TestPreparedStatements:
+    def test_prepared_once_per_connection(self, vendor_db):
+        statement = "SELECT $1::int + 1"
+
+        assert vendor_db.execute_prepared_and_fetchall("plus_one", statement, [1]) == [(2,)]
+        vendor_db.rollback()
+        vendor_db.release()
+        assert vendor_db.execute_prepared_and_fetchall("plus_one", statement, [2]) == [(3,)]
+
+        prepared = vendor_db.execute_and_fetchall("SELECT name FROM pg_prepared_statements")
+        assert prepared == [("plus_one",)]
+        assert vendor_db.db_conn.prepared == {"plus_one"}
+
+
+class TestDeadline:
+    def test_time_left_is_statement_timeout(self, vendor_db):
+        with vendor_db.deadline(5):
+            (timeout,) = vendor_db.execute_and_fetch(
+                "SELECT setting::int FROM pg_settings WHERE name = 'statement_timeout'"
+            )
+        vendor_db.rollback()
+
+        assert 4000 < timeout <= 5000
+
+    def test_running_query_cancelled(self, vendor_db):
+        with vendor_db.deadline(0.1), pytest.raises(QueryCanceledError):
+            vendor_db.execute("SELECT pg_sleep(1)")
+        vendor_db.rollback()
+
+    def test_no_query_after_deadline(self, vendor_db):
+        with vendor_db.deadline(0.01), pytest.raises(DeadlineExceeded):
+            time.sleep(0.02)
+            vendor_db.execute("SELECT 1")
+
+    def test_half_open_trial_given_up_after_deadline(self, vendor_db):
+        vendor_db.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        vendor_db.breaker.record_failure()
+        with vendor_db.deadline(0.01), pytest.raises(DeadlineExceeded):
+            time.sleep(0.02)
+            vendor_db.execute("SELECT 1")
+
+        assert vendor_db.execute_and_fetch("SELECT 1") == (1,)
+        assert vendor_db.breaker.state == CircuitBreaker.CLOSED
+
+    def test_no_deadline(self, vendor_db):
+        with vendor_db.deadline(0):
+            assert vendor_db.execute_and_fetch("SHOW statement_timeout") == ("0",)
+
+
+class TestRetries:
+    def test_retries_are_bounded(self, unreachable_db):
+        unreachable_db.retry_attempts = 3
+        before = REGISTRY.get_sample_value("vendor_matching_db_retries_total")
+
+        with pytest.raises(DatabaseUnavailable):
+            unreachable_db.execute_and_fetch("SELECT 1")
+
+        assert REGISTRY.get_sample_value("vendor_matching_db_retries_total") == before + 2
+
+    def test_open_breaker_fails_fast(self, unreachable_db):
+        unreachable_db.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        with pytest.raises(DatabaseUnavailable):
+            unreachable_db.execute_and_fetch("SELECT 1")
+        before = REGISTRY.get_sample_value("vendor_matching_db_retries_total")
+
+        with pytest.raises(DatabaseUnavailable, match="circuit breaker is open"):
+            unreachable_db.execute_and_fetch("SELECT 1")
+
+        assert REGISTRY.get_sample_value("vendor_matching_db_retries_total") == before
+        assert unreachable_db.breaker.state == CircuitBreaker.OPEN
+
+    def test_pool_timeout_is_unavailable(self, vendor_db):
+        vendor_db.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        vendor_db.breaker.record_failure()
+        vendor_db._pool = ConnectionPool(vendor_db._connect, min_size=0, max_size=0, timeout=0.01)
+
+        with pytest.raises(DatabaseUnavailable, match="No database connection"):
+            vendor_db.execute_and_fetch("SELECT 1")
+
+        assert vendor_db.breaker.allow()
+
+
+class TestCircuitBreaker:
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        assert breaker.allow()
+
+        breaker.record_failure()
+
+        assert not breaker.allow()
+
+    def test_half_open_trial_closes_on_success(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_trial_opens_on_failure(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.allow()
+
+        breaker.record_failure()
+
+        assert breaker.state == CircuitBreaker.OPEN
+
+    def test_half_open_trial_given_up(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.allow()
+
+        breaker.release_trial()
+
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
@@ -0,0 +1,334 @@
+import pytest
+from psycopg2 import errors
+
+from fuzzy_vendor_matching_webhook_python import config
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import (
+    db,
+    db_import,
+    db_drop_vendor_data,
+    db_sync,
+    shard_ranges,
+    SHADOW_TABLE,
+    VENDOR_DATA_COLUMNS,
+)
+from fuzzy_vendor_matching_webhook_python.matching import (
+    match_vendor_statement,
+    SqlVendorMatcher,
+    vat_id_statement,
+    VendorScope,
+)
+from fuzzy_vendor_matching_webhook_python.normalize import normalize_lookup
+from tests import COMPANIES_FILE
+
+
+def explain(vat_id, name, address, country="") -> str:
+    """Return the plan of the statement matching vendors to the inputs."""
+    inputs = [value for value in (vat_id, name, address, country) if value]
+    _, statement = match_vendor_statement(bool(vat_id), bool(name), bool(address), bool(country))
+    return explain_statement(statement, inputs + [20, config.SIMILARITY_THRESHOLD])
+
+
+def explain_statement(statement, parameters) -> str:
+    """Return the plan of a statement, with sequential scans disabled so that the
+    tiny test table does not make the planner ignore the indexes."""
+    db.execute("SET LOCAL enable_seqscan = off;")
+    db.execute(f"PREPARE explained AS {statement}".replace("%", "%%"), ())
+    plan = db.execute_and_fetchall(
+        "EXPLAIN EXECUTE explained(%s)" % ", ".join(["%s"] * len(parameters)), parameters
+    )
+    db.execute("DEALLOCATE explained;")
+    db.rollback()
+    return "\n".join(line for line, in plan)
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestIndexes:
+    def test_name_lookup_uses_trigram_index(self):
+        plan = explain("", "Bernhard", "")
+
+        assert "vendor_data_default_name_norm_idx" in plan
+        assert "Seq Scan" not in plan
+
+    def test_name_lookup_is_ordered_by_index(self):
+        plan = explain("", "Bernhard", "")
+
+        assert "Order By" in plan
+        assert "Limit" in plan
+
+    def test_address_lookup_uses_trigram_index(self):
+        plan = explain("", "", "Flotowstr. 65")
+
+        assert "vendor_data_default_address_norm_idx" in plan
+        assert "Seq Scan" not in plan
+
+    def test_address_lookup_is_ordered_by_index(self):
+        plan = explain("", "", "Flotowstr. 65")
+
+        assert "Order By" in plan
+        assert "Limit" in plan
+
+    def test_combined_lookup_uses_trigram_indexes(self):
+        plan = explain("DE758402667", "Bosco", "Flotowstr. 65")
+
+        assert "_norm_idx" in plan
+        assert "Seq Scan" not in plan
+
+    def test_vat_id_lookup_uses_hash_index(self):
+        _, statement = vat_id_statement()
+        plan = explain_statement(statement, ["DE758402667"])
+
+        assert "vendor_data_default_taxid_norm_idx" in plan
+        assert "Seq Scan" not in plan
+
+
+class TestPartitions:
+    @pytest.fixture
+    def partitioned_vendor_data(self, database, monkeypatch):
+        monkeypatch.setattr(config, "VENDOR_PARTITIONS", ["DE", "AT"])
+        db_import(COMPANIES_FILE)
+        yield
+        db_drop_vendor_data()
+
+    @pytest.mark.usefixtures("partitioned_vendor_data")
+    def test_vendors_in_country_partition(self):
+        counts = db.execute_and_fetchall(
+            "SELECT tableoid::regclass::text, COUNT(*) FROM vendor_data GROUP BY 1"
+        )
+
+        assert [table for table, _ in counts] == ["vendor_data_de"]
+
+    @pytest.mark.usefixtures("partitioned_vendor_data")
+    def test_scoped_lookup_reads_only_its_partition(self):
+        plan = explain("", "Bernhard", "", "DE")
+
+        assert "vendor_data_de_name_norm_idx" in plan
+        assert "vendor_data_at" not in plan
+        assert "vendor_data_default" not in plan
+
+    @pytest.mark.usefixtures("partitioned_vendor_data")
+    def test_unscoped_lookup_merges_partitions_in_order(self):
+        plan = explain("", "Bernhard", "")
+
+        assert "Merge Append" in plan
+        assert "vendor_data_at_name_norm_idx" in plan
+
+
+@pytest.mark.usefixtures("database")
+class TestUnpartitionedVendorData:
+    @pytest.fixture
+    def unpartitioned(self):
+        db.execute("CREATE TABLE vendor_data (id VARCHAR(16) PRIMARY KEY, name TEXT);")
+        db.commit()
+
+    @pytest.mark.usefixtures("unpartitioned")
+    def test_replaced_by_import(self):
+        rows = import_vendor_data(COMPANIES_FILE, bulk=True)
+
+        assert len(rows) == 8
+
+    @pytest.mark.usefixtures("unpartitioned")
+    def test_not_wiped_by_sync(self):
+        with pytest.raises(ValueError):
+            db_sync(COMPANIES_FILE, "delta")
+        db.rollback()
+
+        assert db.execute_and_fetch("SELECT to_regclass('vendor_data')") == ("vendor_data",)
+        db.execute("DROP TABLE vendor_data;")
+        db.commit()
+
+
+@pytest.mark.usefixtures("database")
+def test_vendors_moved_to_partition_added_later(monkeypatch):
+    db_import(COMPANIES_FILE)
+    monkeypatch.setattr(config, "VENDOR_PARTITIONS", ["DE"])
+
+    db_sync(COMPANIES_FILE, "delta")
+
+    counts = db.execute_and_fetchall(
+        "SELECT tableoid::regclass::text, COUNT(*) FROM vendor_data GROUP BY 1"
+    )
+    assert counts == [("vendor_data_de", 8)]
+    assert "vendor_data_de_name_norm_idx" in explain("", "Bernhard", "", "DE")
+    db_drop_vendor_data()
+
+
+def import_vendor_data(filename, bulk, workers=1):
+    db_import(filename, bulk=bulk, workers=workers)
+    rows = db.execute_and_fetchall("SELECT * FROM vendor_data ORDER BY id")
+    db_drop_vendor_data()
+    return rows
+
+
+@pytest.mark.usefixtures("database")
+class TestBulkImport:
+    def test_same_as_row_import(self):
+        rows = import_vendor_data(COMPANIES_FILE, bulk=True)
+
+        assert rows == import_vendor_data(COMPANIES_FILE, bulk=False)
+        assert len(rows) == 8
+
+    def test_escaping_and_missing_values(self, tmp_path):
+        with open(COMPANIES_FILE) as csvfile:
+            header = csvfile.readline()
+        vendor_file = tmp_path / "vendors.csv"
+        vendor_file.write_text(
+            header
+            + "1;Back\\slash\tTab;Street 1;;;City;;12345;DE;;FF;Retail trade;DE1;1;345\n"
+            + "2;Short Row;Street 2;;;City;;12345;DE;;FF;Retail trade;DE2;1\n"
+        )
+
+        rows = import_vendor_data(str(vendor_file), bulk=True)
+
+        assert rows == import_vendor_data(str(vendor_file), bulk=False)
+        assert rows[0][1] == "Back\\slash\tTab"
+        assert rows[1][VENDOR_DATA_COLUMNS.index("file_id")] is None
+
+    def test_parallel_same_as_bulk(self):
+        rows = import_vendor_data(COMPANIES_FILE, bulk=True, workers=2)
+
+        assert rows == import_vendor_data(COMPANIES_FILE, bulk=True)
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_import_replaces_vendors(self, changed_vendor_file, workers):
+        db_import(COMPANIES_FILE)
+        db_import(changed_vendor_file, workers=workers)
+        rows = db.execute_and_fetchall("SELECT * FROM vendor_data ORDER BY id")
+        db_drop_vendor_data()
+
+        assert rows == import_vendor_data(changed_vendor_file, bulk=True)
+        assert rows == import_vendor_data(changed_vendor_file, bulk=True, workers=2)
+
+    def test_parallel_requires_bulk(self):
+        with pytest.raises(ValueError):
+            db_import(COMPANIES_FILE, bulk=False, workers=2)
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+def test_failed_parallel_import_keeps_vendor_data(tmp_path):
+    before = db.execute_and_fetchall("SELECT * FROM vendor_data ORDER BY id")
+    with open(COMPANIES_FILE) as csvfile:
+        lines = csvfile.read().splitlines()
+    vendor_file = tmp_path / "vendors.csv"
+    # the same vendor twice violates the primary key
+    vendor_file.write_text("\n".join(lines + lines[1:2]) + "\n")
+
+    with pytest.raises(errors.UniqueViolation):
+        db_import(str(vendor_file), workers=2)
+
+    assert db.execute_and_fetchall("SELECT * FROM vendor_data ORDER BY id") == before
+    assert db.execute_and_fetch("SELECT to_regclass(%s)", (SHADOW_TABLE,)) == (None,)
+
+
+@pytest.mark.parametrize("shards", [1, 3, 100])
+def test_shard_ranges_cover_all_lines(shards):
+    with open(COMPANIES_FILE, "rb") as csvfile:
+        lines = csvfile.readlines()[1:]
+
+    ranges = shard_ranges(COMPANIES_FILE, shards)
+
+    assert len(ranges) <= shards
+    with open(COMPANIES_FILE, "rb") as csvfile:
+        content = csvfile.read()
+    assert b"".join(content[start:end] for start, end in ranges) == b"".join(lines)
+    assert all(content[start - 1 : start] == b"\n" for start, _ in ranges)
+
+
+@pytest.mark.usefixtures("database")
+class TestSearchColumns:
+    @pytest.fixture
+    def umlaut_vendor_file(self, tmp_path):
+        with open(COMPANIES_FILE) as csvfile:
+            header = csvfile.readline()
+        vendor_file = tmp_path / "vendors.csv"
+        vendor_file.write_text(
+            header
+            + "1;Müller GmbH & Co. KG;Königstraße 5;;;Görlitz;;02826;DE;;FF;Retail trade;"
+            + "DE 123 456 789;1;345\n"
+            + "2;Meier AG;Hauptstr. 1;;;Köln;;50667; de ;;FF;Retail trade;;1; 346 \n"
+        )
+        db_import(str(vendor_file))
+        yield
+        db_drop_vendor_data()
+
+    @pytest.mark.parametrize(
+        "vat_id, name, address",
+        [
+            ("", "MUELLER", ""),
+            ("", "Müller GmbH", ""),
+            ("", "Mueller Gmbh & Co KG", ""),
+            ("", "", "Koenigstrasse 5, 02826 Goerlitz"),
+            ("DE123456789", "", ""),
+        ],
+    )
+    def test_spellings_match_the_same_vendor(self, umlaut_vendor_file, vat_id, name, address):
+        assert SqlVendorMatcher().match(*normalize_lookup(vat_id, name, address), 1) == [
+            ("DE 123 456 789", "Müller GmbH & Co. KG, Königstraße 5, Görlitz (1)")
+        ]
+
+    def test_vendor_without_vat_id(self, umlaut_vendor_file):
+        (taxid_norm,) = db.execute_and_fetch("SELECT taxid_norm FROM vendor_data WHERE id = '2'")
+
+        assert taxid_norm is None
+
+    def test_country_and_file_id_stripped(self, umlaut_vendor_file):
+        scope = VendorScope(country="DE", file_id="346")
+
+        assert SqlVendorMatcher().match("", "MEIER", "", 1, scope) == [
+            ("", "Meier AG, Hauptstr. 1, Köln (2)")
+        ]
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestSync:
+    @pytest.mark.parametrize("strategy", ["delta", "swap"])
+    def test_sync(self, changed_vendor_file, strategy):
+        db_sync(changed_vendor_file, strategy)
+        rows = db.execute_and_fetchall("SELECT * FROM vendor_data ORDER BY id")
+        db_drop_vendor_data()
+
+        assert rows == import_vendor_data(changed_vendor_file, bulk=True)
+        db_import(COMPANIES_FILE)
+
+    def test_delta_leaves_unchanged_vendors_alone(self, changed_vendor_file):
+        query = "SELECT id, xmin::text FROM vendor_data ORDER BY id"
+        before = dict(db.execute_and_fetchall(query))
+
+        db_sync(changed_vendor_file, "delta")
+
+        after = dict(db.execute_and_fetchall(query))
+        changed = {id for id in before.keys() | after.keys() if before.get(id) != after.get(id)}
+        assert changed == {"3562", "4685", "9999"}
+
+    @pytest.mark.parametrize("kept_lines", [1, 3])
+    def test_delta_of_truncated_file_aborted(self, tmp_path, kept_lines):
+        before = db.execute_and_fetchall("SELECT * FROM vendor_data ORDER BY id")
+        with open(COMPANIES_FILE) as csvfile:
+            lines = csvfile.read().splitlines()
+        vendor_file = tmp_path / "vendors.csv"
+        vendor_file.write_text("\n".join(lines[:kept_lines]) + "\n")
+
+        with pytest.raises(ValueError, match="not syncing"):
+            db_sync(str(vendor_file), "delta")
+
+        assert db.execute_and_fetchall("SELECT * FROM vendor_data ORDER BY id") == before
+
+    def test_swap_keeps_names(self, changed_vendor_file):
+        db_sync(changed_vendor_file, "swap")
+        db_sync(changed_vendor_file, "swap")
+
+        relations = db.execute_and_fetchall(
+            "SELECT relname FROM pg_class WHERE relname LIKE 'vendor_data%' ORDER BY relname"
+        )
+        assert [relname for relname, in relations] == [
+            "vendor_data",
+            "vendor_data_address_trgm_idx",
+            "vendor_data_default",
+            "vendor_data_default_address_norm_idx",
+            "vendor_data_default_name_norm_idx",
+            "vendor_data_default_pkey",
+            "vendor_data_default_taxid_norm_idx",
+            "vendor_data_name_trgm_idx",
+            "vendor_data_pkey",
+            "vendor_data_taxid_hash_idx",
+            "vendor_data_version",
+        ]
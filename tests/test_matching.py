@@ -0,0 +1,455 @@
+import threading
+
+import numpy as np
+import pytest
+from prometheus_client import REGISTRY
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from fuzzy_vendor_matching_webhook_python import config, matching, trigram_index
+from fuzzy_vendor_matching_webhook_python.cache import LRUCache, MISSING
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import db, db_sync
+from fuzzy_vendor_matching_webhook_python.matching import (
+    CachedVendorMatcher,
+    SqlVendorMatcher,
+    VendorMatcher,
+    VendorScope,
+    get_matcher,
+    threshold_tiers,
+)
+from fuzzy_vendor_matching_webhook_python.normalize import normalize_lookup
+from fuzzy_vendor_matching_webhook_python.trigram_index import (
+    INDEX_FILE_MODE,
+    InMemoryVendorMatcher,
+    trigrams,
+    write_arrays,
+)
+from tests import COMPANIES_FILE
+
+# matchers take inputs normalized where they enter the service
+QUERIES = [
+    normalize_lookup(*query)
+    for query in [
+        ("", "Bernhard", ""),
+        ("", "Ltd", ""),
+        ("", "Bosco Limited", ""),
+        ("", "", "Flotowstr. 65"),
+        ("", "", "Strasse"),
+        ("", "", "Bayreuther Strasse 93 Frankfurt"),
+        ("DE758402667", "", ""),
+        ("DE758402667", "Bosco", "Flotowstr. 65"),
+        ("DE000000000", "Bosco", ""),
+        ("", "Schroeder & Sons", "Koenigstrasse 49, 18069 Allershagen"),
+        ("", "Synic Roodel", ""),
+        ("", "--", ""),
+    ]
+]
+
+
+SCOPES = [
+    VendorScope(country="DE"),
+    VendorScope(country="AT"),
+    VendorScope(file_id="345"),
+    VendorScope(country="DE", file_id="999"),
+]
+
+
+@pytest.mark.parametrize("text", ["Bosco Ltd", "Flotowstr. 65", "a-b_c  D", "x", "--"])
+def test_trigrams_as_pg_trgm(database, text):
+    (pg_trigrams,) = db.execute_and_fetch("SELECT show_trgm(%s)", (text,))
+
+    assert sorted(trigrams(text)) == pg_trigrams
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestInMemoryVendorMatcher:
+    @pytest.mark.parametrize("vat_id, name, address", QUERIES)
+    def test_same_as_sql(self, vat_id, name, address):
+        in_memory = InMemoryVendorMatcher.from_database()
+
+        assert in_memory.match(vat_id, name, address, 20) == SqlVendorMatcher().match(
+            vat_id, name, address, 20
+        )
+
+    def test_limit(self):
+        in_memory = InMemoryVendorMatcher.from_database()
+
+        assert in_memory.match("", "LTD", "", 1) == SqlVendorMatcher().match("", "LTD", "", 1)
+
+    @pytest.mark.parametrize("matcher", [SqlVendorMatcher, InMemoryVendorMatcher.from_database])
+    def test_similarity_threshold(self, matcher, monkeypatch):
+        monkeypatch.setattr(config, "SIMILARITY_THRESHOLD", 0.2)
+
+        assert matcher().match("", LONG_NOISY_NAME, "", 20) == [
+            ("DE355869309", "Schroeder and Sons, Koenigstrasse 49, Allershagen (5300)")
+        ]
+
+    def test_ties_ranked_by_id(self, tmp_path):
+        # imported in the other order, "100" ranks first by code point
+        twins = "Twin Trading;Street 1;;;City;;12345;DE;;FF;Retail trade"
+        with open(COMPANIES_FILE) as csvfile:
+            lines = csvfile.read().splitlines()
+        lines += [f"20;{twins};DE20;1;345", f"100;{twins};DE100;1;345"]
+        vendor_file = tmp_path / "vendors.csv"
+        vendor_file.write_text("\n".join(lines) + "\n")
+        db_sync(str(vendor_file), "delta")
+        in_memory = InMemoryVendorMatcher.from_database()
+
+        for limit in (1, 2):
+            expected = [("DE100", "Twin Trading, Street 1, City (100)")]
+            expected += [("DE20", "Twin Trading, Street 1, City (20)")][: limit - 1]
+            assert SqlVendorMatcher().match("", "TWIN TRADING", "", limit) == expected
+            assert in_memory.match("", "TWIN TRADING", "", limit) == expected
+
+    @pytest.mark.parametrize("scope", SCOPES)
+    def test_scoped_same_as_sql(self, scope):
+        in_memory = InMemoryVendorMatcher.from_database()
+
+        for query in QUERIES:
+            assert in_memory.match(*query, 20, scope) == SqlVendorMatcher().match(*query, 20, scope)
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestIndexFile:
+    @pytest.mark.parametrize("vat_id, name, address", QUERIES)
+    def test_same_as_sql(self, tmp_path, vat_id, name, address):
+        mapped = InMemoryVendorMatcher.from_index_file(str(tmp_path / "vendors.idx"))
+
+        assert mapped.match(vat_id, name, address, 20) == SqlVendorMatcher().match(
+            vat_id, name, address, 20
+        )
+
+    def test_arrays_are_mapped(self, tmp_path):
+        mapped = InMemoryVendorMatcher.from_index_file(str(tmp_path / "vendors.idx"))
+
+        assert all(not array.flags.owndata for array in mapped.arrays.values())
+
+    def test_rebuilt_when_vendor_data_changed(self, tmp_path, changed_vendor_file):
+        filename = str(tmp_path / "vendors.idx")
+        InMemoryVendorMatcher.from_index_file(filename)
+
+        db_sync(changed_vendor_file, "delta")
+        mapped = InMemoryVendorMatcher.from_index_file(filename)
+
+        assert mapped.match("", "NEWCOMER", "", 20) == [
+            ("DE1", "Newcomer AG, Street 1, City (9999)")
+        ]
+
+    def test_built_once_by_concurrent_processes(self, tmp_path, monkeypatch):
+        filename = str(tmp_path / "vendors.idx")
+        builds = []
+        from_database = InMemoryVendorMatcher.from_database.__func__
+
+        def counting_from_database(cls):
+            builds.append(1)
+            return from_database(cls)
+
+        monkeypatch.setattr(
+            InMemoryVendorMatcher, "from_database", classmethod(counting_from_database)
+        )
+
+        def map_index():
+            InMemoryVendorMatcher.from_index_file(filename)
+            db.release()
+
+        threads = [threading.Thread(target=map_index) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(builds) == 1
+
+    def test_readable_by_others(self, tmp_path):
+        filename = tmp_path / "vendors.idx"
+        InMemoryVendorMatcher.from_index_file(str(filename))
+
+        assert filename.stat().st_mode & 0o777 == INDEX_FILE_MODE
+
+    def test_no_temporary_file_left_on_error(self, tmp_path, monkeypatch):
+        def failing_chmod(path, mode):
+            raise OSError("No space left on device")
+
+        monkeypatch.setattr(trigram_index.os, "chmod", failing_chmod)
+
+        with pytest.raises(OSError):
+            write_arrays(str(tmp_path / "vendors.idx"), {"codes": np.arange(3)}, 1)
+
+        assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestMatchMany:
+    def test_same_as_match(self, monkeypatch):
+        monkeypatch.setattr(matching, "MATCH_BATCH_SIZE", 5)
+        sql = SqlVendorMatcher()
+
+        assert list(sql.match_many(QUERIES, 20)) == [sql.match(*query, 20) for query in QUERIES]
+
+    def test_empty_query(self):
+        assert list(SqlVendorMatcher().match_many([("", "", ""), ("", "BERNHARD", "")], 1)) == [
+            [],
+            [("DE757038244", "Bernhard Group, Brandenburgische Strasse 55, Knittelsheim (2416)")],
+        ]
+
+
+# "Schroeder and Sons" garbled by OCR, below the default similarity threshold
+LONG_NOISY_NAME = "SCHRODER ANO SONS INTERNATIONAL TRADING"
+
+
+@pytest.fixture
+def adaptive(monkeypatch):
+    monkeypatch.setattr(config, "ADAPTIVE_THRESHOLDS", [0.6, 0.44, 0.2])
+
+
+class TestThresholdTiers:
+    def test_not_adaptive_by_default(self):
+        assert threshold_tiers("BOSCO", "") == []
+
+    @pytest.mark.usefixtures("adaptive")
+    def test_short_inputs_relaxed_down_to_similarity_threshold(self):
+        assert threshold_tiers("BOSCO", "") == [0.6, 0.44, 0.3]
+
+    @pytest.mark.usefixtures("adaptive")
+    def test_long_inputs_relaxed_further(self):
+        assert threshold_tiers("BOSCO", "X" * 30) == [0.6, 0.44, 0.3, 0.2]
+
+    @pytest.mark.usefixtures("adaptive")
+    def test_vat_id_lookup_not_adaptive(self):
+        assert threshold_tiers("", "") == []
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table", "adaptive")
+class TestAdaptiveThreshold:
+    @pytest.mark.parametrize("matcher", [SqlVendorMatcher, InMemoryVendorMatcher.from_database])
+    def test_strict_threshold_stops_fan_out(self, matcher):
+        assert [vat_id for vat_id, _ in matcher().match("", "BERNHARD BOSCO", "", 20)] == [
+            "DE757038244"
+        ]
+
+    @pytest.mark.parametrize("matcher", [SqlVendorMatcher, InMemoryVendorMatcher.from_database])
+    def test_long_noisy_name_relaxed(self, matcher, monkeypatch):
+        matcher = matcher()
+        found = [("DE355869309", "Schroeder and Sons, Koenigstrasse 49, Allershagen (5300)")]
+
+        assert matcher.match("", LONG_NOISY_NAME, "", 20) == found
+        # the relaxed threshold is set for the rest of the transaction
+        db.rollback()
+        monkeypatch.setattr(config, "ADAPTIVE_THRESHOLDS", [])
+        assert matcher.match("", LONG_NOISY_NAME, "", 20) == []
+
+    @pytest.mark.parametrize("vat_id, name, address", QUERIES)
+    def test_in_memory_same_as_sql(self, vat_id, name, address):
+        in_memory = InMemoryVendorMatcher.from_database()
+
+        assert in_memory.match(vat_id, name, address, 20) == SqlVendorMatcher().match(
+            vat_id, name, address, 20
+        )
+
+    def test_many_same_as_match(self):
+        queries = QUERIES + [("", "BERNHARD BOSCO", ""), ("", LONG_NOISY_NAME, "")]
+        sql = SqlVendorMatcher()
+
+        assert list(sql.match_many(queries, 20)) == [sql.match(*query, 20) for query in queries]
+
+    def test_threshold_set_by_statement(self):
+        query = matching.match_vendor_query(None, "%(name)s", None, "20", "%(threshold)s")
+        attrs = {"name": LONG_NOISY_NAME, "threshold": 0.2}
+
+        assert db.execute_and_fetchall(query, attrs) == [
+            ("DE355869309", "Schroeder and Sons, Koenigstrasse 49, Allershagen (5300)")
+        ]
+        db.rollback()
+
+    def test_tiers_counted(self):
+        before = REGISTRY.get_sample_value(
+            "vendor_matching_similarity_threshold_tiers_total", {"threshold": "0.2"}
+        )
+
+        SqlVendorMatcher().match("", LONG_NOISY_NAME, "", 20)
+
+        assert (
+            REGISTRY.get_sample_value(
+                "vendor_matching_similarity_threshold_tiers_total", {"threshold": "0.2"}
+            )
+            == (before or 0) + 1
+        )
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestScope:
+    @pytest.mark.parametrize("matcher", [SqlVendorMatcher, InMemoryVendorMatcher.from_database])
+    def test_vendors_of_other_scopes_not_matched(self, matcher):
+        matcher = matcher()
+
+        assert matcher.match("DE758402667", "", "", 20, VendorScope(country="DE")) == [
+            ("DE758402667", "Bosco Ltd, Flotowstr. 65, Aschersleben (3562)")
+        ]
+        assert matcher.match("DE758402667", "", "", 20, VendorScope(country="AT")) == []
+        assert matcher.match("", "BERNHARD", "", 20, VendorScope(file_id="999")) == []
+
+    @pytest.mark.parametrize("scope", SCOPES)
+    def test_many_same_as_match(self, scope):
+        sql = SqlVendorMatcher()
+
+        assert list(sql.match_many(QUERIES, 20, scope)) == [
+            sql.match(*query, 20, scope) for query in QUERIES
+        ]
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestVatIdFastPath:
+    @pytest.mark.parametrize("matcher", [SqlVendorMatcher, InMemoryVendorMatcher.from_database])
+    def test_unique_vat_id_decides(self, matcher):
+        assert matcher().match("DE758402667", "BERNHARD", "", 20) == [
+            ("DE758402667", "Bosco Ltd, Flotowstr. 65, Aschersleben (3562)")
+        ]
+
+    @pytest.mark.parametrize("matcher", [SqlVendorMatcher, InMemoryVendorMatcher.from_database])
+    def test_unknown_vat_id_falls_back_to_fuzzy_search(self, matcher):
+        assert matcher().match("DE000000000", "BERNHARD", "", 20) == []
+
+    def test_many_same_as_match(self):
+        queries = [("DE758402667", "BERNHARD", ""), ("DE000000000", "BOSCO", ""), ("", "BOSCO", "")]
+        sql = SqlVendorMatcher()
+
+        assert list(sql.match_many(queries, 20)) == [sql.match(*query, 20) for query in queries]
+
+    def test_counts_lookups(self):
+        sql = SqlVendorMatcher()
+        before = {
+            result: REGISTRY.get_sample_value(
+                "vendor_matching_vat_id_lookups_total", {"result": result}
+            )
+            or 0
+            for result in ("unique", "miss")
+        }
+
+        sql.match("DE758402667", "", "", 20)
+        sql.match("DE000000000", "BOSCO", "", 20)
+
+        for result in ("unique", "miss"):
+            assert (
+                REGISTRY.get_sample_value(
+                    "vendor_matching_vat_id_lookups_total", {"result": result}
+                )
+                == before[result] + 1
+            )
+
+
+class CountingMatcher(VendorMatcher):
+    def __init__(self):
+        self.calls = 0
+
+    def match(self, vat_id, name, address, limit, scope=matching.ALL_VENDORS):
+        self.calls += 1
+        return [("DE1", name)]
+
+
+def test_vendor_matcher_is_abstract():
+    with pytest.raises(TypeError):
+        VendorMatcher()
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+
+        cache.put("c", 3)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is MISSING
+        assert cache.get("c") == 3
+
+    def test_entries_expire(self):
+        cache = LRUCache(maxsize=2, ttl=0)
+        cache.put("a", 1)
+
+        assert cache.get("a") is MISSING
+
+    def test_stats(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+
+        assert cache.stats() == {"hits": 2, "misses": 1, "hit_ratio": 2 / 3, "size": 1}
+
+
+class TestCachedVendorMatcher:
+    def test_repeated_lookup_is_cached(self):
+        counting = CountingMatcher()
+        cached = CachedVendorMatcher(counting, LRUCache(maxsize=10, ttl=60))
+
+        first = cached.match("DE1", "BOSCO", "", 20)
+        second = cached.match("DE1", "BOSCO", "", 20)
+
+        assert first == second
+        assert counting.calls == 1
+
+    def test_different_lookups_are_not_mixed(self):
+        counting = CountingMatcher()
+        cached = CachedVendorMatcher(counting, LRUCache(maxsize=10, ttl=60))
+
+        cached.match("DE1", "BOSCO", "", 20)
+        cached.match("DE1", "BOSCO", "", 1)
+        cached.match("DE2", "BOSCO", "", 20)
+        cached.match("DE2", "BOSCO", "", 20, VendorScope(country="DE"))
+
+        assert counting.calls == 4
+
+    def test_match_many_forwards_misses(self):
+        counting = CountingMatcher()
+        cached = CachedVendorMatcher(counting, LRUCache(maxsize=10, ttl=60))
+        cached.match("DE1", "BOSCO", "", 20)
+
+        results = list(cached.match_many([("DE1", "BOSCO", ""), ("DE1", "ROODEL", "")], 20))
+
+        assert results == [[("DE1", "BOSCO")], [("DE1", "ROODEL")]]
+        assert counting.calls == 2
+
+    @pytest.mark.usefixtures("fill_vendor_data_table")
+    def test_invalidated_by_sync(self, changed_vendor_file, monkeypatch):
+        monkeypatch.setattr(config, "VENDOR_DATA_CHECK_INTERVAL", 0)
+        assert get_matcher().match("", "NEWCOMER", "", 20) == []
+
+        db_sync(changed_vendor_file, "delta")
+
+        assert get_matcher().match("", "NEWCOMER", "", 20) == [
+            ("DE1", "Newcomer AG, Street 1, City (9999)")
+        ]
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestGetMatcher:
+    def test_version_check_leaves_no_transaction(self, monkeypatch):
+        monkeypatch.setattr(config, "VENDOR_DATA_CHECK_INTERVAL", 0)
+        get_matcher()
+
+        # so that the lookup after it is retried when the connection dropped
+        assert db.db_conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+
+    def test_previous_matcher_served_while_creating(self, monkeypatch):
+        monkeypatch.setattr(config, "VENDOR_DATA_CHECK_INTERVAL", 0)
+        previous = get_matcher()
+        creating, created = threading.Event(), threading.Event()
+        new = CountingMatcher()
+
+        def create_matcher():
+            creating.set()
+            created.wait(5)
+            return new
+
+        monkeypatch.setattr(matching, "create_matcher", create_matcher)
+        monkeypatch.setattr(matching, "_vendor_data_version", -1)
+        thread = threading.Thread(target=get_matcher)
+        thread.start()
+        creating.wait(5)
+
+        assert get_matcher() is previous
+        created.set()
+        thread.join()
+        assert get_matcher() is new
@@ -0,0 +1,42 @@
+import pytest
+
+from fuzzy_vendor_matching_webhook_python.normalize import (
+    normalize_address,
+    normalize_name,
+    normalize_vat_id,
+)
+
+
+@pytest.mark.parametrize(
+    "name, normalized",
+    [
+        ("Müller GmbH", "MUELLER"),
+        ("MUELLER", "MUELLER"),
+        ("Schröder & Söhne GmbH & Co. KG", "SCHROEDER SOEHNE"),
+        ("Weiß UG (haftungsbeschränkt)", "WEISS"),
+        ("Café Crème e.K.", "CAFE CREME"),
+        ("Bosco Ltd", "BOSCO"),
+        ("Holding AG GmbH", "HOLDING"),
+        ("GmbH", "GMBH"),
+        ("", ""),
+    ],
+)
+def test_normalize_name(name, normalized):
+    assert normalize_name(name) == normalized
+
+
+def test_normalize_name_is_idempotent():
+    assert normalize_name(normalize_name("Müller GmbH & Co. KG")) == "MUELLER"
+
+
+def test_normalize_address():
+    assert normalize_address("Königstraße 5", "", None, "Görlitz", "02826") == (
+        "KOENIGSTRASSE 5 GOERLITZ 02826"
+    )
+
+
+@pytest.mark.parametrize(
+    "vat_id, normalized", [("DE 123 456 789", "DE123456789"), ("de123456789", "DE123456789")]
+)
+def test_normalize_vat_id(vat_id, normalized):
+    assert normalize_vat_id(vat_id) == normalized
@@ -0,0 +1,44 @@
+import subprocess
+import sys
+
+import pytest
+
+from fuzzy_vendor_matching_webhook_python import config, matching, prefork
+from fuzzy_vendor_matching_webhook_python.metrics import latest_metrics
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import db
+from fuzzy_vendor_matching_webhook_python.trigram_index import InMemoryVendorMatcher
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+def test_preload_creates_matcher_and_closes_pool(monkeypatch):
+    monkeypatch.setattr(config, "VENDOR_MATCHER", "memory")
+    monkeypatch.setattr(config, "MATCH_CACHE_SIZE", 0)
+    matching.reset_matcher()
+    try:
+        app = prefork.preload()
+
+        assert app.url_map.bind("").match("/vendor_matching", method="POST")
+        assert isinstance(matching._matcher, InMemoryVendorMatcher)
+        assert db._pool is None
+    finally:
+        matching.reset_matcher()
+
+
+def test_memory_usage():
+    usage = prefork.memory_usage()
+
+    assert usage["rss"] > 0
+
+
+def test_metrics_of_all_workers(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    (tmp_path / "counter_1.db").write_bytes(b"")  # left by a previous run
+    prefork.clear_metrics_directory()
+    worker = (
+        "from fuzzy_vendor_matching_webhook_python.metrics import VENDORS_NOT_FOUND;"
+        "VENDORS_NOT_FOUND.inc()"
+    )
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", worker], check=True)
+
+    assert b"vendor_matching_vendors_not_found_total 2.0" in latest_metrics()
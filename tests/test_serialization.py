@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from fuzzy_vendor_matching_webhook_python import serialization
+from fuzzy_vendor_matching_webhook_python.serialization import dumps, encoded_option, use_orjson
+
+RESPONSE = {
+    "messages": [],
+    "operations": [
+        {
+            "op": "replace",
+            "id": "190004",
+            "value": {
+                "content": {"value": "DE1"},
+                "options": [
+                    {"value": "DE1", "label": 'Müller "Bau", Straße 1 (1)'},
+                    {"value": "DE2", "label": "Bosco\\Ltd (2)"},
+                ],
+            },
+        }
+    ],
+}
+
+
+@pytest.mark.parametrize("orjson", [True, False])
+def test_same_json(monkeypatch, orjson):
+    monkeypatch.setattr(serialization, "USE_ORJSON", orjson)
+
+    assert json.loads(dumps(RESPONSE)) == RESPONSE
+
+
+def test_options_encoded_once(monkeypatch):
+    monkeypatch.setattr(serialization, "USE_ORJSON", True)
+    encoded_option.cache_clear()
+
+    dumps(RESPONSE)
+    dumps(RESPONSE)
+
+    assert encoded_option.cache_info().misses == 2
+    assert RESPONSE["operations"][0]["value"]["options"][0] == {
+        "value": "DE1",
+        "label": 'Müller "Bau", Straße 1 (1)',
+    }
+
+
+def test_falls_back_to_json(monkeypatch):
+    monkeypatch.setattr(serialization, "orjson", None)
+
+    assert not use_orjson("orjson")
+
+
+def test_falls_back_to_json_without_fragment(monkeypatch):
+    monkeypatch.setattr(serialization, "orjson", object())
+
+    assert not use_orjson("orjson")
+
+
+@pytest.mark.parametrize("orjson", [True, False])
+def test_other_values(monkeypatch, orjson):
+    monkeypatch.setattr(serialization, "USE_ORJSON", orjson)
+
+    assert json.loads(dumps({"a": [1]})) == {"a": [1]}
+    assert json.loads(dumps({"messages": [], "operations": []})) == {
+        "messages": [],
+        "operations": [],
+    }
+
+
+def test_unknown_serializer():
+    with pytest.raises(ValueError):
+        use_orjson("ujson")
@@ -1,11 +1,42 @@
 import json
+import tracemalloc
 
 import pytest
+from prometheus_client import REGISTRY
 
+from database.database import DatabaseUnavailable
+from fuzzy_vendor_matching_webhook_python import matching, serialization, webhook
+from fuzzy_vendor_matching_webhook_python.import_vendor_data import db
+from fuzzy_vendor_matching_webhook_python.webhook import (
+    index_by_schema_id,
+    parse_json,
+    PRUNED_NODE,
+)
 from tests.conftest import create_annotation_tree, WEBHOOK_URL
 from tests.conftest import create_hashed_signature
 
 
+def post_annotation(
+    client, annotation_tree, action="initialize", updated_datapoints=(), settings=None
+):
+    webhook_schema = {
+        "action": action,
+        "updated_datapoints": list(updated_datapoints),
+        "hook": WEBHOOK_URL,
+        "settings": settings or {},
+        "annotation": {"content": annotation_tree},
+    }
+    request_body = json.dumps(webhook_schema).encode("utf-8")
+    return client.post(
+        data=request_body,
+        path="/vendor_matching",
+        headers={
+            "Content-Type": "application/json",
+            "X-Elis-Signature": f"sha1={create_hashed_signature(request_body)}",  # noqa
+        },
+    )
+
+
 @pytest.mark.usefixtures("fill_vendor_data_table")
 class TestValidate:
     def test_success_sender_name(self, client):
@@ -163,3 +194,349 @@ class TestValidate:
                 }
             ],
         }
+
+    def test_options_ranked_by_similarity(self, client):
+        annot_tree = post_annotation(client, create_annotation_tree(sender_name="Bernhard Bosco"))
+
+        assert annot_tree.status_code == 200
+        options = annot_tree.json["operations"][0]["value"]["options"]
+        assert [option["value"] for option in options] == ["DE757038244", "DE758402667"]
+        assert annot_tree.json["operations"][0]["value"]["content"] == {"value": "DE757038244"}
+
+    @pytest.mark.parametrize(
+        "settings, found",
+        [({"country": " de"}, True), ({"country": "AT"}, False), ({"file_id": "999"}, False)],
+    )
+    def test_scoped_by_settings(self, client, settings, found):
+        annot_tree = post_annotation(
+            client, create_annotation_tree(vendor_vat_id="DE758402667"), settings=settings
+        )
+
+        assert annot_tree.status_code == 200
+        options = annot_tree.json["operations"][0]["value"]["options"]
+        assert (options[0]["value"] == "DE758402667") == found
+
+    @pytest.mark.parametrize("settings", [["DE"], {"country": 1}, {"file_id": ["345"]}])
+    def test_invalid_settings(self, client, settings):
+        annot_tree = post_annotation(client, create_annotation_tree(), settings=settings)
+
+        assert annot_tree.status_code == 400
+
+    def test_same_response_with_json_serializer(self, client, monkeypatch):
+        annotation_tree = create_annotation_tree(sender_name="Bernhard Bosco")
+        monkeypatch.setattr(serialization, "USE_ORJSON", True)
+        response = post_annotation(client, annotation_tree)
+        monkeypatch.setattr(serialization, "USE_ORJSON", False)
+
+        assert post_annotation(client, annotation_tree).json == response.json
+
+    def test_options_limited(self, client, monkeypatch):
+        monkeypatch.setattr(webhook, "MAX_VENDOR_OPTIONS", 1)
+
+        annot_tree = post_annotation(client, create_annotation_tree(sender_name="Bernhard Bosco"))
+
+        assert annot_tree.status_code == 200
+        options = annot_tree.json["operations"][0]["value"]["options"]
+        assert [option["value"] for option in options] == ["DE757038244"]
+
+
+def line_items(rows: int):
+    return [
+        {
+            "id": f"row{row}",
+            "schema_id": "line_item",
+            "children": [
+                {"id": f"{row}_{column}", "schema_id": column, "content": {"value": "x" * 20}}
+                for column in ("item_description", "item_quantity", "item_amount")
+            ],
+        }
+        for row in range(rows)
+    ]
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestLargeAnnotation:
+    def test_peak_memory(self, client):
+        annotation_tree = [{"id": "1", "schema_id": "line_items", "children": line_items(5000)}]
+        annotation_tree += create_annotation_tree(sender_name="Bernhard")
+        body_size = len(json.dumps(annotation_tree))
+        post_annotation(client, annotation_tree)
+
+        tracemalloc.start()
+        try:
+            annot_tree = post_annotation(client, annotation_tree)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert annot_tree.json["operations"][0]["value"]["content"] == {"value": "DE757038244"}
+        # the body is held once as read and once decoded, the tree is not kept
+        assert peak < 4 * body_size
+
+    def test_unread_nodes_pruned(self):
+        annotation_tree = line_items(2) + create_annotation_tree(sender_name="Bernhard")
+
+        parsed = parse_json(json.dumps({"annotation": {"content": annotation_tree}}).encode())
+
+        content = parsed["annotation"]["content"]
+        assert content[:2] == [PRUNED_NODE, PRUNED_NODE]
+        with pytest.raises(TypeError):
+            content[0]["schema_id"] = "line_item"
+        assert content[2] == annotation_tree[2]
+
+    def test_invalid_json(self, client):
+        request_body = b"{"
+
+        annot_tree = client.post(
+            data=request_body,
+            path="/vendor_matching",
+            headers={
+                "Content-Type": "application/json",
+                "X-Elis-Signature": f"sha1={create_hashed_signature(request_body)}",  # noqa
+            },
+        )
+
+        assert annot_tree.status_code == 400
+
+
+def post_batch(client, vendors, payload=None):
+    """Post the vendors to the batch endpoint, or the payload instead when given."""
+    request_body = json.dumps({"vendors": vendors} if payload is None else payload).encode()
+    return client.post(
+        data=request_body,
+        path="/vendor_matching/batch",
+        headers={
+            "Content-Type": "application/json",
+            "X-Elis-Signature": f"sha1={create_hashed_signature(request_body)}",  # noqa
+        },
+    )
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestBatch:
+    def test_results_streamed_in_order(self, client):
+        vendors = [
+            {"id": 1, "name": "Bernhard"},
+            {"id": 2, "vat_id": "DE 758402667"},
+            {"id": 3, "name": "Nonexistent Vendor"},
+        ]
+        response = post_batch(client, vendors)
+
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert [line["id"] for line in lines] == [1, 2, 3]
+        assert lines[0]["options"][0]["value"] == "DE757038244"
+        assert lines[1]["options"][0]["value"] == "DE758402667"
+        assert lines[2]["options"] == []
+
+    @pytest.mark.parametrize(
+        "payload",
+        [
+            {},
+            [],
+            {"vendors": "Bernhard"},
+            {"vendors": ["Bernhard"]},
+            {"vendors": [{"id": 1, "name": "Bernhard"}, {"id": 2, "name": ["Bosco"]}]},
+        ],
+    )
+    def test_invalid_vendors(self, client, payload):
+        assert post_batch(client, None, payload).status_code == 400
+
+    def test_null_inputs(self, client):
+        response = post_batch(client, [{"id": 1, "vat_id": None, "name": "Bernhard"}])
+
+        assert response.status_code == 200
+        assert json.loads(response.data)["options"][0]["value"] == "DE757038244"
+
+    def test_unavailable_database_ends_stream_with_error(self, client, monkeypatch):
+        def match_many(self, queries, limit, scope):
+            yield []
+            raise DatabaseUnavailable("Database circuit breaker is open")
+
+        monkeypatch.setattr(matching.SqlVendorMatcher, "match_many", match_many)
+        monkeypatch.setattr(matching.CachedVendorMatcher, "match_many", match_many)
+
+        response = post_batch(client, [{"id": 1, "name": "Bernhard"}, {"id": 2, "name": "Bosco"}])
+
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert lines[0]["id"] == 1
+        assert lines[1] == {"error": "Database unavailable: Database circuit breaker is open"}
+
+    def test_signature_required(self, client):
+        response = client.post(
+            data=json.dumps({"vendors": []}),
+            path="/vendor_matching/batch",
+            headers={"Content-Type": "application/json", "X-Elis-Signature": "sha1=0000"},
+        )
+
+        assert response.status_code == 401
+
+
+class TestShortCircuit:
+    def test_unrelated_update_skips_database(self, client, monkeypatch):
+        def fail(*args, **kwargs):
+            raise AssertionError("The database must not be queried.")
+
+        monkeypatch.setattr(db, "execute_and_fetchall", fail)
+        counter = "vendor_matching_short_circuited_calls_total"
+        before = REGISTRY.get_sample_value(counter)
+
+        annot_tree = post_annotation(
+            client,
+            create_annotation_tree(sender_name="Bernhard"),
+            action="user_update",
+            updated_datapoints=[190004],
+        )
+
+        assert annot_tree.status_code == 200
+        assert annot_tree.json == {"messages": [], "operations": []}
+        assert REGISTRY.get_sample_value(counter) == before + 1
+
+
+def slow_statement(*present):
+    """A statement taking the parameters of match_vendor_statement, and a second."""
+    inputs = ", ".join(f"${i}::text" for i in range(1, sum(present) + 1))
+    return (
+        f"slow_{sum(present)}",
+        f"SELECT concat({inputs}), pg_sleep(1)::text "
+        f"WHERE ${sum(present) + 2}::float8 > 0 LIMIT ${sum(present) + 1}",
+    )
+
+
+DEADLINE_WARNING = {
+    "id": "190004",
+    "type": "warning",
+    "content": "Vendor matching timed out, the vendor was not matched by name and address.",
+}
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestDeadline:
+    @pytest.fixture(autouse=True)
+    def slow_matching(self, monkeypatch):
+        monkeypatch.setattr(webhook, "REQUEST_DEADLINE", 0.2)
+        monkeypatch.setattr(matching, "match_vendor_statement", slow_statement)
+
+    def test_vendor_enum_left_as_it_is(self, client):
+        counter = "vendor_matching_deadlines_exceeded_total"
+        before = REGISTRY.get_sample_value(counter)
+
+        annot_tree = post_annotation(client, create_annotation_tree(sender_name="Bernhard"))
+
+        assert annot_tree.status_code == 200
+        assert annot_tree.json == {"messages": [DEADLINE_WARNING], "operations": []}
+        assert REGISTRY.get_sample_value(counter) == before + 1
+
+    def test_vat_id_hits_offered(self, client, monkeypatch):
+        # the VAT ID lookup does not decide, as if several vendors had the VAT ID
+        monkeypatch.setattr(matching, "unique_vat_id_hit", lambda hits: False)
+
+        annot_tree = post_annotation(
+            client, create_annotation_tree(vendor_vat_id="DE758402667", sender_name="Bosco")
+        )
+
+        assert annot_tree.status_code == 200
+        assert annot_tree.json["messages"] == [DEADLINE_WARNING]
+        options = annot_tree.json["operations"][0]["value"]["options"]
+        assert [option["value"] for option in options] == ["DE758402667"]
+
+    def test_vendor_data_version_check_cancelled(self, client, monkeypatch):
+        def slow_version():
+            db.execute("SELECT pg_sleep(1)")
+            return 1
+
+        monkeypatch.setattr(matching, "db_vendor_data_version", slow_version)
+
+        annot_tree = post_annotation(client, create_annotation_tree(sender_name="Bernhard"))
+
+        assert annot_tree.status_code == 200
+        assert annot_tree.json == {"messages": [DEADLINE_WARNING], "operations": []}
+
+    def test_matcher_created_regardless(self, client, monkeypatch):
+        def slow_create_matcher():
+            db.execute("SELECT pg_sleep(0.3)")
+            return matching.SqlVendorMatcher()
+
+        monkeypatch.setattr(matching, "create_matcher", slow_create_matcher)
+
+        post_annotation(client, create_annotation_tree(sender_name="Bernhard"))
+
+        assert isinstance(matching._matcher, matching.SqlVendorMatcher)
+
+
+class TestDatabaseUnavailable:
+    def test_service_unavailable(self, client, monkeypatch):
+        def unavailable(*args, **kwargs):
+            raise DatabaseUnavailable("Database circuit breaker is open")
+
+        monkeypatch.setattr(db, "_execute", unavailable)
+
+        annot_tree = post_annotation(client, create_annotation_tree(sender_name="Bernhard"))
+
+        assert annot_tree.status_code == 503
+
+    def test_batch_service_unavailable(self, client, monkeypatch):
+        def unavailable(*args, **kwargs):
+            raise DatabaseUnavailable("Database circuit breaker is open")
+
+        monkeypatch.setattr(db, "_execute", unavailable)
+
+        assert post_batch(client, [{"id": 1, "name": "Bernhard"}]).status_code == 503
+
+
+@pytest.mark.usefixtures("fill_vendor_data_table")
+class TestMetrics:
+    def test_stages_timed(self, client):
+        stages = ["signature", "parse", "tree_lookup", "match", "sql", "serialize"]
+        before = [stage_count(stage) for stage in stages]
+
+        post_annotation(client, create_annotation_tree(sender_name="Bernhard Group"))
+
+        assert all(stage_count(stage) > count for stage, count in zip(stages, before))
+
+    def test_vendor_not_found_counted(self, client):
+        counter = "vendor_matching_vendors_not_found_total"
+        before = REGISTRY.get_sample_value(counter)
+
+        post_annotation(client, create_annotation_tree(sender_name="NotExist"))
+
+        assert REGISTRY.get_sample_value(counter) == before + 1
+
+    def test_metrics_endpoint(self, client):
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert b"vendor_matching_stage_seconds_bucket" in response.data
+
+
+def stage_count(stage) -> float:
+    count = REGISTRY.get_sample_value("vendor_matching_stage_seconds_count", {"stage": stage})
+    return count or 0
+
+
+class TestIndexBySchemaId:
+    def test_finds_nested_nodes(self):
+        nodes = index_by_schema_id(create_annotation_tree(), ["sender_name", "vendor_match"])
+
+        assert nodes["sender_name"]["id"] == "190001"
+        assert nodes["vendor_match"]["id"] == "190004"
+
+    def test_first_node_in_document_order(self):
+        annotation_tree = [
+            {"id": "1", "schema_id": "section", "children": [{"id": "2", "schema_id": "a"}]},
+            {"id": "3", "schema_id": "a"},
+        ]
+
+        assert index_by_schema_id(annotation_tree, ["a"])["a"]["id"] == "2"
+
+    def test_stops_once_all_found(self):
+        # a walk going on would fail on the node without schema_id
+        annotation_tree = create_annotation_tree() + [{"id": "1"}]
+
+        assert len(index_by_schema_id(annotation_tree, ["sender_name", "vendor_match"])) == 2
+
+    def test_missing_ids_are_left_out(self):
+        assert index_by_schema_id(create_annotation_tree(), ["sender_name", "missing"]).keys() == {
+            "sender_name"
+        }